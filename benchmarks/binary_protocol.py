@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Measures how many datapoints per second one core can encode and decode
+with the binary protocol, next to the pickle and plaintext line protocols,
+and how many bytes each takes per datapoint.
+
+usage: binary_protocol.py [messages] [points-per-message] [metrics]
+
+Messages hold 500 datapoints by default, what the relay sends, spread over
+10000 metrics that report over and over, so after the first few messages
+the binary protocol only sends names it has not sent before. Decoding is
+timed through each protocol's receiver up to a metricsReceived handler
+that only counts, so it includes everything a daemon does to receive.
+"""
+
+import sys
+import time
+from os.path import dirname, join, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'lib'))
+
+from carbon.conf import settings
+settings['CONF_DIR'] = join(ROOT_DIR, 'conf')
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+from carbon.protocols import MetricBinaryReceiver, MetricPickleReceiver, MetricLineReceiver
+from carbon.binary import NameTableEncoder
+from carbon.util import pickle
+from carbon import events, state, instrumentation
+state.instrumentation = instrumentation
+
+
+def makeBatches(messages, points, metrics):
+  now = int(time.time())
+  names = [ "carbon.benchmark.host%d.metric%d" % (i % 100, i) for i in xrange(metrics) ]
+  return [ [ (names[(m * points + i) % metrics], (now + m, (m * points + i) * 1.5))
+             for i in xrange(points) ]
+           for m in xrange(messages) ]
+
+
+def encodeLines(datapoints):
+  return ''.join([ "%s %r %d\n" % (metric, value, timestamp)
+                   for (metric, (timestamp, value)) in datapoints ])
+
+
+def encodePickle(datapoints):
+  return pickle.dumps(datapoints, protocol=2)
+
+
+def run(label, encode, protocolClass, deliver, batches, points):
+  t = time.time()
+  messages = [ encode(batch) for batch in batches ]
+  encodeTime = time.time() - t
+
+  received = [0]
+  def count(datapoints):
+    received[0] += len(datapoints)
+  events.metricsReceived.addHandler(count)
+  protocol = protocolClass()
+  protocol.makeConnection(StringTransport())
+  try:
+    t = time.time()
+    for message in messages:
+      deliver(protocol, message)
+    decodeTime = time.time() - t
+  finally:
+    events.metricsReceived.removeHandler(count)
+    protocol.connectionLost(Failure(ConnectionDone()))
+
+  total = len(batches) * points
+  assert received[0] == total, received[0]
+  size = sum([ len(message) for message in messages ])
+  print "%-8s encode %10.0f points/sec  decode %10.0f points/sec  %5.1f bytes/point" % \
+        (label, total / encodeTime, total / decodeTime, float(size) / total)
+
+
+if __name__ == '__main__':
+  messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+  points = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+  metrics = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+
+  batches = makeBatches(messages, points, metrics)
+  encoder = NameTableEncoder(settings.BINARY_MAX_NAMES)
+  run('line', encodeLines, MetricLineReceiver,
+      lambda protocol, message: protocol.dataReceived(message), batches, points)
+  run('pickle', encodePickle, MetricPickleReceiver,
+      lambda protocol, message: protocol.stringReceived(message), batches, points)
+  run('binary', encoder.encode, MetricBinaryReceiver,
+      lambda protocol, message: protocol.stringReceived(message), batches, points)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Measures the resident memory cost of each datapoint held in the MetricCache.
+
+usage: cache_memory.py [metrics] [points-per-metric]
+
+Each cache layout is filled in a freshly forked child so that one run's
+allocations cannot be reused by the next. The "tuples" layout is the old
+per-metric list of (timestamp, value) tuples, "arrays" is the current
+MetricCache.
+"""
+
+import os
+import sys
+import time
+from os.path import dirname, join, abspath
+
+LIB_DIR = join(dirname(dirname(abspath(__file__))), 'lib')
+sys.path.insert(0, LIB_DIR)
+
+from carbon.cache import MetricCache
+
+PAGESIZE = os.sysconf('SC_PAGESIZE')
+
+
+def rss():
+  return int( open('/proc/self/statm').read().split()[1] ) * PAGESIZE
+
+
+class TupleCache(dict):
+  "The list-of-tuples layout MetricCache used to have"
+  def store(self, metric, datapoint):
+    self.setdefault(metric, []).append(datapoint)
+
+
+def fill(cache, metrics, points):
+  now = int(time.time())
+  names = [ "carbon.benchmark.host%d.metric%d" % (i % 100, i) for i in range(metrics) ]
+  for t in range(points):
+    timestamp = float(now + t)
+    for name in names:
+      cache.store(name, (timestamp, float(t) * 1.5))
+  return names
+
+
+def measure(label, cacheFactory, metrics, points):
+  pid = os.fork()
+  if pid:
+    os.waitpid(pid, 0)
+    return
+
+  fill(TupleCache(), min(metrics, 10), 1) # warm up interned code paths
+  before = rss()
+  cache = cacheFactory()
+  t = time.time()
+  fill(cache, metrics, points)
+  elapsed = time.time() - t
+  used = rss() - before
+  total = metrics * points
+  print "%-7s %10d points %8.1f bytes/point %9.0f stores/sec" % (
+    label, total, float(used) / total, total / elapsed)
+  os._exit(0)
+
+
+if __name__ == '__main__':
+  metrics = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  points = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+  measure('tuples', TupleCache, metrics, points)
+  measure('arrays', lambda: MetricCache.__class__(shardCount=16), metrics, points)
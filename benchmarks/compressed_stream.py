@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Measures what zlib compression does to the line and pickle streams a
+relay sends: the bytes per datapoint and the socket reads it takes to
+carry them, the cost of compressing on the sending side, and how many
+datapoints per second the compressed receivers take in compared with the
+plain ones.
+
+usage: compressed_stream.py [points] [metrics]
+
+The stream is made of 500-datapoint messages over 10000 metrics named the
+way a fleet of servers names them, reporting over and over. It is fed to
+each receiver in reads of at most 64KB, as a busy socket hands it over,
+and dispatched to a single metricsReceived handler that only counts.
+"""
+
+import sys
+import time
+import zlib
+import struct
+from os.path import dirname, join, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'lib'))
+
+from carbon.conf import settings
+settings['CONF_DIR'] = join(ROOT_DIR, 'conf')
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+from carbon.protocols import (MetricLineReceiver, MetricPickleReceiver,
+                              MetricCompressedLineReceiver,
+                              MetricCompressedPickleReceiver)
+from carbon.util import pickle
+from carbon import events, state, instrumentation
+state.instrumentation = instrumentation
+
+READ_SIZE = 65536
+MESSAGE_POINTS = 500
+
+
+def makeBatches(points, metrics):
+  now = int(time.time())
+  names = [ "servers.%s%03d.%s.%s" % (("web", "db", "cache")[i % 3], (i // 3) % 200,
+                                       ("cpu", "memory", "disk", "network")[i % 4],
+                                       ("user", "system", "idle", "free", "used")[i % 5])
+            + ".value%d" % (i // 600) for i in xrange(metrics) ]
+  datapoints = [ (names[i % metrics], (now + (i // metrics) * 60, (i % 977) * 0.25))
+                 for i in xrange(points) ]
+  return [ datapoints[i:i + MESSAGE_POINTS] for i in xrange(0, points, MESSAGE_POINTS) ]
+
+
+def encodeLines(batch):
+  return ''.join([ "%s %r %r\n" % (metric, value, timestamp)
+                   for (metric, (timestamp, value)) in batch ])
+
+
+def encodePickle(batch):
+  data = pickle.dumps(batch, protocol=2)
+  return struct.pack('!L', len(data)) + data
+
+
+def compress(messages, flushEach):
+  """A whole stream, flushed after every message like a sender that writes
+  each one out as it goes, or only at the end like a spool file"""
+  compressor = zlib.compressobj()
+  if flushEach:
+    chunks = [ compressor.compress(m) + compressor.flush(zlib.Z_SYNC_FLUSH) for m in messages ]
+  else:
+    chunks = [ compressor.compress(m) for m in messages ]
+  chunks.append(compressor.flush())
+  return ''.join(chunks)
+
+
+def receive(protocolClass, stream, points):
+  received = [0]
+  def count(datapoints):
+    received[0] += len(datapoints)
+  events.metricsReceived.addHandler(count)
+  protocol = protocolClass()
+  protocol.makeConnection(StringTransport())
+  try:
+    t = time.time()
+    for offset in xrange(0, len(stream), READ_SIZE):
+      protocol.dataReceived(stream[offset:offset + READ_SIZE])
+    elapsed = time.time() - t
+  finally:
+    events.metricsReceived.removeHandler(count)
+    protocol.connectionLost(Failure(ConnectionDone()))
+  assert received[0] == points, received[0]
+  return elapsed
+
+
+def run(label, encode, plainClass, compressedClass, batches, points):
+  messages = [ encode(batch) for batch in batches ]
+  plain = ''.join(messages)
+  print "%s, %d datapoints" % (label, points)
+  print "  %-23s %6.1f bytes/point %8d reads %10.0f points/sec received" % \
+        ('plain', float(len(plain)) / points, (len(plain) - 1) // READ_SIZE + 1,
+         points / receive(plainClass, plain, points))
+
+  for name, flushEach in (('zlib, flush per message', True), ('zlib, spool file', False)):
+    t = time.time()
+    stream = compress(messages, flushEach)
+    compressTime = time.time() - t
+    print "  %-23s %6.1f bytes/point %8d reads %10.0f points/sec received  %4.1fx smaller, %.0f points/sec compressed" % \
+          (name, float(len(stream)) / points, (len(stream) - 1) // READ_SIZE + 1,
+           points / receive(compressedClass, stream, points),
+           float(len(plain)) / len(stream), points / compressTime)
+
+
+if __name__ == '__main__':
+  points = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+  metrics = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+  batches = makeBatches(points, metrics)
+  run('line', encodeLines, MetricLineReceiver, MetricCompressedLineReceiver, batches, points)
+  run('pickle', encodePickle, MetricPickleReceiver, MetricCompressedPickleReceiver, batches, points)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Measures how many datapoints per second carbon-cache can hand from a
+receiver to the MetricCache, dispatching them one metricReceived event at a
+time as it used to, and one metricsReceived batch per received message.
+
+usage: event_dispatch.py [points] [batch-size] [shards]
+
+Both runs go through the default instrumentation handler and into a
+MetricCache with the given number of shards (4 by default), in batches of
+batch-size datapoints (500 by default, a typical pickle message).
+"""
+
+import sys
+import time
+from os.path import dirname, join, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'lib'))
+
+from carbon.cache import MetricCache
+from carbon.events import Event
+from carbon import events, state, instrumentation
+state.instrumentation = instrumentation
+
+
+def makeBatches(points, batchSize):
+  now = int(time.time())
+  datapoints = [ ("carbon.benchmark.host%d.metric%d" % (i % 100, i % 10000), (now + i // 10000, float(i)))
+                 for i in xrange(points) ]
+  return [ datapoints[i:i + batchSize] for i in xrange(0, points, batchSize) ]
+
+
+def perDatapoint(batches, shardCount):
+  "One event per datapoint, with the handlers carbon-cache used to register"
+  cache = MetricCache.__class__(shardCount=shardCount)
+  metricReceived = Event('metricReceived')
+  metricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
+  metricReceived.addHandler(cache.store)
+  t = time.time()
+  for batch in batches:
+    for (metric, datapoint) in batch:
+      metricReceived(metric, datapoint)
+  return cache, time.time() - t
+
+
+def perBatch(batches, shardCount):
+  "One event per batch, through the metricsReceived handlers"
+  cache = MetricCache.__class__(shardCount=shardCount)
+  events.metricsReceived.addHandler(cache.storeMany)
+  try:
+    t = time.time()
+    for batch in batches:
+      events.metricsReceived(batch)
+    return cache, time.time() - t
+  finally:
+    events.metricsReceived.removeHandler(cache.storeMany)
+
+
+if __name__ == '__main__':
+  points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  batchSize = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+  shardCount = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+  batches = makeBatches(points, batchSize)
+  for label, run in [ ('per datapoint', perDatapoint), ('per batch', perBatch) ]:
+    cache, elapsed = run(batches, shardCount)
+    assert cache.size == points, cache.size
+    print "%-14s %10d points %10.0f points/sec" % (label, points, points / elapsed)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Measures how many datapoints per second one core can take in over the
+plaintext line protocol, with the receiver parsing a line at a time
+through LineOnlyReceiver as it used to, and with MetricLineReceiver
+parsing each received chunk in one pass.
+
+usage: line_receiver.py [points] [chunk-size]
+
+The data is fed to the protocol in chunks of chunk-size bytes (64KB by
+default, what a busy socket hands over per read) and dispatched to a
+single metricReceived handler that only counts, so the numbers are the
+cost of receiving alone.
+"""
+
+import sys
+import time
+from os.path import dirname, join, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'lib'))
+
+from carbon.conf import settings
+settings['CONF_DIR'] = join(ROOT_DIR, 'conf')
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+from twisted.protocols.basic import LineOnlyReceiver
+from carbon.protocols import MetricLineReceiver
+from carbon import events, state, instrumentation
+state.instrumentation = instrumentation
+
+
+class LineAtATimeReceiver(MetricLineReceiver):
+  "The receiver as it was, one lineReceived() and metricReceived() per line"
+  dataReceived = LineOnlyReceiver.dataReceived
+
+
+def makeData(points):
+  now = int(time.time())
+  lines = [ "carbon.benchmark.host%d.metric%d %d.5 %d\n" % (i % 100, i % 10000, i, now)
+            for i in xrange(points) ]
+  return ''.join(lines)
+
+
+def run(label, protocolClass, data, chunkSize, points):
+  received = [0]
+  def count(metric, datapoint):
+    received[0] += 1
+  events.metricReceived.addHandler(count)
+
+  protocol = protocolClass()
+  protocol.makeConnection(StringTransport())
+  try:
+    t = time.time()
+    for offset in xrange(0, len(data), chunkSize):
+      protocol.dataReceived(data[offset:offset + chunkSize])
+    elapsed = time.time() - t
+  finally:
+    events.metricReceived.removeHandler(count)
+    protocol.connectionLost(Failure(ConnectionDone()))
+
+  assert received[0] == points, received[0]
+  print "%-18s %10d points %10.0f points/sec" % (label, points, points / elapsed)
+
+
+if __name__ == '__main__':
+  points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  chunkSize = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+
+  data = makeData(points)
+  run('line at a time', LineAtATimeReceiver, data, chunkSize, points)
+  run('chunk at a time', MetricLineReceiver, data, chunkSize, points)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Measures how many datapoints per second one core can take in over the
+pickle protocol, with the receiver unpickling and converting a message the
+way it used to (SafeUnpickler, then float() each datapoint in a loop), and
+as MetricPickleReceiver now does (DatapointUnpickler and a single pass),
+next to the insecure unpickler.
+
+usage: pickle_receiver.py [messages] [points-per-message]
+
+Messages hold 500 datapoints by default, what carbon-relay and most pickle
+clients send, and are pickled with protocols 0 and 2. Datapoints are
+dispatched to a single metricsReceived handler that only counts, so the
+numbers are the cost of receiving alone.
+"""
+
+import sys
+import time
+from os.path import dirname, join, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'lib'))
+
+from carbon.conf import settings
+settings['CONF_DIR'] = join(ROOT_DIR, 'conf')
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.python.failure import Failure
+from twisted.internet.error import ConnectionDone
+from carbon.protocols import MetricPickleReceiver
+from carbon.util import pickle, SafeUnpickler
+from carbon import events, state, instrumentation
+state.instrumentation = instrumentation
+
+
+class LoopingPickleReceiver(MetricPickleReceiver):
+  "The receiver as it was, SafeUnpickler and a float() loop per message"
+  def connectionMade(self):
+    MetricPickleReceiver.connectionMade(self)
+    self.unpickler = SafeUnpickler
+
+  def stringReceived(self, data):
+    try:
+      datapoints = self.unpickler.loads(data)
+    except:
+      return
+    self.metricsReceived(self.validDatapoints(datapoints))
+
+
+class InsecurePickleReceiver(MetricPickleReceiver):
+  def connectionMade(self):
+    MetricPickleReceiver.connectionMade(self)
+    self.unpickler = pickle
+
+
+def makeMessage(points, protocol):
+  now = int(time.time())
+  datapoints = [ ("carbon.benchmark.host%d.metric%d" % (i % 100, i), (now, i * 1.5))
+                 for i in xrange(points) ]
+  return pickle.dumps(datapoints, protocol)
+
+
+def run(label, protocolClass, message, messages, points):
+  received = [0]
+  def count(datapoints):
+    received[0] += len(datapoints)
+  events.metricsReceived.addHandler(count)
+
+  protocol = protocolClass()
+  protocol.makeConnection(StringTransport())
+  try:
+    t = time.time()
+    for i in xrange(messages):
+      protocol.stringReceived(message)
+    elapsed = time.time() - t
+  finally:
+    events.metricsReceived.removeHandler(count)
+    protocol.connectionLost(Failure(ConnectionDone()))
+
+  assert received[0] == messages * points, received[0]
+  print "  %-10s %10.0f points/sec %8.1f usec/message" % \
+        (label, messages * points / elapsed, elapsed / messages * 1e6)
+
+
+if __name__ == '__main__':
+  messages = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+  points = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+  for protocol in (0, 2):
+    message = makeMessage(points, protocol)
+    print "pickle protocol %d, %d datapoints per message (%d bytes)" % (protocol, points, len(message))
+    run('before', LoopingPickleReceiver, message, messages, points)
+    run('safe', MetricPickleReceiver, message, messages, points)
+    run('insecure', InsecurePickleReceiver, message, messages, points)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Replays a synthetic dashboard query trace against carbon-reader's
+ReadCache, with a simulated clock and a stand-in database that answers
+fetches the way whisper would, and reports how many queries were served
+from memory and how many datapoints still had to be read.
+
+usage: reader_trace.py [metrics] [hours] [max-points]
+
+Every 10 simulated seconds each metric receives a datapoint and 20
+queries are made. Queried metrics follow a Zipf distribution and the
+ranges asked for are 1 hour (50%), 6 hours (25%), 1 day (15%) or 7 days
+(10%) back from now, which is what a wall of refreshing dashboards and
+the odd person digging into the past looks like.
+"""
+
+import sys
+import time
+import random
+from bisect import bisect
+from os.path import dirname, join, abspath
+
+LIB_DIR = join(dirname(dirname(abspath(__file__))), 'lib')
+sys.path.insert(0, LIB_DIR)
+
+from carbon.conf import settings
+from carbon.readcache import ReadCache
+from carbon import instrumentation
+
+ARCHIVES = [ (10, 86400), (60, 7 * 86400), (600, 365 * 86400) ]
+WIDTHS = [ (3600, 50), (6 * 3600, 25), (86400, 15), (7 * 86400, 10) ]
+STEP = 10
+QUERIES_PER_STEP = 20
+
+
+class TraceDatabase(object):
+  "Every interval of every archive has a value, reads are only counted"
+  def __init__(self, clock):
+    self.clock = clock
+    self.fetches = 0
+    self.pointsRead = 0
+
+  def getArchives(self, metric):
+    return ARCHIVES
+
+  def fetch(self, metric, fromTime, untilTime, secondsPerPoint=None):
+    if secondsPerPoint is None:
+      now = self.clock[0]
+      fromTime = max(fromTime, now - ARCHIVES[-1][1])
+      untilTime = min(untilTime, now)
+      for step, retention in ARCHIVES:
+        if retention >= now - fromTime:
+          break
+    else:
+      step = secondsPerPoint
+    fromInterval = fromTime - (fromTime % step) + step
+    untilInterval = untilTime - (untilTime % step) + step
+    if fromInterval == untilInterval:
+      untilInterval += step
+    values = [ float(interval % 1000) for interval in xrange(fromInterval, untilInterval, step) ]
+    self.fetches += 1
+    self.pointsRead += len(values)
+    return ((fromInterval, untilInterval, step), values)
+
+
+def cumulative(weights):
+  total = 0.0
+  result = []
+  for weight in weights:
+    total += weight
+    result.append(total)
+  return result
+
+
+def run(metrics, hours, maxPoints):
+  settings['READ_CACHE_MAX_POINTS'] = maxPoints
+  random.seed(42)
+  clock = [ 1400000000 ]
+  database = TraceDatabase(clock)
+  cache = ReadCache.__class__(database)
+  instrumentation.stats.clear()
+
+  names = [ "carbon.benchmark.host%d.metric%d" % (i % 100, i) for i in range(metrics) ]
+  popularity = cumulative([ 1.0 / (rank + 1) for rank in range(metrics) ])
+  widths = cumulative([ share for (width, share) in WIDTHS ])
+
+  queries = 0
+  uncachedPoints = 0
+  queryTime = 0.0
+  storeTime = 0.0
+  for tick in xrange(hours * 3600 // STEP):
+    clock[0] += STEP
+    now = clock[0]
+
+    t = time.time()
+    for name in names:
+      cache.store(name, (now, 1.0))
+    storeTime += time.time() - t
+
+    if tick % (600 // STEP) == 0:
+      cache.expire(now)
+
+    t = time.time()
+    for i in range(QUERIES_PER_STEP):
+      name = names[bisect(popularity, random.random() * popularity[-1])]
+      width = WIDTHS[bisect(widths, random.random() * widths[-1])][0]
+      timeInfo, values = cache.query(name, now - width, now=now)
+      uncachedPoints += len(values)
+      queries += 1
+    queryTime += time.time() - t
+
+  hits = instrumentation.stats.get('readCacheHits', 0)
+  print "%d metrics, %d simulated hours, READ_CACHE_MAX_POINTS=%d" % (metrics, hours, maxPoints)
+  print "  queries            %10d  %10.0f queries/sec" % (queries, queries / queryTime)
+  print "  served from memory %10d  %9.1f%%" % (hits, 100.0 * hits / queries)
+  print "  database fetches   %10d" % database.fetches
+  print "  points read        %10d  %9.1f%% of what whisper alone would read" % \
+        (database.pointsRead, 100.0 * database.pointsRead / uncachedPoints)
+  print "  points cached      %10d  in %d metrics" % (cache.size, len(cache.metrics))
+  print "  ingest             %10.0f points/sec" % (metrics * (tick + 1) / storeTime)
+
+
+if __name__ == '__main__':
+  metrics = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  hours = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+  maxPoints = int(sys.argv[3]) if len(sys.argv) > 3 else 2000000
+
+  run(metrics, hours, maxPoints)
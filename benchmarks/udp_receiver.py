@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Measures how many datapoints per second one core can take in over UDP,
+with the listener reading, parsing and dispatching a datagram at a time
+as it used to, and with MetricDatagramPort handing everything waiting on
+the socket to the receiver as one batch.
+
+usage: udp_receiver.py [datagrams] [lines-per-datagram]
+
+The datagrams are all sent to a local socket with a receive buffer large
+enough to hold them before any is read (this needs root, or a high enough
+net.core.rmem_max), so the numbers are the cost of draining the socket
+alone. A single metricsReceived handler only counts.
+"""
+
+import sys
+import time
+import socket
+from os.path import dirname, join, abspath
+
+ROOT_DIR = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, 'lib'))
+
+from carbon.conf import settings
+settings['CONF_DIR'] = join(ROOT_DIR, 'conf')
+
+from twisted.internet import udp
+from carbon.protocols import MetricDatagramReceiver
+from carbon.datagram import MetricDatagramPort, kernelDrops
+from carbon import events, state, instrumentation
+state.instrumentation = instrumentation
+
+BUFFER_SIZE = 256 * 1024 * 1024
+
+
+class DatagramAtATimeReceiver(MetricDatagramReceiver):
+  "The receiver as it was, parsing and dispatching every datagram on its own"
+  def datagramReceived(self, data, (host, port)):
+    datapoints = []
+    for line in data.splitlines():
+      try:
+        metric, value, timestamp = line.strip().split()
+        datapoints.append( (metric, (float(timestamp), float(value))) )
+      except:
+        pass
+
+    if datapoints:
+      self.metricsReceived(datapoints)
+
+
+class DatagramAtATimePort(MetricDatagramPort):
+  "Twisted's own read loop, one datagramReceived() per datagram"
+  doRead = udp.Port.doRead
+
+
+def makeDatagrams(count, lines):
+  now = int(time.time())
+  return [ ''.join([ "carbon.benchmark.host%d.metric%d %d.5 %d\n" % (i % 100, (i * lines + j) % 10000, i, now)
+                     for j in range(lines) ])
+           for i in xrange(count) ]
+
+
+def run(label, portClass, protocol, datagrams, points):
+  received = [0]
+  def count(datapoints):
+    received[0] += len(datapoints)
+  events.metricsReceived.addHandler(count)
+
+  port = portClass(0, protocol, interface='127.0.0.1', bufferSize=BUFFER_SIZE)
+  port.startListening()
+  sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  address = ('127.0.0.1', port.getHost().port)
+  try:
+    for datagram in datagrams:
+      sender.sendto(datagram, address)
+    drops = kernelDrops()
+
+    t = time.time()
+    while received[0] < points - drops * (points // len(datagrams)):
+      port.doRead()
+    elapsed = time.time() - t
+  finally:
+    events.metricsReceived.removeHandler(count)
+    sender.close()
+    port.stopReading()
+    port.connectionLost()
+
+  print "%-20s %10d points %10.0f points/sec %8d kernel drops" % \
+        (label, received[0], received[0] / elapsed, drops)
+
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+  lines = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+  datagrams = makeDatagrams(count, lines)
+  run('datagram at a time', DatagramAtATimePort, DatagramAtATimeReceiver(),
+      datagrams, count * lines)
+  run('batched reads', MetricDatagramPort, MetricDatagramReceiver(),
+      datagrams, count * lines)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Measures what the write-ahead log (ENABLE_WAL) costs the receive path of
+carbon-cache: storing datapoints into the MetricCache alone, and followed by
+an append to the log with each WAL_FSYNC policy.
+
+usage: wal_throughput.py [metrics] [points-per-metric]
+
+Group commits happen every 10000 datapoints, which is what a cache
+receiving 100k points/s does with the default WAL_COMMIT_INTERVAL.
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+from os.path import dirname, join, abspath
+
+LIB_DIR = join(dirname(dirname(abspath(__file__))), 'lib')
+sys.path.insert(0, LIB_DIR)
+
+from carbon.conf import settings
+from carbon.cache import MetricCache
+from carbon.wal import WriteAheadLog
+
+COMMIT_EVERY = 10000
+
+
+def run(label, fsync, metrics, points):
+  cache = MetricCache.__class__(shardCount=16)
+  names = [ "carbon.benchmark.host%d.metric%d" % (i % 100, i) for i in range(metrics) ]
+  now = int(time.time())
+
+  walDir = tempfile.mkdtemp(prefix='carbon-bench-')
+  wal = None
+  if fsync is not None:
+    settings['WAL_DIR'] = walDir
+    settings['WAL_FSYNC'] = fsync
+    wal = WriteAheadLog()
+    wal.openSegment()
+    wal.enabled = True
+
+  try:
+    stored = 0
+    t = time.time()
+    for p in range(points):
+      datapoint = (float(now + p), float(p))
+      for name in names:
+        cache.store(name, datapoint)
+        if wal is not None:
+          wal.append(name, datapoint)
+          stored += 1
+          if stored % COMMIT_EVERY == 0:
+            wal.commit()
+    if wal is not None:
+      wal.commit()
+      wal.closeSegment()
+    elapsed = time.time() - t
+  finally:
+    shutil.rmtree(walDir)
+
+  total = metrics * points
+  print "%-18s %10d points %10.0f points/sec" % (label, total, total / elapsed)
+
+
+if __name__ == '__main__':
+  metrics = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  points = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+  run('cache only', None, metrics, points)
+  for fsync in ('never', 'segment', 'commit'):
+    run('wal fsync=%s' % fsync, fsync, metrics, points)
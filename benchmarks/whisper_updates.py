@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Compares the ways the writer can apply update_many() to whisper files:
+stock whisper.update_many(), files kept open (WRITER_OPEN_FILES) and
+memory-mapped files (WHISPER_MMAP).
+
+usage: whisper_updates.py [files] [rounds]
+
+A synthetic tree of whisper files is created in a temporary directory and
+each round updates every file with a few datapoints, the way a writer pass
+flushes hot metrics. Syscalls are the read and write calls counted in
+/proc/self/io, seeks, opens and closes come on top for the stock path.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from os.path import dirname, join, abspath
+
+LIB_DIR = join(dirname(dirname(abspath(__file__))), 'lib')
+sys.path.insert(0, LIB_DIR)
+
+import whisper
+from carbon.whisperfiles import OpenFileCache
+
+
+def syscalls():
+  counts = dict(line.split(': ') for line in open('/proc/self/io').read().splitlines())
+  return int(counts['syscr']) + int(counts['syscw'])
+
+
+def createTree(root, fileCount):
+  paths = []
+  for i in range(fileCount):
+    path = join(root, 'host%d' % (i % 50), 'metric%d.wsp' % i)
+    if not os.path.isdir(dirname(path)):
+      os.makedirs(dirname(path))
+    whisper.create(path, [(10, 8640), (60, 10080), (600, 52560)])
+    paths.append(path)
+  return paths
+
+
+def run(label, update, paths, rounds):
+  now = int(time.time())
+  calls = 0
+  before = syscalls()
+  t = time.time()
+  for r in range(rounds):
+    points = [ (now - 10 * (rounds - r) - i, float(i)) for i in range(3) ]
+    for path in paths:
+      update(path, points)
+      calls += 1
+  elapsed = time.time() - t
+  used = syscalls() - before
+  print "%-12s %8d update_many calls %10.0f calls/sec %6.1f read/write syscalls per call" % (
+    label, calls, calls / elapsed, float(used) / calls)
+
+
+if __name__ == '__main__':
+  fileCount = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+  rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+  root = tempfile.mkdtemp(prefix='carbon-bench-')
+  try:
+    paths = createTree(root, fileCount)
+    run('stock', whisper.update_many, paths, rounds)
+    for label, mapped in (('open-files', False), ('mmap', True)):
+      openFiles = OpenFileCache(fileCount, mapped)
+      run(label, openFiles.updateMany, paths, rounds)
+      openFiles.clear()
+  finally:
+    shutil.rmtree(root)
@@ -39,6 +39,7 @@ from twisted.internet import stdio, reactor, defer
 from twisted.protocols.basic import LineReceiver
 from carbon.routers import ConsistentHashingRouter, RelayRulesRouter
 from carbon.client import CarbonClientManager
+from carbon.conf import settings
 from carbon import log, events
 
 
@@ -50,6 +51,8 @@ option_parser.add_option('--routing', default='consistent-hashing',
   help='Routing method: "consistent-hashing" (default) or "relay"')
 option_parser.add_option('--relayrules', default=default_relayrules,
   help='relay-rules.conf file to use for relay routing')
+option_parser.add_option('--protocol', default='spool',
+  help='How to send: "spool" (default) to SPOOLING_PATH, or "binary" to the destinations\' binary receiver ports')
 
 options, args = option_parser.parse_args()
 
@@ -75,6 +78,14 @@ for arg in args:
     instance = None
   destinations.append( (host, port, instance) )
 
+if options.protocol not in ('spool', 'binary'):
+  print "Invalid --protocol value, must be one of:"
+  print "  spool"
+  print "  binary"
+  raise SystemExit(1)
+
+settings['DESTINATION_PROTOCOL'] = options.protocol
+
 if options.debug:
   log.logToStdout()
   log.setDebugEnabled(True)
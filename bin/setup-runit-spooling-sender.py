@@ -2,7 +2,8 @@
 
 usage = """Makes the directory+files necessary for a particular
 remote for the spooling relay to be setup.  The spooler will
-send to the line protocol port of a remote cache or relay.
+send to the line protocol port of a remote cache or relay, or
+with the zlib-line spool format to its compressed line port.
 
 Performs setup with runit.
 
@@ -16,6 +17,8 @@ owner       - the user to run as
 group       - the group to run as
 parallelism - the max number of subprocesses to use when sending (10 recommended)
 timeout     - the timeout before a sending process should be killed
+spool_format - optional, the relay's SPOOL_FORMAT: json (the default) or
+              zlib-line, which is sent to COMPRESSED_LINE_RECEIVER_PORT
 
 Example:
 
@@ -52,6 +55,13 @@ import errno
 import pwd
 
 
+# The queue-runner program that sends each SPOOL_FORMAT's files
+SENDERS = {
+    'json': 'json-lineproto-socket-sender.py',
+    'zlib-line': 'zlib-socket-sender.py',
+}
+
+
 def mkdir_p(path, owner=None, group=None, perms=None, verbose=True):
     default_dir_perms = stat.S_IWUSR|stat.S_IXUSR|stat.S_IRUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH
     try:
@@ -100,9 +110,13 @@ def make_runit_dir(runit_dir, dirname, owner, runit_run, runit_log_run):
 
 
 def main(argv=sys.argv[:]):
-    if len(argv) < 9:
+    if len(argv) < 10 or len(argv) > 11:
         print(usage)
         sys.exit(2)
+    spool_format = argv[10] if len(argv) > 10 else 'json'
+    if spool_format not in SENDERS:
+        print("spool_format must be one of: {0}".format(", ".join(sorted(SENDERS))))
+        sys.exit(2)
     hostandport = "{0}:{1}".format(argv[1], argv[2])
     spool_path  = argv[3]
     runit_dir   = argv[4]
@@ -124,12 +138,13 @@ export PATH
 exec 2>&1
 exec chpst -u {0}:{1} -- \
     /opt/graphite/bin/queue-runner.py \
-    json-lineproto-socket-sender.py \
+    {8} \
     {2} \
     {3} \
     {4}/send/{5} \
     {6} \
-    {7}""".format(owner, group, argv[1], argv[2], spool_path, hostandport, parallelism, timeout)
+    {7}""".format(owner, group, argv[1], argv[2], spool_path, hostandport, parallelism, timeout,
+               SENDERS[spool_format])
     runit_log_run = """#!/bin/sh
 exec svlogd -ttt {0}/carbon-sender-{1}
     """.format(log_dir, hostandport)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""This will send a spool file written with SPOOL_FORMAT = zlib-line,
+which already holds a zlib compressed stream of line protocol metrics,
+to the destination's COMPRESSED_LINE_RECEIVER_PORT as it is.  Nothing
+is parsed or re-encoded on the way, the file is only decompressed
+alongside to count the metrics sent.
+
+Usage:
+zlib-socket-sender.py <host> <port> <filename>
+
+This will write instrumentation data back to fd 0 in the form of:
+<number of metrics>,<number of bytes>,<time taken to send>
+
+"""
+
+import os
+import sys
+import time
+import zlib
+import socket
+
+CHUNK_SIZE = 256 * 1024
+
+def main():
+    fname   = sys.argv[3]
+    size    = os.path.getsize(fname)
+    timeout = 60
+
+    if size == 0:
+        os.unlink(fname)
+        sys.exit(1) # 1 will mean no data
+
+    try:
+        conn = socket.create_connection((sys.argv[1], sys.argv[2],), timeout)
+    except Exception as e:
+        print "ERROR: Trying to connect to the remote: {0}:{1}".format(sys.argv[1], sys.argv[2])
+        print "ERROR: message is {0}".format(str(e))
+        print "ERROR: exiting."
+        sys.exit(100)
+
+    f            = open(fname, 'rb')
+    start_time   = time.time()
+    metric_count = 0
+    decompressor = zlib.decompressobj()
+
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+
+        try:
+            conn.sendall(chunk)
+        except Exception as another_error:
+            print "ERROR: Some other error trying to send {0}".format(fname)
+            print "ERROR: the message is: {0}".format(str(another_error))
+            print "ERROR: exiting."
+            sys.exit(100)
+
+        if decompressor:
+            try:
+                metric_count += decompressor.decompress(chunk).count("\n")
+            except zlib.error as ze:
+                print "ERROR: {0} is not a zlib stream, the remote will drop it".format(fname)
+                print "ERROR: the message is {0}".format(str(ze))
+                decompressor = None
+
+    conn.close()
+    end_time           = time.time()
+    time_taken         = end_time - start_time
+    bytes_per_second   = float(size) / float(time_taken)
+    metrics_per_second = float(metric_count) / float(time_taken)
+
+    # if called from the command line, this may fail.  If called from
+    # queue-runner.py, this should succeed.
+    try:
+        os.write(0, "{0:.2f},{1:.2f},{2:.6f}".format(
+            float(metric_count), float(size), float(time_taken)))
+    except OSError:
+        print("INFO: {0} sent {1} bytes for {2} metrics in {3} second(s) ({4} bytes/second, {5} metrics/second) from {6}".format(
+            os.path.basename(sys.argv[0]), size, metric_count, time_taken, bytes_per_second, metrics_per_second, fname))
+
+    os.unlink(sys.argv[3])
+
+if __name__ == '__main__':
+    main()
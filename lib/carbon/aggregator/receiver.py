@@ -2,12 +2,37 @@ from carbon.instrumentation import increment
 from carbon.aggregator.rules import RuleManager
 from carbon.aggregator.buffers import BufferManager
 from carbon.rewrite import RewriteRuleManager
-from carbon import events
+from carbon import events, log
 
 
 def process(metric, datapoint):
-  increment('datapointsReceived')
+  processMany([ (metric, datapoint) ])
 
+
+def processMany(datapoints):
+  """metricsReceived handler. Whatever is not aggregated away is passed on
+  in a single metricsGenerated batch. A datapoint that fails to be processed
+  is logged and skipped."""
+  increment('datapointsReceived', len(datapoints))
+  generated = []
+
+  for metric, datapoint in datapoints:
+    try:
+      metric = aggregate(metric, datapoint)
+    except:
+      log.err(None, "Exception processing %s: datapoint=%s" % (metric, datapoint))
+      continue
+
+    if metric is not None:
+      generated.append( (metric, datapoint) )
+
+  if generated:
+    events.metricsGenerated(generated)
+
+
+def aggregate(metric, datapoint):
+  """Feeds a datapoint to the buffers of the rules it matches. Returns the
+  rewritten metric to pass it on as, or None if it is aggregated away."""
   for rule in RewriteRuleManager.preRules:
     metric = rule.apply(metric)
 
@@ -31,5 +56,6 @@ def process(metric, datapoint):
   for rule in RewriteRuleManager.postRules:
     metric = rule.apply(metric)
 
-  if metric not in aggregate_metrics:
-    events.metricGenerated(metric, datapoint)
+  if metric in aggregate_metrics:
+    return None
+  return metric
@@ -109,6 +109,7 @@ class AMQPGraphiteProtocol(AMQClient):
             log.listener("Message received: %s" % (message,))
 
         metric = message.routing_key
+        datapoints = []
 
         for line in message.content.body.split("\n"):
             line = line.strip()
@@ -124,12 +125,15 @@ class AMQPGraphiteProtocol(AMQClient):
                 log.listener("invalid message line: %s" % (line,))
                 continue
 
-            events.metricReceived(metric, datapoint)
+            datapoints.append((metric, datapoint))
 
             if self.factory.verbose:
                 log.listener("Metric posted: %s %s %s" %
                              (metric, value, timestamp,))
 
+        if datapoints:
+            events.metricsReceived(datapoints)
+
 
 class AMQPReconnectingFactory(ReconnectingClientFactory):
     """The reconnecting factory.
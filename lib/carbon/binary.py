@@ -0,0 +1,148 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The binary metrics protocol. A connection carries a stream of messages,
+each framed by a 32 bit length like the pickle protocol's. Both ends keep a
+table of the metric names sent over the connection so far, and a datapoint
+refers to its metric by its position in that table. A message is, all in
+network byte order:
+
+  flags        uint8    bit 0 set: empty the name table first
+  name count   uint32   names added to the table by this message
+  point count  uint32
+  names        uint16 length and the bytes of each name, in table order
+  metric ids   uint32 per datapoint
+  timestamps   double per datapoint
+  values       double per datapoint
+
+Only the first message a metric appears in carries its name. The columns
+of fixed size datapoint fields are decoded in one go each, without any
+parsing or unpickling per datapoint."""
+
+import sys
+import struct
+from array import array
+
+
+RESET_NAMES = 0x01
+
+HEADER = struct.Struct('!BII')
+NAME_LENGTH = struct.Struct('!H')
+POINT_SIZE = 4 + 8 + 8
+
+# The array typecode of the 4 byte metric ids, which is 'I' on every
+# platform carbon runs on but is only guaranteed to be at least 2 bytes
+for METRIC_ID in ('I', 'L'):
+  if array(METRIC_ID).itemsize == 4:
+    break
+else:
+  raise ImportError("No array typecode of 4 bytes for the binary protocol's metric ids")
+if array('d').itemsize != 8:
+  raise ImportError("The binary protocol needs doubles of 8 bytes")
+
+
+class NameTableEncoder(object):
+  """Encodes lists of (metric, datapoint) for one connection. Once the
+  table would grow past maxNames it is started over, which the next
+  message tells the receiving end to do too. A single message cannot hold
+  more than maxNames different metrics."""
+  def __init__(self, maxNames):
+    self.maxNames = maxNames
+    self.ids = {}  # { metric : position in the name table }
+
+  def encode(self, datapoints):
+    ids = self.ids
+    flags = 0
+    metrics = [ metric for (metric, datapoint) in datapoints ]
+    if len(ids) + len(metrics) > self.maxNames:
+      newMetrics = [ metric for metric in set(metrics) if metric not in ids ]
+      if len(ids) + len(newMetrics) > self.maxNames:
+        ids.clear()
+        flags |= RESET_NAMES
+
+    names = []
+    for metric in metrics:
+      if metric not in ids:
+        ids[metric] = len(ids)
+        if isinstance(metric, unicode):
+          metric = metric.encode('utf-8')
+        names.append(NAME_LENGTH.pack(len(metric)))
+        names.append(metric)
+
+    metricIds = array(METRIC_ID, map(ids.__getitem__, metrics))
+    timestamps = array('d', [ datapoint[0] for (metric, datapoint) in datapoints ])
+    values = array('d', [ datapoint[1] for (metric, datapoint) in datapoints ])
+    if sys.byteorder == 'little':
+      metricIds.byteswap()
+      timestamps.byteswap()
+      values.byteswap()
+
+    return ''.join([ HEADER.pack(flags, len(names) // 2, len(metrics)) ] + names +
+                   [ metricIds.tostring(), timestamps.tostring(), values.tostring() ])
+
+
+class NameTableDecoder(object):
+  """Decodes the messages of one connection into lists of (metric,
+  datapoint). Raises ValueError for a malformed message, after which the
+  name table can no longer be trusted and the connection should be
+  dropped."""
+  def __init__(self, maxNames):
+    self.maxNames = maxNames
+    self.names = []
+
+  def decode(self, data):
+    try:
+      flags, nameCount, pointCount = HEADER.unpack_from(data)
+    except struct.error:
+      raise ValueError("Truncated message header")
+    if flags & RESET_NAMES:
+      self.names = []
+    names = self.names
+    if len(names) + nameCount > self.maxNames:
+      raise ValueError("More than %d metric names on one connection" % self.maxNames)
+
+    offset = HEADER.size
+    try:
+      for i in xrange(nameCount):
+        (length,) = NAME_LENGTH.unpack_from(data, offset)
+        offset += NAME_LENGTH.size
+        name = data[offset:offset + length]
+        if not name or len(name) != length:
+          raise ValueError("Empty or truncated metric name")
+        names.append(name)
+        offset += length
+    except struct.error:
+      raise ValueError("Truncated metric name")
+
+    if len(data) - offset != pointCount * POINT_SIZE:
+      raise ValueError("Message holds %d bytes of datapoints, expected %d" %
+                       (len(data) - offset, pointCount * POINT_SIZE))
+    metricIds = array(METRIC_ID)
+    metricIds.fromstring(data[offset:offset + pointCount * 4])
+    offset += pointCount * 4
+    timestamps = array('d')
+    timestamps.fromstring(data[offset:offset + pointCount * 8])
+    offset += pointCount * 8
+    values = array('d')
+    values.fromstring(data[offset:])
+    if sys.byteorder == 'little':
+      metricIds.byteswap()
+      timestamps.byteswap()
+      values.byteswap()
+
+    try:
+      metrics = map(names.__getitem__, metricIds)
+    except IndexError:
+      raise ValueError("Datapoint for a metric id that was never named")
+    return zip(metrics, zip(timestamps, values))
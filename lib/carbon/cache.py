@@ -12,49 +12,471 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
+import sys
+import time
+from array import array
+from heapq import heappush, heappop
 from threading import Lock
 from carbon.conf import settings
 
 
-class MetricCache(dict):
+def unpackDatapoints(queue):
+  "Turns an interleaved [ts, value, ts, value, ...] buffer into datapoint tuples"
+  return zip(queue[::2], queue[1::2])
+
+
+def encodeDatapoints(queue):
+  "Packs an interleaved [ts, value, ...] buffer as big-endian doubles"
+  if sys.byteorder == 'little':
+    queue = array('d', queue)
+    queue.byteswap()
+  return queue.tostring()
+
+
+def decodeDatapoints(data):
+  "Turns what encodeDatapoints() packed back into datapoint tuples"
+  queue = array('d')
+  queue.fromstring(data)
+  if sys.byteorder == 'little':
+    queue.byteswap()
+  return unpackDatapoints(queue)
+
+
+class MetricCacheShard(dict):
+  """One slice of the MetricCache. Each shard has its own lock and size
+  counter so that the reactor thread storing into one shard never waits on
+  a writer thread working through another.
+
+  A metric's queue is a single array('d') of interleaved timestamps and
+  values, which costs 16 bytes per datapoint instead of a tuple and two
+  float objects. Datapoint tuples are only built when the queue is read.
+
+  The time each queue was started is kept alongside it, in a heap, so the
+  age of the oldest unwritten datapoint is always at hand.
+
+  A metric can be parked while its whisper file is being created. Its
+  datapoints stay in the shard and keep accumulating, but it is left out of
+  the write order until it is unparked. It keeps its arrival time."""
   def __init__(self):
     self.size = 0
     self.lock = Lock()
+    self.arrivals = {}  # { metric : time its queue was started }
+    self.arrivalOrder = []  # heap of (time, metric), stale entries skipped lazily
+    self.parked = set()
+    self.parkedArrivals = {}
 
   def __setitem__(self, key, value):
     raise TypeError("Use store() method instead!")
 
+  def _newQueue(self, metric):
+    queue = array('d')
+    dict.__setitem__(self, metric, queue)
+    now = time.time()
+    self.arrivals[metric] = now
+    heappush(self.arrivalOrder, (now, metric))
+    return queue
+
   def store(self, metric, datapoint):
     try:
       self.lock.acquire()
-      self.setdefault(metric, []).append(datapoint)
-      self.size += 1
+      self._store(metric, datapoint)
     finally:
       self.lock.release()
 
-    if self.isFull():
-      log.msg("MetricCache is full: self.size=%d" % self.size)
-      state.events.cacheFull()
+  def storeMany(self, datapoints):
+    "Stores a list of (metric, datapoint) taking the lock once"
+    try:
+      self.lock.acquire()
+      for (metric, datapoint) in datapoints:
+        self._store(metric, datapoint)
+    finally:
+      self.lock.release()
 
-  def isFull(self):
-    return self.size >= settings.MAX_CACHE_SIZE
+  def _store(self, metric, datapoint):
+    "Appends one datapoint, the lock must be held"
+    try:
+      queue = dict.__getitem__(self, metric)
+    except KeyError:
+      queue = self._newQueue(metric)
+    queue.extend(datapoint)
+    self.size += 1
+
+  def storeQueue(self, metric, values):
+    "Appends an interleaved [ts, value, ...] array to a metric's queue at once"
+    try:
+      self.lock.acquire()
+      try:
+        queue = dict.__getitem__(self, metric)
+      except KeyError:
+        queue = self._newQueue(metric)
+      indexed = metric not in self.parked
+      if indexed and queue:
+        self._unindex(metric, len(queue) // 2)
+      queue.extend(values)
+      self.size += len(values) // 2
+      if indexed:
+        self._index(metric, len(queue) // 2)
+    finally:
+      self.lock.release()
+
+  def popQueue(self, metric):
+    "Removes a metric and returns its queue as the interleaved array"
+    try:
+      self.lock.acquire()
+      queue = dict.pop(self, metric)
+      self.arrivals.pop(metric, None)
+      self.parked.discard(metric)
+      self.parkedArrivals.pop(metric, None)
+      self.size -= len(queue) // 2
+    finally:
+      self.lock.release()
+    return queue
 
   def pop(self, metric):
+    return unpackDatapoints(self.popQueue(metric))
+
+  def _index(self, metric, queueSize):
+    "Hook for shards that index their queues for the write order"
+
+  def _unindex(self, metric, queueSize):
+    "Hook for shards that index their queues for the write order"
+
+  def park(self, metric):
+    "Takes a queued metric out of the write order, returns False if it can't be"
+    try:
+      self.lock.acquire()
+      queue = dict.get(self, metric)
+      if queue is None or metric in self.parked:
+        return False
+      self.parked.add(metric)
+      self.parkedArrivals[metric] = self.arrivals.pop(metric)
+      self._unindex(metric, len(queue) // 2)
+      return True
+    finally:
+      self.lock.release()
+
+  def unpark(self, metric):
+    "Puts a parked metric back into the write order, with every datapoint it gathered"
+    try:
+      self.lock.acquire()
+      if metric not in self.parked:
+        return
+      self.parked.discard(metric)
+      arrival = self.parkedArrivals.pop(metric)
+      queue = dict.get(self, metric)
+      if queue is not None:
+        self.arrivals[metric] = arrival
+        heappush(self.arrivalOrder, (arrival, metric))
+        self._index(metric, len(queue) // 2)
+    finally:
+      self.lock.release()
+
+  def oldestQueue(self):
+    "Returns (arrivalTime, metric) for the longest waiting queue, or None"
+    try:
+      self.lock.acquire()
+      while self.arrivalOrder:
+        arrival, metric = self.arrivalOrder[0]
+        if self.arrivals.get(metric) == arrival:
+          return (arrival, metric)
+        heappop(self.arrivalOrder)  # written out since it was queued
+      return None
+    finally:
+      self.lock.release()
+
+  def oldestArrival(self):
+    "Time the oldest queue still in this shard, parked or not, was started"
+    oldest = self.oldestQueue()
+    if oldest is None:
+      arrival = None
+    else:
+      arrival = oldest[0]
+    try:
+      self.lock.acquire()
+      if self.parkedArrivals:
+        oldestParked = min(self.parkedArrivals.itervalues())
+        if arrival is None or oldestParked < arrival:
+          arrival = oldestParked
+    finally:
+      self.lock.release()
+    return arrival
+
+  def getDatapoints(self, metric):
+    queue = dict.get(self, metric)
+    if queue is None:
+      return None
+    return unpackDatapoints(queue)
+
+  def getRanges(self, metrics, fromTime, untilTime):
+    """Copies the queued datapoints of each metric with fromTime <= timestamp
+    <= untilTime into an interleaved array, for the metrics that have any"""
+    ranges = {}
     try:
       self.lock.acquire()
-      datapoints = dict.pop(self, metric)
-      self.size -= len(datapoints)
-      return datapoints
+      for metric in metrics:
+        queue = dict.get(self, metric)
+        if not queue:
+          continue
+        selected = array('d')
+        for i in xrange(0, len(queue), 2):
+          if fromTime <= queue[i] <= untilTime:
+            selected.append(queue[i])
+            selected.append(queue[i + 1])
+        if selected:
+          ranges[metric] = selected
     finally:
       self.lock.release()
+    return ranges
 
   def counts(self):
     try:
       self.lock.acquire()
-      return [ (metric, len(datapoints)) for (metric, datapoints) in self.items() ]
+      return [ (metric, len(queue) // 2) for (metric, queue) in self.items() ]
     finally:
       self.lock.release()
 
+  def writeOrder(self):
+    "Generates this shard's metrics, largest queue first, from a sorted snapshot"
+    metrics = self.counts()
+
+    t = time.time()
+    metrics.sort(key=lambda item: item[1], reverse=True)  # by queue size, descending
+    log.debug("Sorted %d cache queues in %.6f seconds" % (len(metrics),
+                                                          time.time() - t))
+    for metric, queueSize in metrics:
+      if metric not in self.parked:
+        yield metric
+
+
+class MaxQueueCacheShard(MetricCacheShard):
+  """A shard that keeps its metrics bucketed by queue size as datapoints
+  arrive, so the largest queue can be found without sorting the shard."""
+  def __init__(self):
+    MetricCacheShard.__init__(self)
+    self.buckets = {}  # { queueSize : set(metrics) }
+    self.largest = 0
+
+  def _index(self, metric, queueSize):
+    try:
+      self.buckets[queueSize].add(metric)
+    except KeyError:
+      self.buckets[queueSize] = set([metric])
+    if queueSize > self.largest:
+      self.largest = queueSize
+
+  def _unindex(self, metric, queueSize):
+    bucket = self.buckets[queueSize]
+    bucket.discard(metric)
+    if not bucket:
+      del self.buckets[queueSize]
+
+  def _store(self, metric, datapoint):
+    try:
+      queue = dict.__getitem__(self, metric)
+    except KeyError:
+      queue = self._newQueue(metric)
+      queueSize = 0
+    else:
+      queueSize = len(queue) // 2
+      if metric in self.parked:
+        queue.extend(datapoint)
+        self.size += 1
+        return
+      self._unindex(metric, queueSize)
+    queue.extend(datapoint)
+    self.size += 1
+    self._index(metric, queueSize + 1)
+
+  def popQueue(self, metric):
+    try:
+      self.lock.acquire()
+      queue = dict.pop(self, metric)
+      self.arrivals.pop(metric, None)
+      queueSize = len(queue) // 2
+      if metric in self.parked:
+        self.parked.discard(metric)
+        self.parkedArrivals.pop(metric, None)
+      else:
+        self._unindex(metric, queueSize)
+      self.size -= queueSize
+    finally:
+      self.lock.release()
+    return queue
+
+  def largestQueue(self):
+    "Returns the metric with the most queued datapoints, or None when empty"
+    try:
+      self.lock.acquire()
+      # Every step down was paid for by a store() that stepped up
+      while self.largest and self.largest not in self.buckets:
+        self.largest -= 1
+      if not self.largest:
+        return None
+      for metric in self.buckets[self.largest]:
+        return metric
+    finally:
+      self.lock.release()
+
+  def writeOrder(self):
+    """Generates the current largest queue each time a metric is requested.
+    A pass is bounded by the number of queues in the shard when it started
+    so a busy shard cannot keep the writer from moving on."""
+    for i in xrange(len(self)):
+      metric = self.largestQueue()
+      if metric is None:
+        return
+      yield metric
+
+
+class BoundedLatencyCacheShard(MaxQueueCacheShard):
+  """A shard that writes any queue older than MAX_WRITE_LATENCY seconds
+  first, oldest first, and otherwise falls back to the largest queue. This
+  keeps rarely reporting metrics from waiting out a whole drain cycle."""
+  def overdueQueue(self):
+    oldest = self.oldestQueue()
+    if oldest is not None:
+      arrival, metric = oldest
+      if time.time() - arrival >= settings.MAX_WRITE_LATENCY:
+        return metric
+    return None
+
+  def writeOrder(self):
+    for i in xrange(len(self)):
+      metric = self.overdueQueue() or self.largestQueue()
+      if metric is None:
+        return
+      yield metric
+
+
+WRITE_STRATEGIES = {
+  'sorted' : MetricCacheShard,
+  'max' : MaxQueueCacheShard,
+  'bounded-latency' : BoundedLatencyCacheShard,
+}
+
+
+class MetricCache(object):
+  """Datapoints waiting to be written, spread over a fixed number of
+  independently locked shards keyed by a hash of the metric name."""
+  def __init__(self, shardCount=settings.CACHE_SHARDS,
+               writeStrategy=settings.CACHE_WRITE_STRATEGY):
+    self.shardClass = None
+    self.setWriteStrategy(writeStrategy)
+    self.setShardCount(shardCount)
+
+  def setShardCount(self, shardCount):
+    "Re-shard the cache, this must happen before any datapoint is stored"
+    if hasattr(self, 'shards') and self:
+      raise Exception("Cannot re-shard a MetricCache that holds datapoints")
+    self.shardCount = max(1, int(shardCount))
+    self.shards = tuple( self.shardClass() for i in range(self.shardCount) )
+
+  def setWriteStrategy(self, writeStrategy):
+    """Selects the order in which the writer drains each shard, see
+    CACHE_WRITE_STRATEGY in carbon.conf"""
+    if writeStrategy not in WRITE_STRATEGIES:
+      raise Exception("Invalid CACHE_WRITE_STRATEGY \"%s\", must be one of: %s" %
+                      (writeStrategy, ', '.join(sorted(WRITE_STRATEGIES))))
+    shardClass = WRITE_STRATEGIES[writeStrategy]
+    if shardClass is not self.shardClass:
+      self.shardClass = shardClass
+      if hasattr(self, 'shards'):
+        self.setShardCount(self.shardCount)
+
+  def getShard(self, metric):
+    return self.shards[hash(metric) % self.shardCount]
+
+  @property
+  def size(self):
+    return sum([shard.size for shard in self.shards])
+
+  def __len__(self):
+    return sum([len(shard) for shard in self.shards])
+
+  def __nonzero__(self):
+    for shard in self.shards:
+      if shard:
+        return True
+    return False
+
+  def __contains__(self, metric):
+    return metric in self.getShard(metric)
+
+  def get(self, metric, default=None):
+    datapoints = self.getShard(metric).getDatapoints(metric)
+    if datapoints is None:
+      return default
+    return datapoints
+
+  def getRanges(self, metrics, fromTime=None, untilTime=None):
+    """Returns { metric : interleaved array } of the datapoints queued for
+    the given metrics between fromTime and untilTime, both inclusive and
+    unbounded when None. Each shard is locked once for all of its metrics."""
+    if fromTime is None:
+      fromTime = float('-inf')
+    if untilTime is None:
+      untilTime = float('inf')
+    metricsByShard = [ [] for shard in self.shards ]
+    for metric in metrics:
+      metricsByShard[hash(metric) % self.shardCount].append(metric)
+
+    ranges = {}
+    for shard, shardMetrics in zip(self.shards, metricsByShard):
+      if shardMetrics:
+        ranges.update( shard.getRanges(shardMetrics, fromTime, untilTime) )
+    return ranges
+
+  def store(self, metric, datapoint):
+    self.getShard(metric).store(metric, datapoint)
+
+    if self.isFull():
+      log.msg("MetricCache is full: self.size=%d" % self.size)
+      state.events.cacheFull()
+
+  def storeMany(self, datapoints):
+    """metricsReceived handler, stores a list of (metric, datapoint) locking
+    each shard once and checking for a full cache once"""
+    shardCount = self.shardCount
+    if shardCount == 1:
+      self.shards[0].storeMany(datapoints)
+    else:
+      datapointsByShard = [ [] for shard in self.shards ]
+      for datapoint in datapoints:
+        datapointsByShard[hash(datapoint[0]) % shardCount].append(datapoint)
+      for shard, shardDatapoints in zip(self.shards, datapointsByShard):
+        if shardDatapoints:
+          shard.storeMany(shardDatapoints)
+
+    if self.isFull():
+      log.msg("MetricCache is full: self.size=%d" % self.size)
+      state.events.cacheFull()
+
+  def isFull(self):
+    # Summing the shard sizes on every store is wasted work when unbounded
+    if settings.MAX_CACHE_SIZE == float('inf'):
+      return False
+    return self.size >= settings.MAX_CACHE_SIZE
+
+  def pop(self, metric):
+    return self.getShard(metric).pop(metric)
+
+  def oldestAge(self):
+    "Seconds the oldest unwritten datapoint in any shard has been waiting"
+    arrivals = [ oldest[0] for oldest in
+                 [ shard.oldestQueue() for shard in self.shards ]
+                 if oldest is not None ]
+    if not arrivals:
+      return 0.0
+    return time.time() - min(arrivals)
+
+  def counts(self):
+    """Queue sizes for every cached metric. Each shard is only locked while
+    its own counts are collected."""
+    counts = []
+    for shard in self.shards:
+      counts.extend( shard.counts() )
+    return counts
+
 
 # Ghetto singleton
 MetricCache = MetricCache()
@@ -5,16 +5,15 @@ from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.protocols.basic import Int32StringReceiver
 from carbon.conf import settings
 from carbon.util import pickle
+from carbon.binary import NameTableEncoder
 from carbon import log, state, instrumentation
 from collections import deque
 from time import time
 import json
+import zlib
 import os
 
 
-SEND_QUEUE_LOW_WATERMARK = settings.MAX_QUEUE_SIZE * settings.QUEUE_LOW_WATERMARK_PCT
-
-
 class SpoolingCarbonClientProtocol(Int32StringReceiver):
   def connectionMade(self):
     log.clients("%s::connectionMade" % self)
@@ -23,6 +22,8 @@ class SpoolingCarbonClientProtocol(Int32StringReceiver):
     self.transport.registerProducer(self, streaming=True)
     # Define internal metric names
     self.lastResetTime = time()
+    if not self.factory.spooling:
+      self.encoder = NameTableEncoder(settings.BINARY_MAX_NAMES)
 
     self.factory.connectionMade.callback(self)
     self.factory.connectionMade = Deferred()
@@ -38,7 +39,7 @@ class SpoolingCarbonClientProtocol(Int32StringReceiver):
 
   def pauseProducing(self):
     """XXX self.paused should be ignored for the purposes of writing to the spool."""
-    self.paused = False
+    self.paused = not self.factory.spooling
 
   def resumeProducing(self):
     self.paused = False
@@ -65,9 +66,14 @@ class SpoolingCarbonClientProtocol(Int32StringReceiver):
       The format of the file is repr, so we'll eval the file, line by line
       and send the file.  Should be cheaper and easier than using multiple
       pickles.
+
+      With DESTINATION_PROTOCOL = binary the datapoints are sent over
+      the connection as a binary protocol message instead.
       """
-      # self.sendString(pickle.dumps(datapoints, protocol=-1))
-      self.factory.queue_file.write(json.dumps(datapoints) + "\n")
+      if self.factory.spooling:
+        self.factory.spool(datapoints)
+      else:
+        self.sendString(self.encoder.encode(datapoints))
       # XXX Change "sent" to "written"?
       instrumentation.increment(self.factory.sent, len(datapoints))
       instrumentation.increment(self.factory.batchesSent)
@@ -95,12 +101,15 @@ class SpoolingCarbonClientProtocol(Int32StringReceiver):
     if not self.factory.hasQueuedDatapoints():
       return
 
-    if time() >= self.factory.next_flush_time:
-        self.factory.set_next_flush_time()
-        self.factory.open_next_queue_file()
+    if self.factory.spooling:
+      if time() >= self.factory.next_flush_time:
+          self.factory.set_next_flush_time()
+          self.factory.open_next_queue_file()
+    elif self.paused or not self.connected:
+      return  # resumeProducing() and connectionMade() pick up from here
     self._sendDatapoints(self.factory.takeSomeFromQueue())
     if (self.factory.queueFull.called and
-        queueSize < SEND_QUEUE_LOW_WATERMARK):
+        queueSize < self.factory.queueLowWatermark):
       self.factory.queueHasSpace.callback(queueSize)
     if self.factory.hasQueuedDatapoints():
       reactor.callLater(chained_invocation_delay, self.sendQueued)
@@ -113,7 +122,7 @@ class SpoolingCarbonClientProtocol(Int32StringReceiver):
 class SpoolingCarbonClientFactory(ReconnectingClientFactory):
   maxDelay = 5
 
-  def __init__(self, destination):
+  def __init__(self, destination, destinationProtocol=None, maxQueueSize=None):
     self.destination = destination
     self.destinationName = ('%s:%d:%s' % destination).replace('.', '_')
     self.host, self.port, self.carbon_instance = destination
@@ -146,7 +155,20 @@ class SpoolingCarbonClientFactory(ReconnectingClientFactory):
         settings.SPOOLING_PATH, self.host, self.port)
     self.queue_file_prefix = "{0}/send".format(self.send_queue_dir)
     self.queue_file = None
-    self.open_next_queue_file()
+    self.queue_compressor = None
+    if settings.SPOOL_FORMAT not in ('json', 'zlib-line'):
+      raise Exception("Invalid SPOOL_FORMAT \"%s\", must be json or zlib-line" %
+                      settings.SPOOL_FORMAT)
+    if destinationProtocol is None:
+      destinationProtocol = settings.DESTINATION_PROTOCOL
+    if destinationProtocol not in ('spool', 'binary'):
+      raise Exception("Invalid DESTINATION_PROTOCOL \"%s\", must be spool or binary" %
+                      destinationProtocol)
+    self.spooling = destinationProtocol == 'spool'
+    self.maxQueueSize = maxQueueSize or settings.MAX_QUEUE_SIZE
+    self.queueLowWatermark = self.maxQueueSize * settings.QUEUE_LOW_WATERMARK_PCT
+    if self.spooling:
+      self.open_next_queue_file()
     # self.sec_between_flushes = settings.FLUSH_INTERVAL # seconds
 
 
@@ -185,10 +207,12 @@ class SpoolingCarbonClientFactory(ReconnectingClientFactory):
       it if there is data, or remove it if there is no data.
       """
       if self.queue_file:
+          if self.queue_compressor and not self.queue_file_empty:
+              self.queue_file.write(self.queue_compressor.flush())
           size = self.queue_file.tell() # should be at the end of the file
           self.queue_file.close()
           fname = os.path.basename(self.queue_file_name)
-          new_name = "{0}/{1}.json".format(self.send_queue_dir, fname)
+          new_name = "{0}/{1}.{2}".format(self.send_queue_dir, fname, self.queue_file_extension)
           log.clients("{0}::open_next_queue_file new_name is {1}".format(self, new_name))
 
           try:
@@ -202,7 +226,28 @@ class SpoolingCarbonClientFactory(ReconnectingClientFactory):
               pass
 
       self.queue_file_name = "{0}/{1:.2f}".format(self.send_tmp_dir, self.next_flush_time)
+      if settings.get('worker') is not None:
+          # The ingest workers of a relay share its spool directories
+          self.queue_file_name += "-{0}".format(settings.worker)
       self.queue_file = open(self.queue_file_name, 'w')
+      self.queue_file_empty = True
+      if settings.SPOOL_FORMAT == 'zlib-line':
+          self.queue_compressor = zlib.compressobj()
+          self.queue_file_extension = "zline"
+      else:
+          self.queue_file_extension = "json"
+
+  def spool(self, datapoints):
+      """Writes datapoints to the current spool file. A zlib-line file is
+      a zlib stream of plaintext line protocol, which the sender can send
+      as it is to a COMPRESSED_LINE_RECEIVER_PORT."""
+      if self.queue_compressor:
+          lines = ''.join([ "%s %r %r\n" % (metric, value, timestamp)
+                            for (metric, (timestamp, value)) in datapoints ])
+          self.queue_file.write(self.queue_compressor.compress(lines))
+      else:
+          self.queue_file.write(json.dumps(datapoints) + "\n")
+      self.queue_file_empty = False
 
 
   def queueFullCallback(self, result):
@@ -272,18 +317,29 @@ class SpoolingCarbonClientFactory(ReconnectingClientFactory):
     self.queue.appendleft((metric, datapoint))
 
   def sendDatapoint(self, metric, datapoint):
-    instrumentation.increment(self.attemptedRelays)
-    if self.queueSize >= settings.MAX_QUEUE_SIZE:
+    self.sendDatapoints([ (metric, datapoint) ])
+
+  def sendDatapoints(self, datapoints):
+    """Queues a list of (metric, datapoint) for this destination and
+    schedules a single send for all of them. Whatever does not fit in
+    the queue (MAX_QUEUE_SIZE unless the manager was given a size) is
+    dropped."""
+    count = len(datapoints)
+    instrumentation.increment(self.attemptedRelays, count)
+    room = self.maxQueueSize - self.queueSize
+    if count > room:
+      if room > 0:
+        self.queue.extend(datapoints[:int(room)])
       if not self.queueFull.called:
         self.queueFull.callback(self.queueSize)
-      instrumentation.increment(self.fullQueueDrops)
+      instrumentation.increment(self.fullQueueDrops, count - max(0, int(room)))
     else:
-      self.enqueue(metric, datapoint)
+      self.queue.extend(datapoints)
 
     if self.connectedProtocol:
       reactor.callLater(settings.TIME_TO_DEFER_SENDING, self.connectedProtocol.sendQueued)
     else:
-      instrumentation.increment(self.queuedUntilConnected)
+      instrumentation.increment(self.queuedUntilConnected, count)
 
   def sendHighPriorityDatapoint(self, metric, datapoint):
     """The high priority datapoint is one relating to the carbon
@@ -340,8 +396,10 @@ class SpoolingCarbonClientFactory(ReconnectingClientFactory):
 
 
 class CarbonClientManager(Service):
-  def __init__(self, router):
+  def __init__(self, router, destinationProtocol=None, maxQueueSize=None):
     self.router = router
+    self.destinationProtocol = destinationProtocol  # DESTINATION_PROTOCOL unless given
+    self.maxQueueSize = maxQueueSize  # MAX_QUEUE_SIZE unless given
     self.client_factories = {} # { destination : CarbonClientFactory() }
 
   def startService(self):
@@ -360,7 +418,8 @@ class CarbonClientManager(Service):
 
     log.clients("connecting to carbon daemon at %s:%d:%s" % destination)
     self.router.addDestination(destination)
-    factory = self.client_factories[destination] = SpoolingCarbonClientFactory(destination)
+    factory = self.client_factories[destination] = SpoolingCarbonClientFactory(
+        destination, self.destinationProtocol, self.maxQueueSize)
     connectAttempted = DeferredList(
         [factory.connectionMade, factory.connectFailed],
         fireOnOneCallback=True,
@@ -396,6 +455,31 @@ class CarbonClientManager(Service):
     for destination in self.router.getDestinations(metric):
       self.client_factories[destination].sendDatapoint(metric, datapoint)
 
+  def sendDatapoints(self, datapoints):
+    """metricsReceived and metricsGenerated handler, one send per destination.
+    A datapoint that can't be routed, or a destination that fails to take
+    its share, is logged and skipped."""
+    datapointsByDestination = {}
+    for (metric, datapoint) in datapoints:
+      try:
+        destinations = list(self.router.getDestinations(metric))
+      except:
+        log.err(None, "Exception routing %s: datapoint=%s" % (metric, datapoint))
+        continue
+
+      for destination in destinations:
+        try:
+          datapointsByDestination[destination].append( (metric, datapoint) )
+        except KeyError:
+          datapointsByDestination[destination] = [ (metric, datapoint) ]
+
+    for destination, destinationDatapoints in datapointsByDestination.iteritems():
+      try:
+        self.client_factories[destination].sendDatapoints(destinationDatapoints)
+      except:
+        log.err(None, "Exception sending %d datapoints to %s:%d:%s" %
+                ((len(destinationDatapoints),) + destination))
+
   def sendHighPriorityDatapoint(self, metric, datapoint):
     for destination in self.router.getDestinations(metric):
       self.client_factories[destination].sendHighPriorityDatapoint(metric, datapoint)
@@ -30,23 +30,64 @@ from twisted.python import usage
 defaults = dict(
   USER="",
   MAX_CACHE_SIZE=float('inf'),
+  CACHE_SHARDS=16,
+  CACHE_WRITE_STRATEGY='max',
+  MAX_WRITE_LATENCY=300,
   MAX_UPDATES_PER_SECOND=500,
+  UPDATE_BURST_SECONDS=1.0,
+  UPDATE_RATE_UNIT='updates',
+  UPDATE_LATENCY_TARGET=0,
   MAX_CREATES_PER_MINUTE=float('inf'),
+  MAX_PENDING_CREATES=10000,
+  WRITER_THREADS=1,
+  WRITER_PROCESSES=0,
+  WRITER_BATCH_SIZE=100,
+  STORAGE_BACKEND='whisper',
+  CACHE_SNAPSHOT_ON_SHUTDOWN=False,
+  ENABLE_WAL=False,
+  WAL_COMMIT_INTERVAL=0.1,
+  WAL_FSYNC='segment',
+  WAL_SEGMENT_SIZE=64 * 1024 * 1024,
+  WAL_SEGMENT_SECONDS=60,
+  METRIC_RESOLUTION_CACHE_SIZE=500000,
+  INGEST_PROCESSES=0,
+  INGEST_PEER_INTERFACE='127.0.0.1',
+  INGEST_PEER_PORT=2100,
+  INGEST_PEER_QUEUE_SIZE=100000,
   LINE_RECEIVER_INTERFACE='0.0.0.0',
   LINE_RECEIVER_PORT=2003,
   ENABLE_UDP_LISTENER=False,
   UDP_RECEIVER_INTERFACE='0.0.0.0',
   UDP_RECEIVER_PORT=2003,
+  UDP_RECEIVER_BUFFER_SIZE=0,
+  UDP_RECEIVER_SOCKETS=1,
   PICKLE_RECEIVER_INTERFACE='0.0.0.0',
   PICKLE_RECEIVER_PORT=2004,
+  COMPRESSED_LINE_RECEIVER_INTERFACE='0.0.0.0',
+  COMPRESSED_LINE_RECEIVER_PORT=0,
+  COMPRESSED_PICKLE_RECEIVER_INTERFACE='0.0.0.0',
+  COMPRESSED_PICKLE_RECEIVER_PORT=0,
+  BINARY_RECEIVER_INTERFACE='0.0.0.0',
+  BINARY_RECEIVER_PORT=0,
+  BINARY_MAX_NAMES=100000,
   CACHE_QUERY_INTERFACE='0.0.0.0',
   CACHE_QUERY_PORT=7002,
+  MANAGEMENT_THREADS=4,
+  READER_QUERY_INTERFACE='0.0.0.0',
+  READER_QUERY_PORT=7202,
+  READ_CACHE_MAX_POINTS=10000000,
+  READ_CACHE_MAX_IDLE=3600,
+  READ_CACHE_FLUSH_DELAY=120,
   LOG_UPDATES=True,
   LOG_CACHE_HITS = True,
   WHISPER_AUTOFLUSH=False,
+  WHISPER_MMAP=False,
+  WHISPER_MMAP_FLUSH='kernel',
   WHISPER_SPARSE_CREATE=False,
   WHISPER_FALLOCATE_CREATE=False,
   WHISPER_LOCK_WRITES=False,
+  WRITER_OPEN_FILES=0,
+  WHISPER_FILE_RECHECK_INTERVAL=60,
   MAX_DATAPOINTS_PER_MESSAGE=500,
   MAX_AGGREGATION_INTERVALS=5,
   MAX_QUEUE_SIZE=1000,
@@ -75,10 +116,19 @@ defaults = dict(
   USE_RATIO_RESET=False,
   FLUSH_INTERVAL=1.0,
   SPOOLING_PATH="",
+  SPOOL_FORMAT='json',
+  DESTINATION_PROTOCOL='spool',
   QUEUE_SPREAD=4
 )
 
 
+# Limits that protect the host rather than a process, which every ingest
+# worker only gets its share of
+INGEST_WORKER_SHARED_LIMITS = ('MAX_CACHE_SIZE', 'MAX_UPDATES_PER_SECOND',
+                               'MAX_UPDATES_PER_SECOND_ON_SHUTDOWN',
+                               'MAX_CREATES_PER_MINUTE', 'READ_CACHE_MAX_POINTS')
+
+
 def _umask(value):
     return int(value, 8)
 
@@ -177,6 +227,7 @@ class CarbonCacheOptions(usage.Options):
         ["logdir", "", None, "Write logs to the given directory."],
         ["whitelist", "", None, "List of metric patterns to allow."],
         ["blacklist", "", None, "List of metric patterns to disallow."],
+        ["worker", "", None, "Run as the given ingest worker of the instance."],
         ]
 
     def postOptions(self):
@@ -220,6 +271,29 @@ class CarbonCacheOptions(usage.Options):
             log.msg("Enabling Whisper autoflush")
             whisper.AUTOFLUSH = True
 
+        if settings.WRITER_OPEN_FILES and settings.STORAGE_BACKEND == 'whisper':
+            from carbon import whisperfiles
+            if not whisperfiles.SUPPORTED:
+                log.err("The installed whisper is not one WRITER_OPEN_FILES and "
+                        "WHISPER_MMAP support (see requirements.txt), every update "
+                        "will open its file.")
+
+        if settings.WHISPER_MMAP:
+            from carbon.whisperfiles import MMAP_FLUSH_POLICIES
+            if not settings.WRITER_OPEN_FILES:
+                log.err("WHISPER_MMAP is enabled but WRITER_OPEN_FILES is 0, no file will be mapped.")
+            elif settings.WHISPER_MMAP_FLUSH not in MMAP_FLUSH_POLICIES:
+                print "Error: WHISPER_MMAP_FLUSH must be one of: %s" % ", ".join(MMAP_FLUSH_POLICIES)
+                sys.exit(1)
+            else:
+                log.msg("Enabling memory-mapped Whisper updates")
+
+        if settings.ENABLE_WAL:
+            from carbon.wal import FSYNC_POLICIES
+            if settings.WAL_FSYNC not in FSYNC_POLICIES:
+                print "Error: WAL_FSYNC must be one of: %s" % ", ".join(FSYNC_POLICIES)
+                sys.exit(1)
+
         if settings.WHISPER_FALLOCATE_CREATE:
             if whisper.CAN_FALLOCATE:
                 log.msg("Enabling Whisper fallocate support")
@@ -239,11 +313,12 @@ class CarbonCacheOptions(usage.Options):
 
         # If we are not running in debug mode or non-daemon mode, then log to a
         # directory, otherwise log output will go to stdout. If parent options
-        # are set to log to syslog, then use that instead.
+        # are set to log to syslog, then use that instead. Ingest workers run
+        # in the foreground of their supervisor but log to a directory too.
         if not self["debug"]:
             if self.parent.get("syslog", None):
                 log.logToSyslog(self.parent["prefix"])
-            elif not self.parent["nodaemon"]:
+            elif not self.parent["nodaemon"] or self["worker"] is not None:
                 logdir = settings.LOG_DIR
                 if not isdir(logdir):
                     os.makedirs(logdir)
@@ -427,6 +502,10 @@ def get_default_parser(usage="%prog [options] <start|stop|status>"):
         "--instance",
         default='a',
         help="Manage a specific carbon instance")
+    parser.add_option(
+        "--worker",
+        default=None,
+        help="Run as the given ingest worker of the instance (see INGEST_PROCESSES)")
 
     return parser
 
@@ -545,4 +624,31 @@ def read_config(program, options, **kwargs):
             join(settings["PID_DIR"], '%s.pid' % program))
         settings["LOG_DIR"] = (options["logdir"] or settings["LOG_DIR"])
 
+    # Every instance needs a write-ahead log and cache snapshot of its own.
+    if options["instance"]:
+        instance_name = "%s-%s" % (program, options["instance"])
+    else:
+        instance_name = program
+
+    # And so does every ingest worker of an instance, along with a pidfile
+    # and logs. The supervisor keeps the instance's own.
+    try:
+        worker = options["worker"]
+    except KeyError:
+        worker = None
+    if worker is not None:
+        settings["worker"] = int(worker)
+        instance_name = "%s-%d" % (instance_name, settings["worker"])
+        settings["pidfile"] = join(settings["PID_DIR"], "%s.pid" % instance_name)
+        settings["LOG_DIR"] = join(settings["LOG_DIR"], "worker-%d" % settings["worker"])
+        workers = float(max(1, settings["INGEST_PROCESSES"]))
+        for name in INGEST_WORKER_SHARED_LIMITS:
+            if name in settings:
+                settings[name] = settings[name] / workers
+    settings.setdefault(
+        "WAL_DIR", join(settings["STORAGE_DIR"], "wal", instance_name))
+    settings.setdefault(
+        "CACHE_SNAPSHOT_FILE", join(settings["STORAGE_DIR"],
+                                    "%s.snapshot" % instance_name))
+
     return settings
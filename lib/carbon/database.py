@@ -0,0 +1,258 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import os
+import time
+import errno
+import traceback
+from os.path import dirname, exists, join, sep
+
+import whisper
+from carbon.conf import settings
+from carbon.util import pickle
+from carbon.storage import getFilesystemPath, KnownFiles
+from carbon import state, whisperfiles
+
+
+class TimeSeriesDatabase(object):
+  """The storage backend carbon-cache writes to and carbon-reader reads
+  from, see STORAGE_BACKEND in carbon.conf. The writer and management
+  handlers only ever talk to the backend through these methods, and hand
+  over whole batches of metrics wherever they can so a backend is free to
+  write them in one go."""
+  metadataKeys = ()
+
+  def start(self):
+    "Called once from a thread of its own when the writer starts"
+
+  def exists(self, metric):
+    return metric in self.existsMany([metric])
+
+  def existsMany(self, metrics):
+    "Returns the set of the given metrics that have been created"
+    raise NotImplementedError()
+
+  def create(self, metric, archiveConfig, xFilesFactor, aggregationMethod):
+    raise NotImplementedError()
+
+  def write(self, metric, datapoints):
+    raise NotImplementedError()
+
+  def writeMany(self, datapointsByMetric):
+    """Writes { metric : datapoints } and returns { metric : (updateTime, error) },
+    where error is a formatted traceback or None. This runs in writer threads
+    and writer processes alike, so errors are reported rather than logged."""
+    results = {}
+    for metric, datapoints in datapointsByMetric.iteritems():
+      try:
+        t = time.time()
+        self.write(metric, datapoints)
+        results[metric] = (time.time() - t, None)
+      except:
+        results[metric] = (None, traceback.format_exc())
+    return results
+
+  def invalidate(self, metric):
+    "Forgets whatever is known about a metric after a failed write"
+
+  def getArchives(self, metric):
+    "Returns [ (secondsPerPoint, retention), ... ], highest resolution first"
+    raise NotImplementedError()
+
+  def fetch(self, metric, fromTime, untilTime, secondsPerPoint=None):
+    """Returns ((fromInterval, untilInterval, step), values) like whisper.fetch,
+    from the highest resolution archive that reaches back to fromTime. Given
+    secondsPerPoint, from that archive instead, as is without any clamping
+    of the range to its retention."""
+    raise NotImplementedError()
+
+  def getMetadata(self, metric, key):
+    raise NotImplementedError()
+
+  def setMetadata(self, metric, key, value):
+    "Returns the previous value"
+    raise NotImplementedError()
+
+
+class WhisperDatabase(TimeSeriesDatabase):
+  "One whisper file per metric under LOCAL_DATA_DIR"
+  metadataKeys = ('aggregationMethod',)
+
+  def start(self):
+    # An ingest worker only indexes the files of its own slice
+    KnownFiles.scan(settings.LOCAL_DATA_DIR, state.ownsMetric)
+
+  def exists(self, metric):
+    return KnownFiles.exists(getFilesystemPath(metric))
+
+  def existsMany(self, metrics):
+    return set( metric for metric in metrics if self.exists(metric) )
+
+  def create(self, metric, archiveConfig, xFilesFactor, aggregationMethod):
+    dbFilePath = getFilesystemPath(metric)
+    if not exists(dbFilePath):
+      try:
+        os.makedirs(dirname(dbFilePath), 0755)
+      except OSError, e:
+        if e.errno != errno.EEXIST:
+          raise
+      whisper.create(dbFilePath, archiveConfig, xFilesFactor, aggregationMethod,
+                     settings.WHISPER_SPARSE_CREATE, settings.WHISPER_FALLOCATE_CREATE)
+    KnownFiles.add(dbFilePath)
+
+  def write(self, metric, datapoints):
+    if settings.WRITER_OPEN_FILES:
+      whisperfiles.update_many(getFilesystemPath(metric), datapoints)
+    else:
+      whisper.update_many(getFilesystemPath(metric), datapoints)
+
+  def invalidate(self, metric):
+    # The file may have been removed, have the next write check for it
+    KnownFiles.discard(getFilesystemPath(metric))
+
+  def getArchives(self, metric):
+    info = whisper.info(getFilesystemPath(metric))
+    if info is None:  # whisper.info() swallows the IOError
+      raise IOError(errno.ENOENT, "No whisper file for %s" % metric)
+    return [ (archive['secondsPerPoint'], archive['retention']) for archive in info['archives'] ]
+
+  def fetch(self, metric, fromTime, untilTime, secondsPerPoint=None):
+    if secondsPerPoint is None:
+      return whisper.fetch(getFilesystemPath(metric), fromTime, untilTime)
+
+    if not whisperfiles.SUPPORTED:
+      # whisper.fetch() reads the archive fromTime falls in, which has to be
+      # the one asked for
+      timeInfo, values = whisper.fetch(getFilesystemPath(metric), fromTime, untilTime)
+      if timeInfo[2] != secondsPerPoint:
+        raise ValueError("%s has no archive of %d seconds per point covering %d" %
+                         (metric, secondsPerPoint, fromTime))
+      return (timeInfo, values)
+
+    fh = open(getFilesystemPath(metric), 'rb')
+    try:
+      for archive in whisperfiles.readHeader(fh)['archives']:
+        if archive['secondsPerPoint'] == secondsPerPoint:
+          return whisperfiles.archiveFetch(fh, archive, int(fromTime), int(untilTime))
+      raise ValueError("%s has no archive of %d seconds per point" % (metric, secondsPerPoint))
+    finally:
+      fh.close()
+
+  def getMetadata(self, metric, key):
+    return whisper.info(getFilesystemPath(metric))[key]
+
+  def setMetadata(self, metric, key, value):
+    return whisper.setAggregationMethod(getFilesystemPath(metric), value)
+
+
+class AppendOnlyDatabase(TimeSeriesDatabase):
+  """A stand-in backend for trying out carbon without whisper. Datapoints are
+  appended as "timestamp value" lines to a .log file per metric under
+  LOCAL_DATA_DIR, with metadata pickled into a .meta file next to it.
+  Nothing is ever aggregated or expired, fetches always come back at the
+  resolution of the first archive."""
+  metadataKeys = ('archiveConfig', 'xFilesFactor', 'aggregationMethod')
+
+  def getPath(self, metric, extension):
+    return join(settings.LOCAL_DATA_DIR, metric.replace('.', sep) + extension)
+
+  def exists(self, metric):
+    return exists(self.getPath(metric, '.meta'))
+
+  def existsMany(self, metrics):
+    return set( metric for metric in metrics if self.exists(metric) )
+
+  def create(self, metric, archiveConfig, xFilesFactor, aggregationMethod):
+    metaPath = self.getPath(metric, '.meta')
+    try:
+      os.makedirs(dirname(metaPath), 0755)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    open(self.getPath(metric, '.log'), 'a').close()
+    self.writeMetadata(metric, dict(archiveConfig=archiveConfig,
+                                    xFilesFactor=xFilesFactor,
+                                    aggregationMethod=aggregationMethod))
+
+  def write(self, metric, datapoints):
+    lines = [ "%d %r\n" % (timestamp, float(value)) for (timestamp, value) in datapoints ]
+    fh = open(self.getPath(metric, '.log'), 'a')
+    try:
+      fh.write(''.join(lines))
+    finally:
+      fh.close()
+
+  def getArchives(self, metric):
+    archiveConfig = self.readMetadata(metric)['archiveConfig']
+    retention = max( secondsPerPoint * points for (secondsPerPoint, points) in archiveConfig )
+    return [ (archiveConfig[0][0], retention) ]
+
+  def fetch(self, metric, fromTime, untilTime, secondsPerPoint=None):
+    step = self.getArchives(metric)[0][0]
+    fromInterval = int(fromTime - (fromTime % step)) + step
+    untilInterval = int(untilTime - (untilTime % step)) + step
+    values = [None] * ((untilInterval - fromInterval) // step)
+    fh = open(self.getPath(metric, '.log'), 'rb')
+    try:
+      for line in fh:
+        timestamp, value = line.split()
+        interval = int(timestamp) - (int(timestamp) % step)
+        if fromInterval <= interval < untilInterval:
+          values[(interval - fromInterval) // step] = float(value)
+    finally:
+      fh.close()
+    return ((fromInterval, untilInterval, step), values)
+
+  def readMetadata(self, metric):
+    fh = open(self.getPath(metric, '.meta'), 'rb')
+    try:
+      return pickle.load(fh)
+    finally:
+      fh.close()
+
+  def writeMetadata(self, metric, metadata):
+    metaPath = self.getPath(metric, '.meta')
+    fh = open(metaPath + '.tmp', 'wb')
+    try:
+      pickle.dump(metadata, fh, protocol=-1)
+    finally:
+      fh.close()
+    os.rename(metaPath + '.tmp', metaPath)
+
+  def getMetadata(self, metric, key):
+    return self.readMetadata(metric)[key]
+
+  def setMetadata(self, metric, key, value):
+    metadata = self.readMetadata(metric)
+    oldValue = metadata[key]
+    metadata[key] = value
+    self.writeMetadata(metric, metadata)
+    return oldValue
+
+
+BACKENDS = {
+  'whisper' : WhisperDatabase,
+  'append' : AppendOnlyDatabase,
+}
+
+
+def loadDatabase(backend):
+  if backend not in BACKENDS:
+    raise Exception("Invalid STORAGE_BACKEND \"%s\", must be one of: %s" %
+                    (backend, ', '.join(sorted(BACKENDS))))
+  return BACKENDS[backend]()
+
+
+# Ghetto singleton
+database = loadDatabase(settings.STORAGE_BACKEND)
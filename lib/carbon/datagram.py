@@ -0,0 +1,147 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The UDP listener. Every time its socket is readable the port reads all of
+the datagrams waiting, up to maxThroughput bytes, and hands them to the
+protocol together, so they are parsed in one pass and dispatched as one
+batch instead of paying for a reactor callback, a parse and a dispatch
+per datagram. Whatever the kernel had to drop because the socket's
+receive buffer was full is read from /proc/net/udp and recorded."""
+
+import os
+import sys
+import socket
+
+from twisted.application.internet import UDPServer
+from twisted.internet import udp
+from carbon.util import SO_REUSEPORT
+from carbon import log
+
+
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', None)
+if SO_RCVBUFFORCE is None and sys.platform.startswith('linux'):
+  SO_RCVBUFFORCE = 33
+
+# Each line ends with the socket's inode and, since Linux 2.6.27, its drops
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+
+listeningPorts = set()
+
+
+class MetricDatagramPort(udp.Port):
+  """A UDP port for a protocol with a datagramsReceived(datagrams) method.
+  bufferSize sets the socket's receive buffer (SO_RCVBUF), which is what
+  absorbs bursts while the reactor is busy elsewhere, and reusePort lets
+  other sockets, of this process or another, listen on the same port."""
+  def __init__(self, port, proto, interface='', maxPacketSize=8192, reactor=None,
+               bufferSize=0, reusePort=False):
+    udp.Port.__init__(self, port, proto, interface, maxPacketSize, reactor)
+    self.bufferSize = bufferSize
+    self.reusePort = reusePort
+    self.inode = None
+    self.drops = 0  # as of the last kernelDrops()
+
+  def createInternetSocket(self):
+    s = udp.Port.createInternetSocket(self)
+    if self.reusePort:
+      s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    if self.bufferSize:
+      try:
+        # Unlike SO_RCVBUF this goes past net.core.rmem_max, if we are root
+        s.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, self.bufferSize)
+      except (socket.error, TypeError):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.bufferSize)
+      log.listener("UDP receive buffer of %d bytes asked for, the kernel made it %d" %
+                   (self.bufferSize, s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
+    return s
+
+  def startListening(self):
+    udp.Port.startListening(self)
+    self.inode = os.fstat(self.socket.fileno()).st_ino
+    self.drops = 0
+    listeningPorts.add(self)
+
+  def connectionLost(self, reason=None):
+    listeningPorts.discard(self)
+    udp.Port.connectionLost(self, reason)
+
+  def doRead(self):
+    datagrams = []
+    read = 0
+    recv = self.socket.recv
+    maxPacketSize = self.maxPacketSize
+    try:
+      while read < self.maxThroughput:
+        try:
+          data = recv(maxPacketSize)
+        except socket.error, se:
+          if se.args[0] in udp._sockErrReadIgnore or se.args[0] in udp._sockErrReadRefuse:
+            break
+          raise
+        datagrams.append(data)
+        read += len(data)
+    finally:
+      if datagrams:
+        instrumentation.increment('udpDatagrams', len(datagrams))
+        try:
+          self.protocol.datagramsReceived(datagrams)
+        except:
+          log.err()
+
+
+class MetricDatagramServer(UDPServer):
+  "A UDPServer listening on a MetricDatagramPort"
+  def _getPort(self):
+    port = MetricDatagramPort(*self.args, **self.kwargs)
+    port.startListening()
+    return port
+
+
+def readSocketDrops(inodes):
+  "{ inode : drops } of the UDP sockets with these inodes, from /proc/net/udp"
+  drops = {}
+  for path in PROC_NET_UDP:
+    try:
+      procFile = open(path)
+    except IOError:
+      continue
+    try:
+      procFile.readline()  # the column names
+      for line in procFile:
+        fields = line.split()
+        if len(fields) >= 13 and int(fields[9]) in inodes:
+          drops[int(fields[9])] = int(fields[-1])
+    finally:
+      procFile.close()
+  return drops
+
+
+def kernelDrops():
+  """The datagrams the kernel dropped on the listening ports since the last
+  call, or None where /proc/net/udp has no drop counts"""
+  ports = list(listeningPorts)
+  drops = readSocketDrops(set([ port.inode for port in ports ]))
+  if not drops:
+    return None
+  total = 0
+  for port in ports:
+    current = drops.get(port.inode)
+    if current is not None:
+      total += current - port.drops
+      port.drops = current
+  return total
+
+
+# Avoid import circularities
+from carbon import instrumentation
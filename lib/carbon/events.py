@@ -22,8 +22,59 @@ class Event:
         log.err(None, "Exception in %s event handler: args=%s kwargs=%s" % (self.name, args, kwargs))
 
 
-metricReceived = Event('metricReceived')
-metricGenerated = Event('metricGenerated')
+class BatchEvent(Event):
+  """An event fired once with a whole list of (metric, datapoint), such as
+  everything a receiver parsed out of one read. Its own handlers take the
+  list. The handlers of its per-datapoint event are then called for each
+  datapoint in turn, so handlers written for that one keep working.
+
+  A batch handler that raises loses whatever it had not got to in the
+  batch, which is logged, the other handlers still get all of it. Handing
+  the batch over again a datapoint at a time would repeat what the handler
+  had already done, so batch handlers skip a bad datapoint themselves
+  rather than raise."""
+  def __init__(self, name):
+    Event.__init__(self, name)
+    self.datapointEvent = None
+
+  def __call__(self, datapoints):
+    for handler in self.handlers:
+      try:
+        handler(datapoints)
+      except:
+        log.err(None, "Exception in %s event handler, the rest of its %d datapoints are lost" % (self.name, len(datapoints)))
+
+    handlers = self.datapointEvent.handlers
+    if handlers:
+      name = self.datapointEvent.name
+      for (metric, datapoint) in datapoints:
+        for handler in handlers:
+          try:
+            handler(metric, datapoint)
+          except:
+            log.err(None, "Exception in %s event handler: args=%s" % (name, (metric, datapoint)))
+
+
+class DatapointEvent(Event):
+  "The per-datapoint side of a BatchEvent, firing it fires a batch of one"
+  def __init__(self, name, batchEvent):
+    Event.__init__(self, name)
+    self.batchEvent = batchEvent
+    batchEvent.datapointEvent = self
+
+  def __call__(self, metric, datapoint):
+    self.batchEvent([ (metric, datapoint) ])
+
+
+metricsReceived = BatchEvent('metricsReceived')
+metricReceived = DatapointEvent('metricReceived', metricsReceived)
+# The datapoints this process stores itself out of those received. They
+# are all of them but for the ingest workers of carbon-cache and
+# carbon-reader, which only own a slice of the metrics (see carbon.workers).
+metricsOwned = BatchEvent('metricsOwned')
+metricOwned = DatapointEvent('metricOwned', metricsOwned)
+metricsGenerated = BatchEvent('metricsGenerated')
+metricGenerated = DatapointEvent('metricGenerated', metricsGenerated)
 specialMetricReceived = Event('specialMetricReceived')
 specialMetricGenerated = Event('specialMetricGenerated')
 cacheFull = Event('cacheFull')
@@ -32,7 +83,7 @@ pauseReceivingMetrics = Event('pauseReceivingMetrics')
 resumeReceivingMetrics = Event('resumeReceivingMetrics')
 
 # Default handlers
-metricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
+metricsReceived.addHandler(lambda datapoints: state.instrumentation.increment('metricsReceived', len(datapoints)))
 specialMetricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
 
 
@@ -2,6 +2,7 @@ import os
 import time
 import socket
 from resource import getrusage, RUSAGE_SELF
+from threading import Lock
 
 from twisted.application.service import Service
 from twisted.internet.task import LoopingCall
@@ -9,6 +10,7 @@ from carbon.conf import settings
 from carbon import log
 
 stats = {}
+statsLock = Lock()  # stats are updated from the reactor and every writer thread
 prior_stats = {}
 HOSTNAME = socket.gethostname().replace('.','_')
 PAGESIZE = os.sysconf('SC_PAGESIZE')
@@ -26,22 +28,34 @@ lastUsageTime = time.time()
 
 def increment(stat, increase=1):
   try:
-    stats[stat] += increase
-  except KeyError:
-    stats[stat] = increase
+    statsLock.acquire()
+    try:
+      stats[stat] += increase
+    except KeyError:
+      stats[stat] = increase
+  finally:
+    statsLock.release()
 
 def max(stat, newval):
   try:
-    if stats[stat] < newval:
+    statsLock.acquire()
+    try:
+      if stats[stat] < newval:
+        stats[stat] = newval
+    except KeyError:
       stats[stat] = newval
-  except KeyError:
-    stats[stat] = newval
+  finally:
+    statsLock.release()
 
 def append(stat, value):
   try:
-    stats[stat].append(value)
-  except KeyError:
-    stats[stat] = [value]
+    statsLock.acquire()
+    try:
+      stats[stat].append(value)
+    except KeyError:
+      stats[stat] = [value]
+  finally:
+    statsLock.release()
 
 
 def getCpuUsage():
@@ -73,24 +87,41 @@ def getMemUsage():
 def recordMetrics():
   global lastUsage
   global prior_stats
-  myStats = stats.copy()
+  try:
+    statsLock.acquire()
+    myStats = stats.copy()
+    stats.clear()
+  finally:
+    statsLock.release()
   myPriorStats = {}
-  stats.clear()
 
   # cache metrics
   if settings.program == 'carbon-cache':
     record = cache_record
     updateTimes = myStats.get('updateTimes', [])
+    createTimes = myStats.get('createTimes', [])
+    updateRateLimits = myStats.get('updateRateLimits', [])
+    createWaitTimes = myStats.get('createWaitTimes', [])
     committedPoints = myStats.get('committedPoints', 0)
     creates = myStats.get('creates', 0)
+    droppedCreates = myStats.get('droppedCreates', 0)
+    pendingCreates = myStats.get('pendingCreates', 0)
     errors = myStats.get('errors', 0)
     cacheQueries = myStats.get('cacheQueries', 0)
     cacheOverflow = myStats.get('cache.overflow', 0)
+    oldestPointAge = myStats.get('oldestPointAge', 0)
 
     if updateTimes:
       avgUpdateTime = sum(updateTimes) / len(updateTimes)
       record('avgUpdateTime', avgUpdateTime)
 
+    if updateRateLimits:
+      record('avgUpdateRateLimit', sum(updateRateLimits) / len(updateRateLimits))
+
+    if createTimes:
+      record('avgCreateTime', sum(createTimes) / len(createTimes))
+      record('avgCreateWaitTime', sum(createWaitTimes) / len(createWaitTimes))
+
     if committedPoints:
       pointsPerUpdate = float(committedPoints) / len(updateTimes)
       record('pointsPerUpdate', pointsPerUpdate)
@@ -98,11 +129,30 @@ def recordMetrics():
     record('updateOperations', len(updateTimes))
     record('committedPoints', committedPoints)
     record('creates', creates)
+    record('droppedCreates', droppedCreates)
+    record('pendingCreates', pendingCreates)
     record('errors', errors)
     record('cache.queries', cacheQueries)
     record('cache.queues', len(cache.MetricCache))
     record('cache.size', cache.MetricCache.size)
     record('cache.overflow', cacheOverflow)
+    record('cache.oldestPointAge', oldestPointAge)
+
+    if settings.ENABLE_WAL:
+      record('wal.bytes', myStats.get('walBytes', 0))
+      record('wal.segments', myStats.get('walSegments', 0))
+
+  # reader metrics
+  elif settings.program == 'carbon-reader':
+    from carbon.readcache import ReadCache
+    record = reader_record
+    record('readCache.queries', myStats.get('readerQueries', 0))
+    record('readCache.hits', myStats.get('readCacheHits', 0))
+    record('readCache.misses', myStats.get('readCacheMisses', 0))
+    record('readCache.pointsRead', myStats.get('readCachePointsRead', 0))
+    record('readCache.evictions', myStats.get('readCacheEvictions', 0))
+    record('readCache.metrics', len(ReadCache.metrics))
+    record('readCache.size', ReadCache.size)
 
   # aggregator metrics
   elif settings.program == 'carbon-aggregator':
@@ -129,6 +179,13 @@ def recordMetrics():
   record('metricsReceived', myStats.get('metricsReceived', 0))
   record('cpuUsage', getCpuUsage())
 
+  if settings.ENABLE_UDP_LISTENER:
+    from carbon.datagram import kernelDrops
+    record('udp.datagrams', myStats.get('udpDatagrams', 0))
+    drops = kernelDrops()
+    if drops is not None:
+      record('udp.kernelDrops', drops)
+
   # And here preserve count of messages received in the prior periiod
   myPriorStats['metricsReceived'] = myStats.get('metricsReceived', 0)
   prior_stats.clear()
@@ -140,32 +197,40 @@ def recordMetrics():
     pass
 
 
+def agentName():
+  "The host, and instance and ingest worker if any, the metrics recorded are about"
+  name = HOSTNAME
+  if settings.instance is not None:
+    name += '-%s' % settings.instance
+  if settings.get('worker') is not None:
+    name += '-%d' % settings.worker
+  return name
+
+
 def cache_record(metric, value):
     prefix = settings.CARBON_METRIC_PREFIX
-    if settings.instance is None:
-      fullMetric = '%s.agents.%s.%s' % (prefix, HOSTNAME, metric)
-    else:
-      fullMetric = '%s.agents.%s-%s.%s' % (prefix, HOSTNAME, settings.instance, metric)
+    fullMetric = '%s.agents.%s.%s' % (prefix, agentName(), metric)
     datapoint = (time.time(), value)
     cache.MetricCache.store(fullMetric, datapoint)
 
 def relay_record(metric, value):
     prefix = settings.CARBON_METRIC_PREFIX
-    if settings.instance is None:
-      fullMetric = '%s.relays.%s.%s' % (prefix, HOSTNAME, metric)
-    else:
-      fullMetric = '%s.relays.%s-%s.%s' % (prefix, HOSTNAME, settings.instance, metric)
+    fullMetric = '%s.relays.%s.%s' % (prefix, agentName(), metric)
     log.relay("{0} {1}".format(fullMetric, value))
     datapoint = (time.time(), value)
     events.metricGenerated(fullMetric, datapoint)
 
 
+def reader_record(metric, value):
+    prefix = settings.CARBON_METRIC_PREFIX
+    fullMetric = '%s.readers.%s.%s' % (prefix, agentName(), metric)
+    datapoint = (time.time(), value)
+    events.metricGenerated(fullMetric, datapoint)
+
+
 def aggregator_record(metric, value):
     prefix = settings.CARBON_METRIC_PREFIX
-    if settings.instance is None:
-      fullMetric = '%s.aggregator.%s.%s' % (prefix, HOSTNAME, metric)
-    else:
-      fullMetric = '%s.aggregator.%s-%s.%s' % (prefix, HOSTNAME, settings.instance, metric)
+    fullMetric = '%s.aggregator.%s.%s' % (prefix, agentName(), metric)
     datapoint = (time.time(), value)
     events.metricGenerated(fullMetric, datapoint)
 
@@ -1,17 +1,61 @@
 import traceback
-import whisper
+from twisted.internet import reactor, threads, defer
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
 from carbon import log
-from carbon.storage import getFilesystemPath
+from carbon.conf import settings
+from carbon.database import database
 
 
+# Requests that touch the disk run here rather than on the reactor thread,
+# started on first use and stopped with the reactor.
+threadPool = None
+pendingByMetric = {}  # { metric : Deferred fired once its last queued request is done }
+
+
+def deferToThreadPool(f, *args, **kwargs):
+  "Runs f on the management thread pool, at most MANAGEMENT_THREADS at a time"
+  global threadPool
+  if threadPool is None:
+    threadPool = ThreadPool(1, settings.MANAGEMENT_THREADS, name='management')
+    threadPool.start()
+    reactor.addSystemEventTrigger('during', 'shutdown', threadPool.stop)
+  return threads.deferToThreadPool(reactor, threadPool, f, *args, **kwargs)
+
+
+def deferForMetric(metric, f, *args):
+  """deferToThreadPool(f, *args) once every request queued for the same
+  metric before it is done, so that pipelined requests take effect in the
+  order they were made while requests for different metrics run side by side"""
+  previous = pendingByMetric.get(metric)
+  done = pendingByMetric[metric] = defer.Deferred()
+  result = defer.Deferred()
+
+  def finished(outcome):
+    if pendingByMetric.get(metric) is done:
+      del pendingByMetric[metric]
+    done.callback(None)
+    if isinstance(outcome, failure.Failure):
+      result.errback(outcome)
+    else:
+      result.callback(outcome)
+
+  def run(ignored):
+    deferToThreadPool(f, *args).addBoth(finished)
+
+  if previous is None:
+    run(None)
+  else:
+    previous.addCallback(run)
+  return result
+
 
 def getMetadata(metric, key):
-  if key != 'aggregationMethod':
+  if key not in database.metadataKeys:
     return dict(error="Unsupported metadata key \"%s\"" % key)
 
-  wsp_path = getFilesystemPath(metric)
   try:
-    value = whisper.info(wsp_path)['aggregationMethod']
+    value = database.getMetadata(metric, key)
     return dict(value=value)
   except:
     log.err()
@@ -19,12 +63,11 @@ def getMetadata(metric, key):
 
 
 def setMetadata(metric, key, value):
-  if key != 'aggregationMethod':
+  if key not in database.metadataKeys:
     return dict(error="Unsupported metadata key \"%s\"" % key)
 
-  wsp_path = getFilesystemPath(metric)
   try:
-    old_value = whisper.setAggregationMethod(wsp_path, value)
+    old_value = database.setMetadata(metric, key, value)
     return dict(old_value=old_value, new_value=value)
   except:
     log.err()
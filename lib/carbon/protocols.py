@@ -1,11 +1,13 @@
-from twisted.internet import reactor
+import zlib
+from twisted.internet import reactor, defer, threads
 from twisted.internet.protocol import DatagramProtocol
 from twisted.internet.error import ConnectionDone
 from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
 from carbon import log, events, state, management
 from carbon.conf import settings
 from carbon.regexlist import WhiteList, BlackList
-from carbon.util import pickle, get_unpickler
+from carbon.util import pickle, get_unpickler, DatapointUnpickler
+from carbon.binary import NameTableDecoder
 
 
 class MetricReceiver:
@@ -57,10 +59,60 @@ class MetricReceiver:
     if datapoint[1] == datapoint[1]: # filter out NaN values
       events.metricReceived(metric, datapoint)
 
+  def metricsReceived(self, datapoints):
+    """Filters a list of (metric, datapoint) that was parsed in one go the
+    way metricReceived() does, and dispatches what is left as one batch"""
+    if BlackList:
+      allowed = [ (metric, datapoint) for (metric, datapoint) in datapoints
+                  if metric not in BlackList ]
+      if len(allowed) < len(datapoints):
+        instrumentation.increment('blacklistMatches', len(datapoints) - len(allowed))
+      datapoints = allowed
+    if WhiteList:
+      allowed = [ (metric, datapoint) for (metric, datapoint) in datapoints
+                  if metric in WhiteList ]
+      if len(allowed) < len(datapoints):
+        instrumentation.increment('whitelistRejects', len(datapoints) - len(allowed))
+      datapoints = allowed
+
+    datapoints = [ (metric, datapoint) for (metric, datapoint) in datapoints
+                   if datapoint[1] == datapoint[1] ] # filter out NaN values
+    if datapoints:
+      events.metricsReceived(datapoints)
+
 
 class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
+  """Parses every chunk of data received in a single pass rather than a
+  line at a time, and hands all of its datapoints to metricsReceived()
+  together. Only the incomplete line at the end of a chunk is held over.
+  Like LineOnlyReceiver, the connection is dropped at the first line, or
+  incomplete line, longer than MAX_LENGTH, the lines before it are kept."""
   delimiter = '\n'
 
+  def dataReceived(self, data):
+    lines = (self._buffer + data).split('\n')
+    self._buffer = lines.pop()
+
+    datapoints = []
+    tooLong = None
+    for line in lines:
+      if len(line) > self.MAX_LENGTH:
+        tooLong = line
+        break
+      try:
+        metric, value, timestamp = line.split()
+        datapoints.append( (metric, (float(timestamp), float(value))) )
+      except ValueError:
+        log.listener('invalid line received from client %s, ignoring' % self.peerName)
+
+    if datapoints and not self.transport.disconnecting:
+      self.metricsReceived(datapoints)
+
+    if tooLong is not None:
+      return self.lineLengthExceeded(tooLong)
+    if len(self._buffer) > self.MAX_LENGTH:
+      return self.lineLengthExceeded(self._buffer)
+
   def lineReceived(self, line):
     try:
       metric, value, timestamp = line.strip().split()
@@ -73,15 +125,27 @@ class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
 
 
 class MetricDatagramReceiver(MetricReceiver, DatagramProtocol):
+  """Parses datagrams of plaintext lines. MetricDatagramPort hands it all of
+  the datagrams read at once, which are parsed in a single pass and
+  dispatched as one batch."""
   def datagramReceived(self, data, (host, port)):
-    for line in data.splitlines():
+    self.datagramsReceived([data])
+
+  def datagramsReceived(self, datagrams):
+    datapoints = []
+    invalid = 0
+    for line in '\n'.join(datagrams).splitlines():
       try:
-        metric, value, timestamp = line.strip().split()
-        datapoint = ( float(timestamp), float(value) )
+        metric, value, timestamp = line.split()
+        datapoints.append( (metric, (float(timestamp), float(value))) )
+      except ValueError:
+        if line.strip():
+          invalid += 1
 
-        self.metricReceived(metric, datapoint)
-      except:
-        log.listener('invalid line received from %s, ignoring' % host)
+    if invalid:
+      log.listener('%d invalid lines received over UDP, ignoring' % invalid)
+    if datapoints:
+      self.metricsReceived(datapoints)
 
 
 class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
@@ -89,7 +153,10 @@ class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
 
   def connectionMade(self):
     MetricReceiver.connectionMade(self)
-    self.unpickler = get_unpickler(insecure=settings.USE_INSECURE_UNPICKLER)
+    if settings.USE_INSECURE_UNPICKLER:
+      self.unpickler = pickle
+    else:
+      self.unpickler = DatapointUnpickler
 
   def stringReceived(self, data):
     try:
@@ -98,21 +165,116 @@ class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
       log.listener('invalid pickle received from %s, ignoring' % self.peerName)
       return
 
+    try:
+      # A well formed message is converted in a single pass
+      datapoints = [ (metric, (float(timestamp), float(value)))
+                     for (metric, (timestamp, value)) in datapoints ]
+    except:
+      datapoints = self.validDatapoints(datapoints)
+
+    if datapoints:
+      self.metricsReceived(datapoints)
+
+  def validDatapoints(self, datapoints):
+    "Converts the datapoints one at a time, skipping any that are malformed"
+    valid = []
     for (metric, datapoint) in datapoints:
       try:
         datapoint = ( float(datapoint[0]), float(datapoint[1]) ) #force proper types
       except:
         continue
 
-      self.metricReceived(metric, datapoint)
+      valid.append( (metric, datapoint) )
+    return valid
+
+
+class ZlibStreamReceiver:
+  """Mixin for a receiver whose connection carries a zlib stream, as
+  zlib.compressobj() writes it, or several of them one after the other.
+  What arrives is decompressed a chunk of at most maxChunkSize bytes at a
+  time into the usual parsing of receiverClass, so a sender may flush as
+  often or as seldom as it likes."""
+  receiverClass = None
+  maxChunkSize = 2 ** 20
+
+  def connectionMade(self):
+    self.decompressor = zlib.decompressobj()
+    self.receiverClass.connectionMade(self)
+
+  def dataReceived(self, data):
+    while data and not self.transport.disconnecting:
+      try:
+        chunk = self.decompressor.decompress(data, self.maxChunkSize)
+      except zlib.error, e:
+        log.listener('invalid compressed data received from %s, disconnecting: %s' % (self.peerName, e))
+        self.transport.loseConnection()
+        return
+
+      data = self.decompressor.unconsumed_tail
+      if self.decompressor.unused_data:  # The next stream has started
+        data = self.decompressor.unused_data
+        self.decompressor = zlib.decompressobj()
+      if chunk:
+        why = self.receiverClass.dataReceived(self, chunk)
+        if why is not None:  # Such as a line over MAX_LENGTH
+          return why
+
+
+class MetricCompressedLineReceiver(ZlibStreamReceiver, MetricLineReceiver):
+  receiverClass = MetricLineReceiver
+
+
+class MetricCompressedPickleReceiver(ZlibStreamReceiver, MetricPickleReceiver):
+  receiverClass = MetricPickleReceiver
+
+
+class MetricBinaryReceiver(MetricReceiver, Int32StringReceiver):
+  """Receives the binary protocol, see carbon.binary. A malformed message
+  leaves the connection's name table in doubt, so the connection is
+  dropped rather than the message skipped."""
+  MAX_LENGTH = 2 ** 20
+
+  def connectionMade(self):
+    MetricReceiver.connectionMade(self)
+    self.decoder = NameTableDecoder(settings.BINARY_MAX_NAMES)
+
+  def stringReceived(self, data):
+    if self.transport.disconnecting:
+      return  # Whatever else was read along with a malformed message
+    try:
+      datapoints = self.decoder.decode(data)
+    except ValueError, e:
+      log.listener('invalid message received from %s, disconnecting: %s' % (self.peerName, e))
+      self.transport.loseConnection()
+      return
+
+    if datapoints:
+      self.metricsReceived(datapoints)
+
+
+class MetricPeerReceiver(MetricBinaryReceiver):
+  """Receives what the other ingest workers of an instance forward to the
+  one owning the metrics. The worker that received the datapoints already
+  counted and filtered them, so they are only stored."""
+  def metricsReceived(self, datapoints):
+    events.metricsOwned(datapoints)
+
 
+class QueryHandler(Int32StringReceiver):
+  """Base class for the pickled request/response query protocols. A
+  client may pipeline requests: each is answered as soon as its result is
+  ready, which may be a Deferred from another thread, but responses always
+  go out in the order the requests came in. Reading from a client stops
+  while it has maxPendingResponses requests outstanding."""
+  maxPendingResponses = 100
 
-class CacheManagementHandler(Int32StringReceiver):
   def connectionMade(self):
     peer = self.transport.getPeer()
     self.peerAddr = "%s:%d" % (peer.host, peer.port)
     log.query("%s connected" % self.peerAddr)
     self.unpickler = get_unpickler(insecure=settings.USE_INSECURE_UNPICKLER)
+    self.responses = defer.succeed(None)
+    self.pendingResponses = 0
 
   def connectionLost(self, reason):
     if reason.check(ConnectionDone):
@@ -120,6 +282,44 @@ class CacheManagementHandler(Int32StringReceiver):
     else:
       log.query("%s connection lost: %s" % (self.peerAddr, reason.value))
 
+  def respond(self, result):
+    "Sends result, or what a Deferred result fires with, after every earlier response"
+    if isinstance(result, defer.Deferred):
+      result.addErrback(self.requestFailed)
+    self.pendingResponses += 1
+    if self.pendingResponses == self.maxPendingResponses:
+      self.transport.pauseProducing()
+
+    # Chaining onto the previous response keeps them in request order
+    self.responses.addCallback(lambda ignored: result)
+    self.responses.addCallback(self.sendResponse)
+    self.responses.addErrback(self.responseFailed)
+
+  def requestFailed(self, failure):
+    log.query('[%s] request failed: %s' % (self.peerAddr, failure.getErrorMessage()))
+    return dict(error=failure.getErrorMessage())
+
+  def responseFailed(self, failure):
+    """Answers with an error instead of a result that could not be sent,
+    such as one that doesn't pickle, so that the chain goes on and every
+    later request still gets its own response. A client that can't be
+    answered at all is disconnected."""
+    log.query('[%s] response failed: %s' % (self.peerAddr, failure.getErrorMessage()))
+    log.err(failure)
+    try:
+      self.sendString(pickle.dumps(dict(error=failure.getErrorMessage()), protocol=-1))
+    except:
+      log.err()
+      self.transport.loseConnection()
+
+  def sendResponse(self, result):
+    self.pendingResponses -= 1
+    if self.pendingResponses == self.maxPendingResponses - 1:
+      self.transport.resumeProducing()
+    self.sendString(pickle.dumps(result, protocol=-1))
+
+
+class CacheManagementHandler(QueryHandler):
   def stringReceived(self, rawRequest):
     request = self.unpickler.loads(rawRequest)
     if request['type'] == 'cache-query':
@@ -130,19 +330,63 @@ class CacheManagementHandler(Int32StringReceiver):
         log.query('[%s] cache query for \"%s\" returned %d values' % (self.peerAddr, metric, len(datapoints)))
       instrumentation.increment('cacheQueries')
 
+    elif request['type'] == 'cache-query-bulk':
+      # Any number of metrics in one round-trip, only the datapoints within
+      # the requested range, each metric's packed by encodeDatapoints()
+      metrics = request['metrics']
+      ranges = MetricCache.getRanges(metrics, request.get('from'), request.get('until'))
+      datapoints = dict( (metric, encodeDatapoints(queue)) for (metric, queue) in ranges.iteritems() )
+      result = dict(datapoints=datapoints)
+      if settings.LOG_CACHE_HITS is True:
+        log.query('[%s] bulk cache query for %d metrics returned %d values' %
+                  (self.peerAddr, len(metrics), sum([len(queue) // 2 for queue in ranges.itervalues()])))
+      instrumentation.increment('cacheQueries')
+
     elif request['type'] == 'get-metadata':
-      result = management.getMetadata(request['metric'], request['key'])
+      result = management.deferForMetric(request['metric'], management.getMetadata,
+                                         request['metric'], request['key'])
 
     elif request['type'] == 'set-metadata':
-      result = management.setMetadata(request['metric'], request['key'], request['value'])
+      result = management.deferForMetric(request['metric'], management.setMetadata,
+                                         request['metric'], request['key'], request['value'])
 
     else:
       result = dict(error="Invalid request type \"%s\"" % request['type'])
 
-    response = pickle.dumps(result, protocol=-1)
-    self.sendString(response)
+    self.respond(result)
+
+
+class ReaderQueryHandler(QueryHandler):
+  """carbon-reader's query protocol. A pickled
+  {'type': 'fetch', 'metric': ..., 'from': ..., 'until': ...} request is
+  answered with dict(timeInfo=..., values=...) as whisper.fetch() returns
+  them, or dict(error=...). Queries may read through to disk so they run
+  in the reactor's thread pool."""
+  def stringReceived(self, rawRequest):
+    try:
+      request = self.unpickler.loads(rawRequest)
+    except:
+      log.query('invalid request received from %s, ignoring' % self.peerAddr)
+      result = dict(error="Invalid request")
+    else:
+      if request.get('type') == 'fetch':
+        result = threads.deferToThread(ReadCache.query, request['metric'],
+                                       request['from'], request.get('until'))
+        result.addCallback(self.fetchResult)
+      else:
+        result = dict(error="Invalid request type \"%s\"" % request.get('type'))
+      instrumentation.increment('readerQueries')
+
+    self.respond(result)
+
+  def fetchResult(self, fetched):
+    if fetched is None:
+      return dict(timeInfo=None, values=[])
+    timeInfo, values = fetched
+    return dict(timeInfo=timeInfo, values=values)
 
 
 # Avoid import circularities
-from carbon.cache import MetricCache
+from carbon.cache import MetricCache, encodeDatapoints
+from carbon.readcache import ReadCache
 from carbon import instrumentation
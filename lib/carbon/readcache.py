@@ -0,0 +1,395 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import time
+from array import array
+from threading import Lock
+from carbon.conf import settings
+
+
+NAN = float('nan')
+
+
+def missing(count):
+  "An array('d') of count missing values"
+  return array('d', [NAN]) * count
+
+
+def rangeWidth(seconds):
+  "Rounds a queried range up to a power of two so similar queries share a width"
+  width = 1
+  seconds = int(seconds)
+  while width < seconds:  # int.bit_length() needs Python 2.7
+    width <<= 1
+  return width
+
+
+class CachedSeries(object):
+  """One archive of a queried metric, held as an array('d') of values one
+  step apart from start on, with NaN where there is no value.
+
+  Intervals from loadedFrom on have been read from the database. The live
+  series, the highest resolution archive, is kept current by the ingest
+  stream from there on. What carbon-cache still held in memory when it was
+  read was not on disk yet, so the intervals read last (unsettledFrom to
+  unsettledUntil) are read once more, for the gaps only, on the first
+  query READ_CACHE_FLUSH_DELAY seconds after they were read (unsettledAt).
+  A coarser series only holds what aggregation had
+  produced when it was read: it is complete up to validUntil, and the
+  intervals after that are served for one step before they are read again.
+  Either way a query only reads the intervals the series is missing.
+
+  widths maps each range width the series has been queried for to the time
+  it was last queried, which is what eviction goes by."""
+  __slots__ = ('step', 'live', 'start', 'values', 'loadedFrom', 'validUntil',
+               'fetchedAt', 'widths', 'unsettledFrom', 'unsettledUntil', 'unsettledAt')
+
+  def __init__(self, step, live):
+    self.step = step
+    self.live = live
+    self.start = None
+    self.values = array('d')
+    self.loadedFrom = None
+    self.validUntil = None
+    self.fetchedAt = 0
+    self.widths = {}
+    self.unsettledFrom = None
+    self.unsettledUntil = None
+    self.unsettledAt = None
+
+  @property
+  def end(self):
+    return self.start + len(self.values) * self.step
+
+  def missing(self, fromInterval, untilInterval, now):
+    "The [from, until) ranges to read before [fromInterval, untilInterval) can be served"
+    step = self.step
+    if self.loadedFrom is None:
+      if self.live:
+        return [ (fromInterval, now - (now % step) + step) ]
+      return [ (fromInterval, untilInterval) ]
+
+    ranges = []
+    if fromInterval < self.loadedFrom:
+      ranges.append( (fromInterval, self.loadedFrom) )
+    if not self.live and untilInterval > self.validUntil and now - self.fetchedAt >= step:
+      ranges.append( (self.validUntil, untilInterval) )
+    return ranges
+
+  def unsettle(self, ranges, now):
+    "Records that the live series is reading ranges from the database at now"
+    if not ranges:
+      return
+    fromInterval = min([ a for (a, b) in ranges ])
+    untilInterval = max([ b for (a, b) in ranges ])
+    if self.unsettledAt is not None:
+      fromInterval = min(fromInterval, self.unsettledFrom)
+      untilInterval = max(untilInterval, self.unsettledUntil)
+    self.unsettledFrom = fromInterval
+    self.unsettledUntil = untilInterval
+    self.unsettledAt = now
+
+  def settle(self, now):
+    """The range to read again once carbon-cache may have written what it
+    held at the last read, or None"""
+    if self.unsettledAt is None or now - self.unsettledAt < settings.READ_CACHE_FLUSH_DELAY:
+      return None
+    fromInterval = max(self.unsettledFrom, self.start)
+    untilInterval = self.unsettledUntil
+    self.unsettledAt = None
+    if fromInterval >= untilInterval:
+      return None
+    return (fromInterval, untilInterval)
+
+  def allocate(self, fromInterval, untilInterval):
+    "Grows the array to span [fromInterval, untilInterval), returns the points added"
+    step = self.step
+    before = len(self.values)
+    if self.start is None:
+      self.start = fromInterval
+    if fromInterval < self.start:
+      self.values = missing((self.start - fromInterval) // step) + self.values
+      self.start = fromInterval
+    end = self.end
+    if untilInterval > end:
+      self.values.extend( missing((untilInterval - end) // step) )
+    return len(self.values) - before
+
+  def set(self, interval, value):
+    "Stores an ingested value, returns the points added"
+    added = self.allocate(interval, interval + self.step)
+    self.values[(interval - self.start) // self.step] = value
+    return added
+
+  def merge(self, timeInfo, values):
+    """Stores what was read from the database, returns the points added. The
+    live series only fills in the intervals ingest hasn't provided, which
+    are newer than anything the database had."""
+    fromInterval, untilInterval, step = timeInfo
+    added = self.allocate(fromInterval, untilInterval)
+    current = self.values
+    i = (fromInterval - self.start) // step
+    for value in values:
+      if value is not None:
+        if not (self.live and current[i] == current[i]):
+          current[i] = value
+      elif not self.live:
+        current[i] = NAN
+      i += 1
+    return added
+
+  def slice(self, fromInterval, untilInterval):
+    "The values of [fromInterval, untilInterval) as whisper.fetch() lists them"
+    step = self.step
+    result = [None] * ((untilInterval - fromInterval) // step)
+    low = max(fromInterval, self.start)
+    high = min(untilInterval, self.end)
+    if low < high:
+      i = (low - fromInterval) // step
+      for value in self.values[(low - self.start) // step:(high - self.start) // step]:
+        if value == value:  # NaN is missing
+          result[i] = value
+        i += 1
+    return result
+
+  def trim(self, oldest):
+    "Drops the intervals before the one oldest falls in, returns the points dropped"
+    if self.start is None or oldest < self.start + self.step:
+      return 0
+    oldest = int(oldest) - (int(oldest) % self.step)
+    count = min(len(self.values), (oldest - self.start) // self.step)
+    del self.values[:count]
+    if self.values:
+      self.start += count * self.step
+    else:
+      self.start = oldest
+    if self.loadedFrom is not None and self.loadedFrom < self.start:
+      self.loadedFrom = self.start
+    return count
+
+
+class CachedMetric(object):
+  __slots__ = ('archives', 'series')
+
+  def __init__(self, archives):
+    self.archives = archives  # [ (secondsPerPoint, retention), ... ], highest resolution first
+    self.series = {}  # { secondsPerPoint : CachedSeries }
+
+
+class ReadCache(object):
+  """Time-range queries for metrics, answered the way whisper.fetch() would
+  answer them, from memory wherever possible.
+
+  Nothing is held for a metric until it is queried. The first query of a
+  range reads it through from the database, after which the metric's
+  highest resolution archive is kept up to date from the ingest stream
+  (storeMany() is a metricsReceived handler) so later queries of that range, or
+  of anything more recent, never touch the disk.
+
+  Each series remembers the range widths it was queried for and when. A
+  series is trimmed to its widest range that has been queried within
+  READ_CACHE_MAX_IDLE seconds, and dropped once there is none. When a
+  read takes the cache past READ_CACHE_MAX_POINTS the least recently
+  queried ranges are dropped first, down to 90% of it."""
+  def __init__(self, database=None):
+    self.database = database
+    self.lock = Lock()
+    self.metrics = {}  # { metric : CachedMetric }
+    self.size = 0  # points held over every series
+
+  def setDatabase(self, database):
+    self.database = database
+
+  def query(self, metric, fromTime, untilTime=None, now=None):
+    "Returns ((fromInterval, untilInterval, step), values) like whisper.fetch()"
+    if now is None:
+      now = int(time.time())
+    cached = self.metrics.get(metric)
+    if cached is None:
+      archives = self.database.getArchives(metric)
+    else:
+      archives = cached.archives
+
+    # The same adjustments and archive choice as whisper.fetch()
+    fromTime = int(fromTime)
+    if untilTime is None:
+      untilTime = now
+    untilTime = int(untilTime)
+    if fromTime > untilTime:
+      raise ValueError("Invalid time interval: from time '%s' is after until time '%s'" %
+                       (fromTime, untilTime))
+    oldestTime = now - max([ retention for (step, retention) in archives ])
+    if fromTime > now or untilTime < oldestTime:
+      return None
+    fromTime = max(fromTime, oldestTime)
+    untilTime = min(untilTime, now)
+
+    for step, retention in archives:
+      if retention >= now - fromTime:
+        break
+    fromInterval = fromTime - (fromTime % step) + step
+    untilInterval = untilTime - (untilTime % step) + step
+    if fromInterval == untilInterval:
+      untilInterval += step
+    live = step == archives[0][0]
+
+    try:
+      self.lock.acquire()
+      cached = self.metrics.get(metric)
+      if cached is None:
+        cached = self.metrics[metric] = CachedMetric(archives)
+      series = cached.series.get(step)
+      if series is None:
+        series = cached.series[step] = CachedSeries(step, live)
+      series.widths[rangeWidth(now - fromTime)] = now
+
+      ranges = series.missing(fromInterval, untilInterval, now)
+      if live:
+        settling = series.settle(now)
+        series.unsettle(ranges, now)
+        if settling is not None:
+          ranges.append(settling)
+      if not ranges:
+        instrumentation.increment('readCacheHits')
+        return ((fromInterval, untilInterval, step),
+                series.slice(fromInterval, untilInterval))
+
+      if live:
+        # Ingest lands in the series from here on, while it is being read
+        for (a, b) in ranges:
+          self.size += series.allocate(a, b)
+    finally:
+      self.lock.release()
+
+    instrumentation.increment('readCacheMisses')
+    fetched = []
+    for (a, b) in ranges:
+      # whisper.fetch()'s rounding turns these into exactly [a, b)
+      timeInfo, values = self.database.fetch(metric, a - 1, b - 1, step)
+      instrumentation.increment('readCachePointsRead', len(values))
+      fetched.append( (timeInfo, values) )
+
+    try:
+      self.lock.acquire()
+      # Unless it was evicted while it was being read
+      if cached.series.get(step) is series and self.metrics.get(metric) is cached:
+        for (timeInfo, values) in fetched:
+          self.merge(series, timeInfo, values, now)
+        result = ((fromInterval, untilInterval, step),
+                  series.slice(fromInterval, untilInterval))
+        if self.size > settings.READ_CACHE_MAX_POINTS:
+          self.evict(now)
+        return result
+    finally:
+      self.lock.release()
+
+    return self.database.fetch(metric, fromTime, untilTime)
+
+  def merge(self, series, timeInfo, values, now):
+    fromInterval, untilInterval, step = timeInfo
+    self.size += series.merge(timeInfo, values)
+    if series.loadedFrom is None or fromInterval < series.loadedFrom:
+      series.loadedFrom = fromInterval
+
+    if not series.live:
+      # Aggregation may still change the last intervals, as the writer
+      # catches up with what it has in its cache.
+      validUntil = min(untilInterval, now - (now % step) - step)
+      if series.validUntil is None or validUntil >= series.validUntil:
+        series.validUntil = validUntil
+        series.fetchedAt = now
+
+  def store(self, metric, datapoint):
+    "metricReceived handler, keeps the live series of queried metrics current"
+    self.storeMany([ (metric, datapoint) ])
+
+  def storeMany(self, datapoints):
+    "metricsReceived handler, store() for a whole batch taking the lock once"
+    metrics = self.metrics
+    queried = [ (metric, datapoint) for (metric, datapoint) in datapoints
+                if metric in metrics ]
+    if not queried:
+      return
+    now = time.time()
+    try:
+      self.lock.acquire()
+      for (metric, (timestamp, value)) in queried:
+        cached = metrics.get(metric)
+        if cached is None:
+          continue
+        step, retention = cached.archives[0]
+        series = cached.series.get(step)
+        if series is None or series.start is None:
+          continue
+        interval = int(timestamp) - (int(timestamp) % step)
+        # Anything older is read from the database if it is ever queried, and
+        # a clock far in the future is kept from growing the series unbounded
+        if interval < series.start or interval > now + retention:
+          continue
+        self.size += series.set(interval, value)
+    finally:
+      self.lock.release()
+
+  def fit(self, metric, series, now):
+    """Trims a series to the widest range still queried from it, or drops
+    it if there is none. Returns the number of points freed."""
+    if series.widths:
+      return series.trim(now - max(series.widths))
+    cached = self.metrics[metric]
+    del cached.series[series.step]
+    if not cached.series:
+      del self.metrics[metric]
+    return len(series.values)
+
+  def evict(self, now):
+    "Drops the least recently queried ranges, widest first, down to 90% of READ_CACHE_MAX_POINTS"
+    target = settings.READ_CACHE_MAX_POINTS * 0.9
+    ranges = []
+    for metric, cached in self.metrics.iteritems():
+      for series in cached.series.itervalues():
+        for width, lastQueried in series.widths.iteritems():
+          ranges.append( (lastQueried, -width, metric, series) )
+    ranges.sort(key=lambda r: r[:2])
+
+    evicted = 0
+    for lastQueried, width, metric, series in ranges:
+      if self.size <= target:
+        break
+      del series.widths[-width]
+      self.size -= self.fit(metric, series, now)
+      evicted += 1
+    instrumentation.increment('readCacheEvictions', evicted)
+
+  def expire(self, now=None):
+    "Forgets the ranges not queried for READ_CACHE_MAX_IDLE seconds"
+    if now is None:
+      now = time.time()
+    try:
+      self.lock.acquire()
+      for metric, cached in self.metrics.items():
+        for series in cached.series.values():
+          for width, lastQueried in series.widths.items():
+            if now - lastQueried > settings.READ_CACHE_MAX_IDLE:
+              del series.widths[width]
+          self.size -= self.fit(metric, series, now)
+    finally:
+      self.lock.release()
+
+
+# Ghetto singleton
+ReadCache = ReadCache()
+
+
+# Avoid import circularities
+from carbon import instrumentation
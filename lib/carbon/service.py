@@ -12,10 +12,11 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
+import os
 from os.path import exists
 
 from twisted.application.service import MultiService
-from twisted.application.internet import TCPServer, TCPClient, UDPServer
+from twisted.application.internet import TCPServer, TCPClient, TimerService
 from twisted.internet.protocol import ServerFactory
 from twisted.python.components import Componentized
 from twisted.python.log import ILogObserver
@@ -36,14 +37,81 @@ class CarbonRootService(MultiService):
 
 
 
+def isSupervisor():
+    "With INGEST_PROCESSES the daemon started only supervises its workers"
+    from carbon.conf import settings
+    return settings.INGEST_PROCESSES > 0 and settings.get("worker") is None
+
+
+def workerPort(port):
+    "Ports only one process can listen on are spaced out by ingest worker"
+    from carbon.conf import settings
+    return int(port) + (settings.get("worker") or 0)
+
+
+def createSupervisorService(config):
+    from carbon.conf import settings
+    from carbon import workers
+
+    if util.SO_REUSEPORT is None:
+      raise Exception("INGEST_PROCESSES needs SO_REUSEPORT, which this platform does not have")
+
+    root_service = CarbonRootService()
+    root_service.setName(settings.program)
+
+    service = workers.SupervisorService(workers.workerCommand(config),
+                                        int(settings.INGEST_PROCESSES))
+    service.setServiceParent(root_service)
+
+    return root_service
+
+
+def sliceMetrics(root_service):
+    """Fires metricsOwned with the received datapoints this process stores
+    itself. An ingest worker only keeps its slice of the metrics and
+    forwards the rest to the workers owning them."""
+    from carbon.conf import settings
+    from carbon.protocols import MetricPeerReceiver
+
+    if settings.get("worker") is None:
+        events.metricsReceived.addHandler(events.metricsOwned)
+        return
+
+    from carbon.workers import MetricSlicer, peerDestination
+
+    slicer = MetricSlicer(settings.worker, int(settings.INGEST_PROCESSES))
+    slicer.clients.setServiceParent(root_service)
+    state.ownsMetric = slicer.owns
+    events.metricsReceived.addHandler(slicer.route)
+
+    interface, port, instance = peerDestination(settings.worker)
+    factory = ServerFactory()
+    factory.protocol = MetricPeerReceiver
+    service = TCPServer(port, factory, interface=interface)
+    service.setServiceParent(root_service)
+
+
 def createBaseService(config):
     from carbon.conf import settings
     from carbon.protocols import (MetricLineReceiver, MetricPickleReceiver,
-                                  MetricDatagramReceiver)
+                                  MetricCompressedLineReceiver,
+                                  MetricCompressedPickleReceiver,
+                                  MetricBinaryReceiver, MetricDatagramReceiver)
 
     root_service = CarbonRootService()
     root_service.setName(settings.program)
 
+    # Ingest workers share the receiver ports, the kernel spreads
+    # connections between them
+    if settings.get("worker") is None:
+        tcp_server = TCPServer
+    else:
+        from carbon.workers import ReusePortTCPServer, stopIfOrphaned
+        tcp_server = ReusePortTCPServer
+
+        service = TimerService(5, stopIfOrphaned, os.getppid())
+        service.setServiceParent(root_service)
+
     use_amqp = settings.get("ENABLE_AMQP", False)
     if use_amqp:
         from carbon import amqp_listener
@@ -63,18 +131,39 @@ def createBaseService(config):
                                        MetricLineReceiver),
                                       (settings.PICKLE_RECEIVER_INTERFACE,
                                        settings.PICKLE_RECEIVER_PORT,
-                                       MetricPickleReceiver)):
-        if port:
-            factory = ServerFactory()
-            factory.protocol = protocol
-            service = TCPServer(int(port), factory, interface=interface)
-            service.setServiceParent(root_service)
+                                       MetricPickleReceiver),
+                                      (settings.COMPRESSED_LINE_RECEIVER_INTERFACE,
+                                       settings.COMPRESSED_LINE_RECEIVER_PORT,
+                                       MetricCompressedLineReceiver),
+                                      (settings.COMPRESSED_PICKLE_RECEIVER_INTERFACE,
+                                       settings.COMPRESSED_PICKLE_RECEIVER_PORT,
+                                       MetricCompressedPickleReceiver),
+                                      (settings.BINARY_RECEIVER_INTERFACE,
+                                       settings.BINARY_RECEIVER_PORT,
+                                       MetricBinaryReceiver)):
+        # A receiver whose port is unset or 0 is off
+        if not port:
+            continue
+        factory = ServerFactory()
+        factory.protocol = protocol
+        service = tcp_server(int(port), factory, interface=interface)
+        service.setServiceParent(root_service)
 
     if settings.ENABLE_UDP_LISTENER:
-        service = UDPServer(int(settings.UDP_RECEIVER_PORT),
-                            MetricDatagramReceiver(),
-                            interface=settings.UDP_RECEIVER_INTERFACE)
-        service.setServiceParent(root_service)
+        from carbon.datagram import MetricDatagramServer
+
+        sockets = int(settings.UDP_RECEIVER_SOCKETS)
+        reuse_port = sockets > 1 or settings.get("worker") is not None
+        if reuse_port and util.SO_REUSEPORT is None:
+            raise Exception("UDP_RECEIVER_SOCKETS above 1 needs SO_REUSEPORT, "
+                            "which this platform does not have")
+        for i in range(sockets):
+            service = MetricDatagramServer(int(settings.UDP_RECEIVER_PORT),
+                                           MetricDatagramReceiver(),
+                                           interface=settings.UDP_RECEIVER_INTERFACE,
+                                           bufferSize=int(settings.UDP_RECEIVER_BUFFER_SIZE),
+                                           reusePort=reuse_port)
+            service.setServiceParent(root_service)
 
     if use_amqp:
         factory = amqp_listener.createAMQPListener(
@@ -89,7 +178,7 @@ def createBaseService(config):
         from carbon import manhole
 
         factory = manhole.createManholeListener()
-        service = TCPServer(int(settings.MANHOLE_PORT), factory,
+        service = TCPServer(workerPort(settings.MANHOLE_PORT), factory,
                             interface=settings.MANHOLE_INTERFACE)
         service.setServiceParent(root_service)
 
@@ -113,13 +202,33 @@ def createCacheService(config):
     from carbon.conf import settings
     from carbon.protocols import CacheManagementHandler
 
+    if isSupervisor():
+        return createSupervisorService(config)
+
     # Configure application components
-    events.metricReceived.addHandler(MetricCache.store)
+    MetricCache.setWriteStrategy(settings.CACHE_WRITE_STRATEGY)
+    MetricCache.setShardCount(settings.CACHE_SHARDS)
+    events.metricsOwned.addHandler(MetricCache.storeMany)
+
+    # Whatever the last shutdown saved goes back into the cache first
+    from carbon.snapshot import restoreCache
+    restoreCache(MetricCache, settings.CACHE_SNAPSHOT_FILE)
+
+    if settings.ENABLE_WAL:
+        from carbon.wal import WAL
+        from twisted.internet import reactor
+
+        # Datapoints left by the last run are back in the cache before any
+        # listener opens. Logging follows the cache store, see WriteAheadLog.
+        WAL.start()
+        events.metricsOwned.addHandler(WAL.appendMany)
+        reactor.addSystemEventTrigger('after', 'shutdown', WAL.stop)
 
     root_service = createBaseService(config)
+    sliceMetrics(root_service)
     factory = ServerFactory()
     factory.protocol = CacheManagementHandler
-    service = TCPServer(int(settings.CACHE_QUERY_PORT), factory,
+    service = TCPServer(workerPort(settings.CACHE_QUERY_PORT), factory,
                         interface=settings.CACHE_QUERY_INTERFACE)
     service.setServiceParent(root_service)
 
@@ -136,6 +245,49 @@ def createCacheService(config):
     return root_service
 
 
+def createReaderService(config):
+    from carbon.conf import settings
+    from carbon.database import database
+    from carbon.readcache import ReadCache
+    from carbon.protocols import ReaderQueryHandler
+    from carbon.routers import ConsistentHashingRouter
+    from carbon.client import CarbonClientManager
+
+    if isSupervisor():
+        return createSupervisorService(config)
+
+    # Configure application components
+    ReadCache.setDatabase(database)
+    events.metricsOwned.addHandler(ReadCache.storeMany)
+
+    root_service = createBaseService(config)
+    sliceMetrics(root_service)
+
+    # carbon-reader stores nothing itself, what it records about itself is
+    # sent on to be stored like carbon-aggregator's output is
+    router = ConsistentHashingRouter()
+    client_manager = CarbonClientManager(router)
+    client_manager.setServiceParent(root_service)
+    events.metricsGenerated.addHandler(client_manager.sendDatapoints)
+
+    if not settings.DESTINATIONS:
+      raise Exception("Required setting DESTINATIONS is missing from carbon.conf")
+
+    for destination in util.parseDestinations(settings.DESTINATIONS):
+      client_manager.startClient(destination)
+
+    factory = ServerFactory()
+    factory.protocol = ReaderQueryHandler
+    service = TCPServer(workerPort(settings.READER_QUERY_PORT), factory,
+                        interface=settings.READER_QUERY_INTERFACE)
+    service.setServiceParent(root_service)
+
+    service = TimerService(60, ReadCache.expire)
+    service.setServiceParent(root_service)
+
+    return root_service
+
+
 def createAggregatorService(config):
     from carbon.aggregator import receiver
     from carbon.aggregator.rules import RuleManager
@@ -145,6 +297,10 @@ def createAggregatorService(config):
     from carbon.conf import settings
     from carbon import events
 
+    # Every aggregate has to be computed from all of its inputs in one place
+    if settings.INGEST_PROCESSES:
+      raise Exception("INGEST_PROCESSES is not supported by carbon-aggregator")
+
     root_service = createBaseService(config)
 
     # Configure application components
@@ -152,8 +308,8 @@ def createAggregatorService(config):
     client_manager = CarbonClientManager(router)
     client_manager.setServiceParent(root_service)
 
-    events.metricReceived.addHandler(receiver.process)
-    events.metricGenerated.addHandler(client_manager.sendDatapoint)
+    events.metricsReceived.addHandler(receiver.processMany)
+    events.metricsGenerated.addHandler(client_manager.sendDatapoints)
 
     RuleManager.read_from(settings["aggregation-rules"])
     if exists(settings["rewrite-rules"]):
@@ -174,6 +330,9 @@ def createRelayService(config):
     from carbon.conf import settings
     from carbon import events
 
+    if isSupervisor():
+        return createSupervisorService(config)
+
     root_service = createBaseService(config)
 
     # Configure application components
@@ -189,8 +348,8 @@ def createRelayService(config):
     client_manager = CarbonClientManager(router)
     client_manager.setServiceParent(root_service)
 
-    events.metricReceived.addHandler(client_manager.sendDatapoint)
-    events.metricGenerated.addHandler(client_manager.sendDatapoint)
+    events.metricsReceived.addHandler(client_manager.sendDatapoints)
+    events.metricsGenerated.addHandler(client_manager.sendDatapoints)
     events.specialMetricReceived.addHandler(client_manager.sendHighPriorityDatapoint)
     events.specialMetricGenerated.addHandler(client_manager.sendHighPriorityDatapoint)
 
@@ -0,0 +1,103 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import os
+import sys
+import time
+import struct
+from array import array
+
+from carbon import log
+
+
+# A snapshot starts with this line, naming the byte order of the datapoints.
+# Then each metric follows as its name's length and the number of values in
+# its queue, the name, and the queue's interleaved timestamps and values
+# exactly as the MetricCache holds them. A zero length name ends the file.
+SNAPSHOT_MAGIC = 'carbon-cache snapshot 1'
+RECORD_HEADER = struct.Struct('!HI')
+
+
+def dumpCache(cache, path):
+  """Moves every queue in the cache into a snapshot file, emptying the cache
+  as it goes so memory use never grows. The file only replaces path once it
+  is complete. Returns the number of metrics and datapoints written."""
+  metrics = datapoints = 0
+  tmpPath = path + '.tmp'
+  fh = open(tmpPath, 'wb')
+  try:
+    fh.write('%s %s\n' % (SNAPSHOT_MAGIC, sys.byteorder))
+    for shard in cache.shards:
+      for metric in shard.keys():
+        try:
+          queue = shard.popQueue(metric)
+        except KeyError:
+          continue
+        fh.write(RECORD_HEADER.pack(len(metric), len(queue)) + metric)
+        queue.tofile(fh)
+        metrics += 1
+        datapoints += len(queue) // 2
+    fh.write(RECORD_HEADER.pack(0, 0))
+    fh.flush()
+    os.fsync(fh.fileno())
+  finally:
+    fh.close()
+  os.rename(tmpPath, path)
+  return (metrics, datapoints)
+
+
+def loadCache(cache, path):
+  "Stores the content of a snapshot file into the cache, returns (metrics, datapoints)"
+  metrics = datapoints = 0
+  fh = open(path, 'rb')
+  try:
+    header = fh.readline().split()
+    if ' '.join(header[:-1]) != SNAPSHOT_MAGIC:
+      raise Exception("%s is not a carbon-cache snapshot" % path)
+    swap = header[-1] != sys.byteorder
+
+    while True:
+      recordHeader = fh.read(RECORD_HEADER.size)
+      if len(recordHeader) < RECORD_HEADER.size:
+        log.msg("Snapshot %s is incomplete, loaded what it has" % path)
+        break
+      nameLength, valueCount = RECORD_HEADER.unpack(recordHeader)
+      if not nameLength:
+        break
+      metric = fh.read(nameLength)
+      queue = array('d')
+      try:
+        queue.fromfile(fh, valueCount)
+      except EOFError:
+        log.msg("Snapshot %s is incomplete, loaded what it has" % path)
+        break
+      if swap:
+        queue.byteswap()
+      cache.getShard(metric).storeQueue(metric, queue)
+      metrics += 1
+      datapoints += valueCount // 2
+  finally:
+    fh.close()
+  return (metrics, datapoints)
+
+
+def restoreCache(cache, path):
+  "Loads the snapshot left by the last shutdown, if any, then removes it"
+  if not os.path.exists(path):
+    return
+  t = time.time()
+  metrics, datapoints = loadCache(cache, path)
+  os.unlink(path)
+  log.msg("Restored %d datapoints for %d metrics from %s in %.2f seconds" %
+          (datapoints, metrics, path, time.time() - t))
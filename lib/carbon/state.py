@@ -5,4 +5,6 @@ several modules.
 
 metricReceiversPaused = False
 cacheTooFull = False
+writersStopped = False
 connectedMetricReceiverProtocols = set()
+ownsMetric = None  # set for an ingest worker, which only stores its slice of the metrics
@@ -13,11 +13,12 @@ See the License for the specific language governing permissions and
 limitations under the License."""
 
 import os, re
+import time
 import whisper
 
-from os.path import join, exists, sep
+from os.path import join, exists, sep, getmtime
 from carbon.conf import OrderedConfigParser, settings
-from carbon.util import pickle
+from carbon.util import pickle, LRUCache
 from carbon import log
 
 
@@ -25,9 +26,66 @@ STORAGE_SCHEMAS_CONFIG = join(settings.CONF_DIR, 'storage-schemas.conf')
 STORAGE_AGGREGATION_CONFIG = join(settings.CONF_DIR, 'storage-aggregation.conf')
 STORAGE_LISTS_DIR = join(settings.CONF_DIR, 'lists')
 
+pathCache = LRUCache(settings.METRIC_RESOLUTION_CACHE_SIZE)
+
+
 def getFilesystemPath(metric):
-  metric_path = metric.replace('.',sep).lstrip(sep) + '.wsp'
-  return join(settings.LOCAL_DATA_DIR, metric_path)
+  try:
+    return pathCache[metric]
+  except KeyError:
+    metric_path = metric.replace('.',sep).lstrip(sep) + '.wsp'
+    path = pathCache[metric] = join(settings.LOCAL_DATA_DIR, metric_path)
+    return path
+
+
+def getConfigMtime(path):
+  "Returns the modification time of a config file, or None if it is missing"
+  try:
+    return getmtime(path)
+  except OSError:
+    return None
+
+
+class KnownFiles:
+  """An in-memory index of whisper files known to exist, so that the writer
+  only stat()s files it has not seen before. It is seeded by scan() and
+  kept current with add() on create and discard() when a file turns out to
+  be gone."""
+  def __init__(self):
+    self.paths = set()
+
+  def __len__(self):
+    return len(self.paths)
+
+  def exists(self, path):
+    if path in self.paths:
+      return True
+    if exists(path):
+      self.paths.add( intern(path) )
+      return True
+    return False
+
+  def add(self, path):
+    self.paths.add( intern(path) )
+
+  def discard(self, path):
+    self.paths.discard(path)
+
+  def scan(self, root, accept=None):
+    """Indexes every whisper file under root, or with accept only those of
+    the metrics it is true for, meant to be run in a thread"""
+    t = time.time()
+    found = 0
+    prefix = len(join(root, ''))
+    for dirpath, dirnames, filenames in os.walk(root):
+      for filename in filenames:
+        if filename.endswith('.wsp'):
+          path = join(dirpath, filename)
+          if accept is not None and not accept(path[prefix:-4].replace(sep, '.')):
+            continue
+          self.paths.add( intern(path) )
+          found += 1
+    log.msg("Indexed %d whisper files under %s in %.2f seconds" % (found, root, time.time() - t))
 
 
 class Schema:
@@ -37,6 +95,10 @@ class Schema:
   def matches(self, metric):
     return bool( self.test(metric) )
 
+  def refresh(self):
+    "Reloads any external state the schema depends on, returns True if it changed"
+    return False
+
 
 class DefaultSchema(Schema):
 
@@ -81,7 +143,7 @@ class ListSchema(Schema):
       self.mtime = 0
       self.members = frozenset()
 
-  def test(self, metric):
+  def refresh(self):
     if exists(self.path):
       current_mtime = os.stat(self.path).st_mtime
 
@@ -90,7 +152,13 @@ class ListSchema(Schema):
         fh = open(self.path, 'rb')
         self.members = pickle.load(fh)
         fh.close()
+        return True
+
+    return False
 
+  def test(self, metric):
+    # The list file is checked for changes by refresh() when the schemas
+    # are reloaded, not on every match.
     return metric in self.members
 
 
@@ -198,3 +266,6 @@ defaultOptions = {'pattern': '.*', 'retentions': '60s:7d'}
 emptyAggregationOptions = {'pattern': '.*', 'default': 'default'}
 defaultSchema = DefaultSchema('default', [defaultArchive], defaultOptions)
 defaultAggregation = DefaultSchema('default', (None, None), emptyAggregationOptions)
+
+# Ghetto singleton
+KnownFiles = KnownFiles()
@@ -0,0 +1,52 @@
+from twisted.trial.unittest import TestCase
+from carbon import events
+from carbon.aggregator import receiver
+from carbon.aggregator.rules import RuleManager, AggregationRule
+from carbon.aggregator.buffers import BufferManager
+
+
+class FailingRule(AggregationRule):
+
+    def get_aggregate_metric(self, metric_path):
+        if metric_path == "bad":
+            raise ValueError("bad metric")
+        return AggregationRule.get_aggregate_metric(self, metric_path)
+
+
+class ProcessManyTest(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.rules = RuleManager.rules
+        self.handlers = list(events.metricsGenerated.handlers)
+        events.metricsGenerated.handlers[:] = [self.batches.append]
+        RuleManager.rules = [FailingRule("foo.<host>.requests",
+                                         "foo.all.requests", "sum", 60)]
+
+    def tearDown(self):
+        BufferManager.clear()
+        RuleManager.rules = self.rules
+        events.metricsGenerated.handlers[:] = self.handlers
+
+    def test_what_is_not_aggregated_away_is_one_batch(self):
+        receiver.processMany([("foo.a.requests", (60, 1.0)),
+                              ("foo.all.requests", (60, 5.0)),
+                              ("foo.b.requests", (70, 2.0)),
+                              ("bar", (60, 3.0))])
+        self.assertEqual([[("foo.a.requests", (60, 1.0)),
+                           ("foo.b.requests", (70, 2.0)),
+                           ("bar", (60, 3.0))]], self.batches)
+        buffer = BufferManager.get_buffer("foo.all.requests")
+        self.assertEqual([1.0, 5.0, 2.0], buffer.interval_buffers[60].values)
+
+    def test_all_aggregated_away_generates_nothing(self):
+        receiver.processMany([("foo.all.requests", (60, 5.0))])
+        self.assertEqual([], self.batches)
+
+    def test_failing_datapoint_is_skipped(self):
+        receiver.processMany([("foo.a.requests", (60, 1.0)),
+                              ("bad", (60, 2.0)),
+                              ("bar", (60, 3.0))])
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual([[("foo.a.requests", (60, 1.0)),
+                           ("bar", (60, 3.0))]], self.batches)
@@ -0,0 +1,44 @@
+import struct
+from unittest import TestCase
+from carbon.binary import NameTableEncoder, NameTableDecoder
+
+
+class NameTableTest(TestCase):
+
+    def setUp(self):
+        self.encoder = NameTableEncoder(4)
+        self.decoder = NameTableDecoder(4)
+
+    def roundTrip(self, datapoints):
+        return self.decoder.decode(self.encoder.encode(datapoints))
+
+    def test_round_trip(self):
+        datapoints = [("foo", (1, 1.5)), ("bar", (2.0, -3)), ("foo", (3, 1e300))]
+        self.assertEqual([("foo", (1.0, 1.5)), ("bar", (2.0, -3.0)),
+                          ("foo", (3.0, 1e300))], self.roundTrip(datapoints))
+
+    def test_network_byte_order(self):
+        data = self.encoder.encode([("foo", (1, 2.5))])
+        self.assertEqual(struct.pack("!BIIH3sIdd", 0, 1, 1, 3, "foo", 0, 1, 2.5), data)
+
+    def test_names_are_sent_once(self):
+        first = self.encoder.encode([("foo.bar.baz", (1, 1.0))])
+        second = self.encoder.encode([("foo.bar.baz", (2, 2.0))])
+        self.assertEqual(len("foo.bar.baz") + 2, len(first) - len(second))
+        self.decoder.decode(first)
+        self.assertEqual([("foo.bar.baz", (2.0, 2.0))], self.decoder.decode(second))
+
+    def test_table_starts_over_when_full(self):
+        for i in range(10):
+            datapoints = [("metric.%d" % i, (i, 1.0)), ("metric.%d" % (i + 1), (i, 2.0))]
+            self.assertEqual(datapoints, self.roundTrip(datapoints))
+        self.assertTrue(len(self.decoder.names) <= 4)
+
+    def test_malformed_messages(self):
+        data = self.encoder.encode([("foo", (1, 1.0))])
+        self.assertRaises(ValueError, NameTableDecoder(4).decode, data[:-1])
+        self.assertRaises(ValueError, NameTableDecoder(4).decode, data[:5])
+        self.assertRaises(ValueError, NameTableDecoder(0).decode, data)
+        # Refers to the name sent before, which this decoder never saw
+        data = self.encoder.encode([("foo", (1, 1.0))])
+        self.assertRaises(ValueError, NameTableDecoder(4).decode, data)
@@ -0,0 +1,168 @@
+from unittest import TestCase
+from carbon.cache import MetricCache, encodeDatapoints, decodeDatapoints
+from carbon import conf
+
+
+class MetricCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = MetricCache.__class__(shardCount=4)
+
+    def test_store_and_pop(self):
+        """Datapoints come back from pop() in the order they were stored."""
+        self.cache.store("foo.bar", (1, 1.0))
+        self.cache.store("foo.bar", (2, 2.0))
+        self.assertEqual([(1, 1.0), (2, 2.0)], self.cache.pop("foo.bar"))
+        self.assertFalse(self.cache)
+
+    def test_store_many_spans_shards(self):
+        self.cache.storeMany([("metric.%d" % (i % 10), (i, float(i)))
+                              for i in range(100)])
+        self.assertEqual(100, self.cache.size)
+        self.assertEqual(10, len(self.cache))
+        self.assertEqual([(3, 3.0), (13, 13.0)],
+                         self.cache.pop("metric.3")[:2])
+
+    def test_pop_missing_metric_raises(self):
+        self.assertRaises(KeyError, self.cache.pop, "foo.bar")
+
+    def test_size_spans_shards(self):
+        """The size and length of the cache are totals over every shard."""
+        for i in range(100):
+            self.cache.store("metric.%d" % i, (i, float(i)))
+        self.cache.store("metric.0", (1, 1.0))
+        self.assertEqual(101, self.cache.size)
+        self.assertEqual(100, len(self.cache))
+        self.assertEqual(101, sum([shard.size for shard in self.cache.shards]))
+
+    def test_metric_lives_in_one_shard(self):
+        self.cache.store("foo.bar", (1, 1.0))
+        shard = self.cache.getShard("foo.bar")
+        self.assertTrue("foo.bar" in shard)
+        self.assertEqual(1, sum([len(s) for s in self.cache.shards]))
+
+    def test_counts(self):
+        self.cache.store("foo", (1, 1.0))
+        self.cache.store("foo", (2, 1.0))
+        self.cache.store("bar", (1, 1.0))
+        self.assertEqual([("bar", 1), ("foo", 2)], sorted(self.cache.counts()))
+
+    def test_reshard_only_when_empty(self):
+        self.cache.setShardCount(8)
+        self.assertEqual(8, len(self.cache.shards))
+        self.cache.store("foo", (1, 1.0))
+        self.assertRaises(Exception, self.cache.setShardCount, 2)
+
+    def test_get_returns_datapoint_tuples(self):
+        """Queued datapoints are handed out as (timestamp, value) tuples."""
+        self.cache.store("foo", (1, 2.5))
+        self.assertEqual([(1.0, 2.5)], self.cache.get("foo"))
+        self.assertEqual([], self.cache.get("bar", []))
+
+    def _fill_for_write_order(self):
+        for metric, count in (("small", 1), ("large", 5), ("medium", 3)):
+            for i in range(count):
+                self.cache.store(metric, (i, 1.0))
+
+    def test_max_strategy_writes_largest_queue_first(self):
+        self.cache = MetricCache.__class__(shardCount=1, writeStrategy='max')
+        self._fill_for_write_order()
+        shard = self.cache.shards[0]
+        order = []
+        for metric in shard.writeOrder():
+            order.append(metric)
+            shard.pop(metric)
+        self.assertEqual(["large", "medium", "small"], order)
+        self.assertEqual({}, shard.buckets)
+
+    def test_max_strategy_follows_new_datapoints(self):
+        """The index reflects datapoints stored after a pass has started."""
+        self.cache = MetricCache.__class__(shardCount=1, writeStrategy='max')
+        self._fill_for_write_order()
+        shard = self.cache.shards[0]
+        shard.pop("large")
+        for i in range(10):
+            self.cache.store("small", (i, 1.0))
+        self.assertEqual("small", shard.largestQueue())
+
+    def test_sorted_strategy_writes_largest_queue_first(self):
+        self.cache = MetricCache.__class__(shardCount=1, writeStrategy='sorted')
+        self._fill_for_write_order()
+        self.assertEqual(["large", "medium", "small"],
+                         list(self.cache.shards[0].writeOrder()))
+
+    def test_invalid_write_strategy(self):
+        self.assertRaises(Exception, self.cache.setWriteStrategy, "bogus")
+
+    def _bounded_latency_order(self, maxWriteLatency):
+        self.cache = MetricCache.__class__(shardCount=1,
+                                           writeStrategy='bounded-latency')
+        self.cache.store("rare", (1, 1.0))
+        for i in range(5):
+            self.cache.store("busy", (i, 1.0))
+        original = conf.settings.MAX_WRITE_LATENCY
+        conf.settings["MAX_WRITE_LATENCY"] = maxWriteLatency
+        try:
+            shard = self.cache.shards[0]
+            order = []
+            for metric in shard.writeOrder():
+                order.append(metric)
+                shard.pop(metric)
+            return order
+        finally:
+            conf.settings["MAX_WRITE_LATENCY"] = original
+
+    def test_bounded_latency_writes_overdue_queues_first(self):
+        self.assertEqual(["rare", "busy"], self._bounded_latency_order(0))
+
+    def test_bounded_latency_falls_back_to_largest_queue(self):
+        self.assertEqual(["busy", "rare"], self._bounded_latency_order(3600))
+
+    def test_oldest_age(self):
+        self.assertEqual(0.0, self.cache.oldestAge())
+        self.cache.store("foo", (1, 1.0))
+        shard = self.cache.getShard("foo")
+        arrival, metric = shard.oldestQueue()
+        self.assertEqual("foo", metric)
+        self.assertTrue(self.cache.oldestAge() >= 0.0)
+        self.cache.pop("foo")
+        self.assertEqual(None, shard.oldestQueue())
+
+    def _assert_parking(self, writeStrategy):
+        self.cache = MetricCache.__class__(shardCount=1, writeStrategy=writeStrategy)
+        self._fill_for_write_order()
+        shard = self.cache.shards[0]
+        self.assertTrue(shard.park("large"))
+        self.assertFalse(shard.park("large"))
+        self.cache.store("large", (10, 1.0))
+        written = []
+        for metric in shard.writeOrder():
+            written.append( (metric, len(shard.pop(metric))) )
+        self.assertEqual([("medium", 3), ("small", 1)], written)
+        self.assertEqual(6, self.cache.size)
+        shard.unpark("large")
+        self.assertEqual(["large"], list(shard.writeOrder())[:1])
+        self.assertEqual(6, len(self.cache.pop("large")))
+
+    def test_parked_metrics_keep_datapoints_out_of_write_order(self):
+        for writeStrategy in ('sorted', 'max', 'bounded-latency'):
+            self._assert_parking(writeStrategy)
+
+    def test_pop_parked_metric(self):
+        shard = self.cache.getShard("foo")
+        self.cache.store("foo", (1, 1.0))
+        shard.park("foo")
+        self.assertEqual([(1.0, 1.0)], self.cache.pop("foo"))
+        self.assertEqual(set(), shard.parked)
+        self.assertEqual(0, self.cache.size)
+
+    def test_get_ranges_of_many_metrics(self):
+        for i in range(10):
+            self.cache.store("foo", (i, float(i)))
+        self.cache.store("bar", (1, 1.0))
+        ranges = self.cache.getRanges(["foo", "bar", "baz"], 3, 5)
+        self.assertEqual(["foo"], list(ranges))
+        self.assertEqual([(3.0, 3.0), (4.0, 4.0), (5.0, 5.0)],
+                         decodeDatapoints(encodeDatapoints(ranges["foo"])))
+        self.assertEqual(10, len(self.cache.getRanges(["foo"])["foo"]) // 2)
+        self.assertEqual(11, self.cache.size)
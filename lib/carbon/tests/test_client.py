@@ -0,0 +1,59 @@
+from twisted.trial.unittest import TestCase
+from carbon.client import CarbonClientManager
+
+A = ("127.0.0.1", 2004, "a")
+B = ("127.0.0.1", 2104, "b")
+
+
+class FakeRouter(object):
+    "Routes foo.* to A, bar.* to B and everything else to both"
+
+    def getDestinations(self, metric):
+        if metric == "bad":
+            raise ValueError("bad metric")
+        if not metric.startswith("bar."):
+            yield A
+        if not metric.startswith("foo."):
+            yield B
+
+
+class FakeFactory(object):
+
+    def __init__(self, failing=False):
+        self.failing = failing
+        self.sent = []
+
+    def sendDatapoints(self, datapoints):
+        if self.failing:
+            raise IOError("Broken pipe")
+        self.sent.append(datapoints)
+
+
+class SendDatapointsTest(TestCase):
+
+    def setUp(self):
+        self.manager = CarbonClientManager(FakeRouter())
+        self.manager.client_factories = {A: FakeFactory(), B: FakeFactory()}
+
+    def test_one_send_per_destination(self):
+        self.manager.sendDatapoints([("foo.1", (1, 1.0)), ("bar.1", (1, 2.0)),
+                                     ("foo.2", (1, 3.0)), ("baz", (1, 4.0))])
+        self.assertEqual([[("foo.1", (1, 1.0)), ("foo.2", (1, 3.0)),
+                           ("baz", (1, 4.0))]],
+                         self.manager.client_factories[A].sent)
+        self.assertEqual([[("bar.1", (1, 2.0)), ("baz", (1, 4.0))]],
+                         self.manager.client_factories[B].sent)
+
+    def test_unroutable_datapoint_is_skipped(self):
+        self.manager.sendDatapoints([("foo.1", (1, 1.0)), ("bad", (1, 2.0)),
+                                     ("foo.2", (1, 3.0))])
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual([[("foo.1", (1, 1.0)), ("foo.2", (1, 3.0))]],
+                         self.manager.client_factories[A].sent)
+
+    def test_failing_destination_does_not_stop_the_others(self):
+        self.manager.client_factories[A].failing = True
+        self.manager.sendDatapoints([("foo.1", (1, 1.0)), ("baz", (1, 4.0))])
+        self.assertEqual(1, len(self.flushLoggedErrors(IOError)))
+        self.assertEqual([[("baz", (1, 4.0))]],
+                         self.manager.client_factories[B].sent)
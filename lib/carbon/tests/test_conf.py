@@ -337,6 +337,32 @@ class ReadConfigTest(MockerTestCase):
             ROOT_DIR="foo")
         self.assertEqual("baz", settings.LOG_DIR)
 
+    def test_worker_gets_its_share_of_the_limits(self):
+        """
+        The limits protecting the host are shared out between the ingest
+        workers, so together they stay within the configured ones.
+        """
+        config = self.makeFile(
+            content=("[foo]\nINGEST_PROCESSES = 4\n"
+                     "MAX_CACHE_SIZE = 1000000\nMAX_UPDATES_PER_SECOND = 500\n"
+                     "MAX_CREATES_PER_MINUTE = 50\n"))
+        settings = read_config(
+            "carbon-foo",
+            FakeOptions(config=config, instance=None, worker="1",
+                        pidfile=None, logdir=None),
+            ROOT_DIR="foo")
+        self.assertEqual(250000, settings.MAX_CACHE_SIZE)
+        self.assertEqual(125, settings.MAX_UPDATES_PER_SECOND)
+        self.assertEqual(12.5, settings.MAX_CREATES_PER_MINUTE)
+
+        settings = read_config(
+            "carbon-foo",
+            FakeOptions(config=config, instance=None,
+                        pidfile=None, logdir=None),
+            ROOT_DIR="foo")
+        self.assertEqual(1000000, settings.MAX_CACHE_SIZE)
+        self.assertEqual(500, settings.MAX_UPDATES_PER_SECOND)
+
     def test_log_dir_from_instance_config(self):
         """
         Providing a 'LOG_DIR' for the specific instance in the configuration
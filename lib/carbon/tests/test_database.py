@@ -0,0 +1,139 @@
+import os
+import time
+import shutil
+import tempfile
+from os.path import dirname, join
+from unittest import TestCase
+from carbon import conf
+
+# Where carbon.storage looks for its configuration, which is never read here
+conf.settings.setdefault("CONF_DIR", dirname(__file__))
+from carbon import database, storage
+
+
+class DatabaseTests(object):
+    """The TimeSeriesDatabase methods the writer, management handlers and
+    carbon-reader use, against a backend in a temporary LOCAL_DATA_DIR."""
+    backend = None
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.settings = dict(conf.settings)
+        conf.settings["LOCAL_DATA_DIR"] = self.tmpDir
+        storage.pathCache.clear()
+        storage.KnownFiles.paths.clear()
+        self.database = self.backend()
+        now = int(time.time())
+        self.start = now - now % 10 - 50
+        self.datapoints = [(self.start, 1.5), (self.start + 10, 2.0),
+                           (self.start + 30, -3.0)]
+
+    def tearDown(self):
+        conf.settings.clear()
+        conf.settings.update(self.settings)
+        storage.pathCache.clear()
+        storage.KnownFiles.paths.clear()
+        shutil.rmtree(self.tmpDir)
+
+    def create(self, metric):
+        self.database.create(metric, [(10, 60), (60, 60)], 0.5, "average")
+
+    def fetch(self, metric):
+        return self.database.fetch(metric, self.start - 10, time.time())
+
+    def test_create_and_exists(self):
+        self.assertFalse(self.database.exists("foo.bar"))
+        self.create("foo.bar")
+        self.assertTrue(self.database.exists("foo.bar"))
+        self.assertEqual(set(["foo.bar"]),
+                         self.database.existsMany(["foo.bar", "foo.baz"]))
+
+    def test_create_twice(self):
+        self.create("foo.bar")
+        self.database.write("foo.bar", self.datapoints)
+        self.create("foo.bar")
+        self.assertEqual(1.5, self.fetch("foo.bar")[1][0])
+
+    def test_write_then_fetch(self):
+        self.create("foo.bar")
+        self.database.write("foo.bar", self.datapoints[:1])
+        self.database.write("foo.bar", self.datapoints[1:])
+        (fromInterval, untilInterval, step), values = self.fetch("foo.bar")
+        self.assertEqual((self.start, 10), (fromInterval, step))
+        self.assertEqual([1.5, 2.0, None, -3.0], values[:4])
+
+    def test_write_many_reports_each_metric(self):
+        self.create("foo.bar")
+        results = self.database.writeMany({"foo.bar": self.datapoints,
+                                           "no.such": self.datapoints})
+        self.assertEqual(None, results["foo.bar"][1])
+        self.assertTrue(results["no.such"][1])
+
+    def test_metadata(self):
+        self.create("foo.bar")
+        self.assertTrue("aggregationMethod" in self.database.metadataKeys)
+        self.assertEqual("average",
+                         self.database.getMetadata("foo.bar", "aggregationMethod"))
+        self.assertEqual("average",
+                         self.database.setMetadata("foo.bar", "aggregationMethod", "max"))
+        self.assertEqual("max",
+                         self.database.getMetadata("foo.bar", "aggregationMethod"))
+
+
+class WhisperDatabaseTest(DatabaseTests, TestCase):
+    backend = database.WhisperDatabase
+
+    def test_archives(self):
+        self.create("foo.bar")
+        self.assertEqual([(10, 600), (60, 3600)],
+                         self.database.getArchives("foo.bar"))
+
+    def test_start_indexes_existing_files(self):
+        self.create("foo.bar")
+        self.create("foo.baz")
+        storage.KnownFiles.paths.clear()
+        self.database.start()
+        self.assertEqual(2, len(storage.KnownFiles))
+
+    def test_removed_file_is_noticed_once_invalidated(self):
+        self.create("foo.bar")
+        os.unlink(join(self.tmpDir, "foo", "bar.wsp"))
+        self.assertTrue(self.database.exists("foo.bar"))
+        self.database.invalidate("foo.bar")
+        self.assertFalse(self.database.exists("foo.bar"))
+
+    def test_fetch_of_a_coarser_archive(self):
+        self.create("foo.bar")
+        self.database.write("foo.bar", self.datapoints)
+        timeInfo, values = self.database.fetch("foo.bar", self.start - 600,
+                                               time.time(), 60)
+        self.assertEqual(60, timeInfo[2])
+        self.assertRaises(ValueError, self.database.fetch, "foo.bar",
+                          self.start, time.time(), 30)
+
+
+class AppendOnlyDatabaseTest(DatabaseTests, TestCase):
+    backend = database.AppendOnlyDatabase
+
+    def test_archives(self):
+        # Everything is kept at the resolution of the first archive
+        self.create("foo.bar")
+        self.assertEqual([(10, 3600)], self.database.getArchives("foo.bar"))
+
+    def test_other_metadata(self):
+        self.create("foo.bar")
+        self.assertEqual(0.5, self.database.getMetadata("foo.bar", "xFilesFactor"))
+        self.assertEqual([(10, 60), (60, 60)],
+                         self.database.getMetadata("foo.bar", "archiveConfig"))
+
+
+class LoadDatabaseTest(TestCase):
+
+    def test_backends_by_name(self):
+        self.assertTrue(isinstance(database.loadDatabase("whisper"),
+                                   database.WhisperDatabase))
+        self.assertTrue(isinstance(database.loadDatabase("append"),
+                                   database.AppendOnlyDatabase))
+
+    def test_unknown_backend(self):
+        self.assertRaises(Exception, database.loadDatabase, "rrd")
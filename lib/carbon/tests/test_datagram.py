@@ -0,0 +1,93 @@
+import os
+import socket
+import shutil
+import tempfile
+from unittest import TestCase
+from twisted.internet.protocol import DatagramProtocol
+from carbon import datagram
+from carbon.datagram import MetricDatagramPort, readSocketDrops, kernelDrops
+
+
+PROC_NET_UDP = """\
+   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  123: 0100007F:07D3 00000000:0000 07 00000000:00000000 00:00000000 00000000  1000        0 18211 2 ffff88003a7f8000 %d
+  124: 00000000:0035 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 18342 2 ffff88003a7f8400 7
+"""
+
+
+class BatchingProtocol(DatagramProtocol):
+
+    def __init__(self):
+        self.batches = []
+
+    def datagramsReceived(self, datagrams):
+        self.batches.append(datagrams)
+
+
+class MetricDatagramPortTest(TestCase):
+
+    def setUp(self):
+        self.protocol = BatchingProtocol()
+        self.port = MetricDatagramPort(0, self.protocol, interface="127.0.0.1",
+                                       bufferSize=4096)
+        self.port.startListening()
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sender.close()
+        self.port.stopReading()
+        self.port.connectionLost()
+
+    def test_drains_waiting_datagrams_in_one_batch(self):
+        address = ("127.0.0.1", self.port.getHost().port)
+        for i in range(200):
+            self.sender.sendto("metric.%d 1 1\n" % i * 20, address)
+        self.port.doRead()
+
+        self.assertEqual(1, len(self.protocol.batches))
+        received = len(self.protocol.batches[0])
+        self.assertTrue(0 < received <= 200)
+        # What the kernel counts also depends on the host, the drops of
+        # this socket can only be at least those seen here
+        drops = kernelDrops()
+        if drops is not None:
+            self.assertTrue(drops >= 200 - received)
+
+
+class KernelDropsTest(TestCase):
+    """Drop counts read from a fixed /proc/net/udp, as the live counters
+    depend on the host."""
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.procNetUdp = datagram.PROC_NET_UDP
+        datagram.PROC_NET_UDP = (os.path.join(self.tmpDir, "udp"),
+                                 os.path.join(self.tmpDir, "udp6"))
+        self.port = MetricDatagramPort(0, BatchingProtocol())
+        self.port.inode = 18211
+        datagram.listeningPorts.add(self.port)
+
+    def tearDown(self):
+        datagram.listeningPorts.discard(self.port)
+        datagram.PROC_NET_UDP = self.procNetUdp
+        shutil.rmtree(self.tmpDir)
+
+    def writeDrops(self, drops):
+        procFile = open(datagram.PROC_NET_UDP[0], "w")
+        procFile.write(PROC_NET_UDP % drops)
+        procFile.close()
+
+    def test_reads_drops_of_the_given_sockets(self):
+        self.writeDrops(35)
+        self.assertEqual({18211: 35, 18342: 7}, readSocketDrops(set([18211, 18342])))
+        self.assertEqual({18342: 7}, readSocketDrops(set([18342, 99999])))
+
+    def test_drops_since_the_last_call(self):
+        self.writeDrops(35)
+        self.assertEqual(35, kernelDrops())
+        self.assertEqual(0, kernelDrops())
+        self.writeDrops(50)
+        self.assertEqual(15, kernelDrops())
+
+    def test_no_drop_counts(self):
+        self.assertEqual(None, kernelDrops())
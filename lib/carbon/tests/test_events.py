@@ -0,0 +1,38 @@
+from twisted.trial.unittest import TestCase
+from carbon.events import BatchEvent, DatapointEvent
+
+
+class BatchEventTest(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.datapoints = []
+        self.batchEvent = BatchEvent('metricsTested')
+        self.datapointEvent = DatapointEvent('metricTested', self.batchEvent)
+
+    def test_batch_reaches_both_kinds_of_handler(self):
+        self.batchEvent.addHandler(self.batches.append)
+        self.datapointEvent.addHandler(
+            lambda metric, datapoint: self.datapoints.append((metric, datapoint)))
+        batch = [("foo", (1, 1.0)), ("bar", (1, 2.0))]
+        self.batchEvent(batch)
+        self.assertEqual([batch], self.batches)
+        self.assertEqual(batch, self.datapoints)
+
+    def test_datapoint_is_a_batch_of_one(self):
+        self.batchEvent.addHandler(self.batches.append)
+        self.datapointEvent("foo", (1, 1.0))
+        self.assertEqual([[("foo", (1, 1.0))]], self.batches)
+
+    def test_failing_handler_does_not_stop_the_others(self):
+        def fail(datapoints):
+            raise ValueError("bad batch")
+        self.batchEvent.addHandler(fail)
+        self.batchEvent.addHandler(self.batches.append)
+        self.datapointEvent.addHandler(
+            lambda metric, datapoint: self.datapoints.append((metric, datapoint)))
+        batch = [("foo", (1, 1.0)), ("bar", (1, 2.0))]
+        self.batchEvent(batch)
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual([batch], self.batches)
+        self.assertEqual(batch, self.datapoints)
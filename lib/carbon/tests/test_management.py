@@ -0,0 +1,41 @@
+from os.path import dirname
+from unittest import TestCase
+from twisted.internet import defer
+from carbon import conf
+
+# Where carbon.storage looks for its configuration, which is never read here
+conf.settings.setdefault("CONF_DIR", dirname(__file__))
+from carbon import management
+
+
+class DeferForMetricTest(TestCase):
+
+    def setUp(self):
+        self.started = []  # (args, Deferred) of every call handed to the thread pool
+        self.deferToThreadPool = management.deferToThreadPool
+        management.deferToThreadPool = self.fakeDeferToThreadPool
+
+    def tearDown(self):
+        management.deferToThreadPool = self.deferToThreadPool
+        management.pendingByMetric.clear()
+
+    def fakeDeferToThreadPool(self, f, *args):
+        d = defer.Deferred()
+        self.started.append((args, d))
+        return d
+
+    def test_requests_for_a_metric_run_in_order_with_their_own_results(self):
+        results = []
+        for i in range(3):
+            d = management.deferForMetric("foo", None, i)
+            d.addCallbacks(results.append, lambda f: results.append(f.getErrorMessage()))
+        bar = management.deferForMetric("bar", None, "bar")
+        self.assertEqual([(0,), ("bar",)], [args for (args, d) in self.started])
+
+        self.started[0][1].errback(ValueError("first"))
+        self.assertEqual(["first"], results)
+        self.assertEqual((1,), self.started[2][0])
+        self.started[2][1].callback("second")
+        self.started[3][1].callback("third")
+        self.assertEqual(["first", "second", "third"], results)
+        self.assertEqual(["bar"], management.pendingByMetric.keys())
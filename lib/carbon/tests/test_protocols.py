@@ -0,0 +1,212 @@
+import os
+import struct
+import shutil
+import tempfile
+import zlib
+from os.path import dirname
+from twisted.trial.unittest import TestCase
+from twisted.test.proto_helpers import StringTransport
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.python.failure import Failure
+from carbon import conf
+from carbon.util import pickle
+
+# Where carbon.storage looks for its configuration, which is never read here
+conf.settings.setdefault("CONF_DIR", dirname(__file__))
+from carbon.protocols import (QueryHandler, MetricLineReceiver,
+                              MetricCompressedLineReceiver,
+                              MetricCompressedPickleReceiver)
+from carbon.client import SpoolingCarbonClientFactory
+
+
+class QueryHandlerTest(TestCase):
+
+    def setUp(self):
+        self.transport = StringTransport()
+        self.handler = QueryHandler()
+        self.handler.makeConnection(self.transport)
+
+    def responses(self):
+        data = self.transport.value()
+        responses = []
+        while data:
+            (length,) = struct.unpack("!I", data[:4])
+            responses.append(pickle.loads(data[4:4 + length]))
+            data = data[4 + length:]
+        return responses
+
+    def test_unpicklable_result_does_not_stop_later_responses(self):
+        self.handler.respond(dict(value=lambda: None))
+        self.handler.respond(dict(value=1))
+        self.flushLoggedErrors()
+
+        failed, answered = self.responses()
+        self.assertTrue("error" in failed)
+        self.assertEqual(dict(value=1), answered)
+        self.assertEqual(0, self.handler.pendingResponses)
+        self.assertTrue(self.transport.connected)
+
+
+class ReceiverTestCase(TestCase):
+    """Connects a receiver to a StringTransport, and records the batches it
+    parses rather than dispatching them."""
+    receiverClass = None
+
+    def setUp(self):
+        self.batches = []
+        self.transport = StringTransport()
+        self.receiver = self.receiverClass()
+        self.receiver.metricsReceived = self.batches.append
+        self.receiver.makeConnection(self.transport)
+
+    def tearDown(self):
+        self.receiver.connectionLost(Failure(ConnectionDone()))
+
+    def received(self):
+        "Every datapoint parsed, in order"
+        datapoints = []
+        for batch in self.batches:
+            datapoints.extend(batch)
+        return datapoints
+
+    def feed(self, data, chunkSize):
+        for i in range(0, len(data), chunkSize):
+            self.receiver.dataReceived(data[i:i + chunkSize])
+
+
+class MetricLineReceiverTest(ReceiverTestCase):
+    receiverClass = MetricLineReceiver
+
+    def test_several_lines_in_one_chunk_are_one_batch(self):
+        self.receiver.dataReceived("foo 1 10\nbar 2.5 20\n")
+        self.assertEqual([[("foo", (10.0, 1.0)), ("bar", (20.0, 2.5))]],
+                         self.batches)
+
+    def test_line_split_across_chunks(self):
+        self.receiver.dataReceived("foo 1 1")
+        self.assertEqual([], self.batches)
+        self.receiver.dataReceived("0\nbar 2 20\n")
+        self.assertEqual([[("foo", (10.0, 1.0)), ("bar", (20.0, 2.0))]],
+                         self.batches)
+
+    def test_trailing_partial_line_is_held_over(self):
+        self.receiver.dataReceived("foo 1 10\nbar 2")
+        self.assertEqual([[("foo", (10.0, 1.0))]], self.batches)
+        self.receiver.dataReceived(" 20\n")
+        self.assertEqual([("bar", (20.0, 2.0))], self.batches[-1])
+
+    def test_malformed_lines_are_skipped(self):
+        self.receiver.dataReceived("foo 1\nbar x 20\nbaz 3 30\n\n")
+        self.assertEqual([[("baz", (30.0, 3.0))]], self.batches)
+
+    def test_oversized_line_drops_the_connection(self):
+        tooLong = "foo " + "1" * self.receiver.MAX_LENGTH + " 10"
+        result = self.receiver.dataReceived("bar 2 20\n%s\nbaz 3 30\n" % tooLong)
+        self.assertTrue(isinstance(result, ConnectionLost))
+        self.assertEqual([[("bar", (20.0, 2.0))]], self.batches)
+
+    def test_oversized_partial_line_drops_the_connection(self):
+        self.receiver.dataReceived("foo ")
+        result = self.receiver.dataReceived("1" * self.receiver.MAX_LENGTH)
+        self.assertTrue(isinstance(result, ConnectionLost))
+
+
+DATAPOINTS = [("foo.%d" % i, (1000000.0 + i, i * 0.5)) for i in range(500)]
+LINES = "".join(["%s %r %r\n" % (metric, value, timestamp)
+                 for (metric, (timestamp, value)) in DATAPOINTS])
+
+
+class MetricCompressedLineReceiverTest(ReceiverTestCase):
+    receiverClass = MetricCompressedLineReceiver
+
+    def test_stream_in_arbitrary_chunks(self):
+        data = zlib.compress(LINES)
+        for chunkSize in (1, 7, 4096):
+            del self.batches[:]
+            self.feed(data, chunkSize)
+            self.assertEqual(DATAPOINTS, self.received())
+
+    def test_stream_decompressing_past_max_chunk_size(self):
+        self.receiver.maxChunkSize = 100
+        self.receiver.dataReceived(zlib.compress(LINES))
+        self.assertEqual(DATAPOINTS, self.received())
+        self.assertTrue(len(self.batches) >= len(LINES) / 100)
+
+    def test_streams_one_after_the_other(self):
+        half = LINES.index("foo.250 ")
+        self.receiver.dataReceived(zlib.compress(LINES[:half]) +
+                                   zlib.compress(LINES[half:]))
+        self.assertEqual(DATAPOINTS, self.received())
+
+    def test_corrupt_stream_drops_the_connection(self):
+        data = zlib.compress(LINES)
+        self.receiver.dataReceived(data[:50])
+        self.receiver.dataReceived("\xff" * 50 + data[100:])
+        self.assertTrue(self.transport.disconnecting)
+        parsed = self.received()
+        self.assertEqual(DATAPOINTS[:len(parsed)], parsed)
+
+    def test_oversized_line_drops_the_connection(self):
+        tooLong = "foo " + "1" * self.receiver.MAX_LENGTH + " 10\n"
+        result = self.receiver.dataReceived(zlib.compress(tooLong + LINES))
+        self.assertTrue(isinstance(result, ConnectionLost))
+        self.assertEqual([], self.received())
+
+
+class MetricCompressedPickleReceiverTest(ReceiverTestCase):
+    receiverClass = MetricCompressedPickleReceiver
+
+    def messages(self):
+        data = ""
+        for i in range(0, len(DATAPOINTS), 100):
+            message = pickle.dumps(DATAPOINTS[i:i + 100], protocol=-1)
+            data += struct.pack("!I", len(message)) + message
+        return data
+
+    def test_stream_in_arbitrary_chunks(self):
+        self.feed(zlib.compress(self.messages()), 5)
+        self.assertEqual(DATAPOINTS, self.received())
+        self.assertEqual(5, len(self.batches))
+
+    def test_stream_decompressing_past_max_chunk_size(self):
+        self.receiver.maxChunkSize = 100
+        self.receiver.dataReceived(zlib.compress(self.messages()))
+        self.assertEqual(DATAPOINTS, self.received())
+
+    def test_corrupt_stream_drops_the_connection(self):
+        self.receiver.dataReceived("not a zlib stream")
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual([], self.batches)
+
+
+class SpoolFileTest(ReceiverTestCase):
+    """A zlib-line spool file as the client writes it, sent as it is."""
+    receiverClass = MetricCompressedLineReceiver
+
+    def setUp(self):
+        ReceiverTestCase.setUp(self)
+        self.settings = dict(conf.settings)
+        self.tmpDir = tempfile.mkdtemp()
+        conf.settings.update(SPOOLING_PATH=self.tmpDir, SPOOL_FORMAT="zlib-line")
+        for spoolDir in ("temp", "send"):
+            os.makedirs(os.path.join(self.tmpDir, spoolDir, "127.0.0.1:2004"))
+
+    def tearDown(self):
+        ReceiverTestCase.tearDown(self)
+        conf.settings.clear()
+        conf.settings.update(self.settings)
+        shutil.rmtree(self.tmpDir)
+
+    def test_spool_file_round_trip(self):
+        factory = SpoolingCarbonClientFactory(("127.0.0.1", 2004, None), "spool")
+        for i in range(0, len(DATAPOINTS), 100):
+            factory.spool(DATAPOINTS[i:i + 100])
+        factory.set_next_flush_time(factory.next_flush_time + 1)
+        factory.open_next_queue_file()
+        factory.queue_file.close()
+
+        [spoolFile] = os.listdir(factory.send_queue_dir)
+        self.assertTrue(spoolFile.endswith(".zline"))
+        data = open(os.path.join(factory.send_queue_dir, spoolFile), "rb").read()
+        self.feed(data, 1000)
+        self.assertEqual(DATAPOINTS, self.received())
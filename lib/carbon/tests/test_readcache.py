@@ -0,0 +1,146 @@
+from unittest import TestCase
+from carbon.readcache import ReadCache, rangeWidth
+from carbon import conf
+
+
+NOW = 1000000
+
+
+class FakeDatabase(object):
+    """Serves fetches like whisper.fetch() would at NOW, from a dict of
+    { metric : { interval : value } } of the finest archive, averaged into
+    the coarser one."""
+    archives = [(10, 600), (60, 3600)]
+
+    def __init__(self):
+        self.points = {}
+        self.fetches = []
+
+    def getArchives(self, metric):
+        return self.archives
+
+    def fetch(self, metric, fromTime, untilTime, secondsPerPoint=None):
+        self.fetches.append((metric, fromTime, untilTime))
+        if secondsPerPoint is None:
+            fromTime = max(fromTime, NOW - self.archives[-1][1])
+            untilTime = min(untilTime, NOW)
+            for step, retention in self.archives:
+                if retention >= NOW - fromTime:
+                    break
+        else:
+            step = secondsPerPoint
+        fromInterval = fromTime - (fromTime % step) + step
+        untilInterval = untilTime - (untilTime % step) + step
+        if fromInterval == untilInterval:
+            untilInterval += step
+        points = self.points.get(metric, {})
+        values = []
+        for interval in range(fromInterval, untilInterval, step):
+            known = [points[t] for t in range(interval, interval + step, 10)
+                     if t in points]
+            if known:
+                values.append(sum(known) / len(known))
+            else:
+                values.append(None)
+        return ((fromInterval, untilInterval, step), values)
+
+
+class RangeWidthTest(TestCase):
+
+    def test_rounds_up_to_a_power_of_two(self):
+        self.assertEqual([1, 1, 2, 4, 4, 8, 1024, 2048],
+                         [rangeWidth(s) for s in (0, 1, 2, 3, 4, 5, 1024, 1025)])
+
+
+class ReadCacheTest(TestCase):
+
+    def setUp(self):
+        self.database = FakeDatabase()
+        self.cache = ReadCache.__class__(self.database)
+        for t in range(NOW - 3600, NOW, 10):
+            self.database.points.setdefault('foo', {})[t - t % 10] = float(t)
+
+    def test_read_through_then_served_from_memory(self):
+        expected = self.database.fetch('foo', NOW - 300, NOW)
+        del self.database.fetches[:]
+        self.assertEqual(expected, self.cache.query('foo', NOW - 300, now=NOW))
+        self.assertEqual(1, len(self.database.fetches))
+        self.assertEqual(expected, self.cache.query('foo', NOW - 300, now=NOW))
+        self.assertEqual(expected[1][-10:],
+                         self.cache.query('foo', NOW - 100, now=NOW)[1])
+        self.assertEqual(1, len(self.database.fetches))
+
+    def test_ingest_only_feeds_queried_metrics(self):
+        self.cache.store('bar', (NOW - 5, 1.0))
+        self.assertEqual({}, self.cache.metrics)
+
+        self.cache.query('foo', NOW - 300, now=NOW)
+        self.cache.store('foo', (NOW + 5, 42.0))
+        timeInfo, values = self.cache.query('foo', NOW - 300, NOW + 10,
+                                            now=NOW + 10)
+        self.assertEqual(42.0, values[-2])
+        self.assertEqual(1, len(self.database.fetches))
+
+    def test_points_flushed_after_the_first_read_are_read_again(self):
+        del self.database.points['foo'][NOW - 20]
+        del self.database.points['foo'][NOW - 10]
+        values = self.cache.query('foo', NOW - 300, now=NOW)[1]
+        self.assertEqual([None, None, None], values[-3:])
+        firstFetch = self.database.fetches[-1]
+        # carbon-cache writes what it held, and the ingest stream carries on
+        self.database.points['foo'][NOW - 10] = 7.0
+        self.cache.store('foo', (NOW + 5, 42.0))
+        values = self.cache.query('foo', NOW - 300, NOW + 10, now=NOW + 60)[1]
+        self.assertEqual([None, None, 42.0, None], values[-4:])
+        self.assertEqual(1, len(self.database.fetches))
+
+        delay = conf.settings.READ_CACHE_FLUSH_DELAY
+        values = self.cache.query('foo', NOW - 300, NOW + 10, now=NOW + delay)[1]
+        self.assertEqual([None, 7.0, 42.0, None], values[-4:])
+        self.assertEqual(firstFetch, self.database.fetches[-1])
+        self.cache.query('foo', NOW - 300, NOW + 10, now=NOW + 2 * delay)
+        self.assertEqual(2, len(self.database.fetches))
+
+    def test_older_range_reads_only_what_is_missing(self):
+        self.cache.query('foo', NOW - 100, now=NOW)
+        timeInfo, values = self.cache.query('foo', NOW - 300, now=NOW)
+        self.assertEqual((NOW - 290, NOW + 10, 10), timeInfo)
+        self.assertEqual(float(NOW - 290), values[0])
+        self.assertEqual(NOW - 91, self.database.fetches[-1][2])
+
+    def test_coarse_archive_is_read_again_after_a_step(self):
+        expected = self.database.fetch('foo', NOW - 1800, NOW)
+        self.assertEqual(60, expected[0][2])
+        self.cache.query('foo', NOW - 1800, now=NOW)
+        self.cache.query('foo', NOW - 1800, now=NOW + 30)
+        self.assertEqual(2, len(self.database.fetches))
+        self.cache.query('foo', NOW - 1800, now=NOW + 60)
+        self.assertEqual(3, len(self.database.fetches))
+        # Only the intervals aggregation may have changed since
+        self.assertEqual((NOW - 100 - 1, NOW + 80 - 1),
+                         self.database.fetches[-1][1:])
+
+    def test_least_recently_queried_ranges_are_evicted(self):
+        for t in range(NOW - 600, NOW, 10):
+            self.database.points.setdefault('bar', {})[t] = 1.0
+        original = conf.settings.READ_CACHE_MAX_POINTS
+        conf.settings['READ_CACHE_MAX_POINTS'] = 80
+        try:
+            self.cache.query('foo', NOW - 500, now=NOW)
+            self.cache.query('bar', NOW - 500, now=NOW + 1)
+        finally:
+            conf.settings['READ_CACHE_MAX_POINTS'] = original
+        self.assertEqual(['bar'], list(self.cache.metrics))
+        self.assertEqual(len(self.cache.metrics['bar'].series[10].values),
+                         self.cache.size)
+
+    def test_idle_ranges_expire(self):
+        self.cache.query('foo', NOW - 500, now=NOW)
+        self.cache.query('foo', NOW + 2900, now=NOW + 3000)
+        self.cache.expire(NOW + 3700)
+        series = self.cache.metrics['foo'].series[10]
+        self.assertEqual([128], list(series.widths))
+        self.assertTrue(series.start >= NOW + 3700 - 128 - 10)
+        self.cache.expire(NOW + 7000)
+        self.assertEqual({}, self.cache.metrics)
+        self.assertEqual(0, self.cache.size)
@@ -0,0 +1,47 @@
+from os.path import dirname
+from unittest import TestCase
+from carbon import conf
+
+# Where carbon.storage looks for its configuration, which is never read here
+conf.settings.setdefault("CONF_DIR", dirname(__file__))
+from carbon import events, instrumentation, service
+from carbon.client import CarbonClientManager
+
+
+class ReaderServiceTest(TestCase):
+
+    def setUp(self):
+        self.settings = dict(conf.settings)
+        conf.settings.update(program="carbon-reader", instance=None,
+                             DESTINATIONS=["127.0.0.1:2004"],
+                             DESTINATION_PROTOCOL="binary")
+        self.handlers = {}
+        for event in (events.metricsReceived, events.metricsOwned,
+                      events.metricsGenerated):
+            self.handlers[event] = list(event.handlers)
+
+    def tearDown(self):
+        conf.settings.clear()
+        conf.settings.update(self.settings)
+        for event, handlers in self.handlers.items():
+            event.handlers[:] = handlers
+
+    def test_recorded_stats_are_sent_to_destinations(self):
+        root_service = service.createReaderService(None)
+        [client_manager] = [s for s in root_service
+                            if isinstance(s, CarbonClientManager)]
+        instrumentation.reader_record("queries", 3)
+        factory = client_manager.client_factories[("127.0.0.1", 2004, None)]
+        [(metric, (timestamp, value))] = list(factory.queue)
+        self.assertTrue(metric.startswith("carbon.readers."))
+        self.assertTrue(metric.endswith(".queries"))
+        self.assertEqual(3, value)
+
+    def test_destinations_are_required(self):
+        conf.settings["DESTINATIONS"] = []
+        try:
+            service.createReaderService(None)
+        except Exception, e:
+            self.assertTrue("DESTINATIONS" in str(e))
+        else:
+            self.fail("DESTINATIONS was not required")
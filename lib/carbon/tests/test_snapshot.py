@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from carbon.cache import MetricCache
+from carbon.snapshot import dumpCache, loadCache
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpDir, "carbon-cache.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_round_trip(self):
+        """A snapshot empties the cache and loads back into another one."""
+        cache = MetricCache.__class__(shardCount=4)
+        for i in range(20):
+            for t in range(i % 3 + 1):
+                cache.store("metric.%d" % i, (t, i * 1.5))
+        expected = sorted(cache.counts())
+
+        self.assertEqual((20, cache.size), dumpCache(cache, self.path))
+        self.assertFalse(cache)
+        self.assertEqual(0, cache.size)
+
+        restored = MetricCache.__class__(shardCount=1, writeStrategy='max')
+        loadCache(restored, self.path)
+        self.assertEqual(expected, sorted(restored.counts()))
+        self.assertEqual([(0.0, 3.0), (1.0, 3.0), (2.0, 3.0)], restored.get("metric.2"))
+        # Restored queues are indexed for the write order like stored ones
+        largest = restored.shards[0].largestQueue()
+        self.assertEqual(3, len(restored.get(largest)))
+
+    def test_incomplete_snapshot_loads_what_it_has(self):
+        cache = MetricCache.__class__(shardCount=1)
+        cache.store("foo", (1, 1.0))
+        cache.store("bar", (1, 2.0))
+        dumpCache(cache, self.path)
+        fh = open(self.path, 'r+b')
+        fh.truncate(os.path.getsize(self.path) - 12)
+        fh.close()
+
+        restored = MetricCache.__class__(shardCount=1)
+        metrics, datapoints = loadCache(restored, self.path)
+        self.assertEqual(1, metrics)
+        self.assertEqual(1, restored.size)
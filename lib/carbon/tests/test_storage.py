@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+from os.path import dirname, join
+from unittest import TestCase
+from carbon import conf
+from carbon.util import pickle
+
+# Where carbon.storage looks for its configuration, which is never read here
+conf.settings.setdefault("CONF_DIR", dirname(__file__))
+from carbon import storage
+
+
+def touch(path, mtime=None):
+    open(path, "a").close()
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+class KnownFilesTest(TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.knownFiles = storage.KnownFiles.__class__()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_only_unknown_files_are_looked_up(self):
+        path = join(self.tmpDir, "foo.wsp")
+        self.assertFalse(self.knownFiles.exists(path))
+        self.assertEqual(0, len(self.knownFiles))
+        touch(path)
+        self.assertTrue(self.knownFiles.exists(path))
+        os.unlink(path)
+        # Known files are not looked up again until discarded
+        self.assertTrue(self.knownFiles.exists(path))
+        self.knownFiles.discard(path)
+        self.assertFalse(self.knownFiles.exists(path))
+
+    def test_added_files_are_known(self):
+        path = join(self.tmpDir, "foo.wsp")
+        self.knownFiles.add(path)
+        self.assertTrue(self.knownFiles.exists(path))
+
+    def test_scan_indexes_accepted_whisper_files(self):
+        os.makedirs(join(self.tmpDir, "foo"))
+        for name in ("bar.wsp", "baz.wsp", "qux.txt"):
+            touch(join(self.tmpDir, "foo", name))
+        self.knownFiles.scan(self.tmpDir, lambda metric: metric != "foo.baz")
+        self.assertEqual(set([join(self.tmpDir, "foo", "bar.wsp")]),
+                         self.knownFiles.paths)
+
+
+class ListSchemaTest(TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.whitelistsDir = conf.settings.get("WHITELISTS_DIR")
+        conf.settings["WHITELISTS_DIR"] = self.tmpDir
+        self.path = join(self.tmpDir, "hosts")
+
+    def tearDown(self):
+        conf.settings["WHITELISTS_DIR"] = self.whitelistsDir
+        shutil.rmtree(self.tmpDir)
+
+    def writeList(self, members, mtime):
+        fh = open(self.path, "wb")
+        pickle.dump(frozenset(members), fh)
+        fh.close()
+        os.utime(self.path, (mtime, mtime))
+
+    def test_list_is_only_read_again_once_changed(self):
+        self.writeList(["foo"], 1000)
+        schema = storage.ListSchema("hosts", "hosts", [], {})
+        self.assertTrue(schema.matches("foo"))
+        self.assertFalse(schema.refresh())
+
+        self.writeList(["bar"], 1000)
+        self.assertFalse(schema.refresh())
+        self.assertTrue(schema.matches("foo"))
+
+        self.writeList(["bar"], 2000)
+        self.assertTrue(schema.refresh())
+        self.assertFalse(schema.matches("foo"))
+        self.assertTrue(schema.matches("bar"))
+
+    def test_missing_list_matches_nothing(self):
+        schema = storage.ListSchema("hosts", "hosts", [], {})
+        self.assertFalse(schema.matches("foo"))
+        self.assertFalse(schema.refresh())
+
+
+class ConfigMtimeTest(TestCase):
+
+    def test_missing_file(self):
+        self.assertEqual(None, storage.getConfigMtime("/no/such/file.conf"))
+
+    def test_existing_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            touch(path, 1000)
+            self.assertEqual(1000, storage.getConfigMtime(path))
+        finally:
+            os.unlink(path)
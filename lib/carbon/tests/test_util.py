@@ -0,0 +1,84 @@
+from unittest import TestCase
+from carbon.util import LRUCache, TokenBucket, DatapointUnpickler, pickle
+
+
+class LRUCacheTest(TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(10)
+        cache["foo"] = 1
+        self.assertEqual(1, cache["foo"])
+        self.assertEqual(None, cache.get("bar"))
+        self.assertRaises(KeyError, lambda: cache["bar"])
+
+    def test_size_is_bounded(self):
+        cache = LRUCache(10)
+        for i in range(100):
+            cache[i] = i
+        self.assertTrue(len(cache) <= 10)
+        self.assertTrue(99 in cache)
+        self.assertFalse(0 in cache)
+
+    def test_recently_used_entries_survive(self):
+        """An entry read since the last turnover is kept by the next one."""
+        cache = LRUCache(4)
+        cache["hot"] = "hot"
+        cache["a"] = "a"
+        cache["b"] = "b"  # "hot" and "a" move to the previous generation
+        self.assertEqual("hot", cache["hot"])
+        cache["c"] = "c"  # "a" is dropped, "hot" was promoted
+        self.assertTrue("hot" in cache)
+        self.assertFalse("a" in cache)
+
+    def test_clear(self):
+        cache = LRUCache(4)
+        cache["foo"] = 1
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+
+class TokenBucketTest(TestCase):
+
+    def test_drain_up_to_capacity(self):
+        bucket = TokenBucket(3, 0.001)
+        self.assertTrue(bucket.drain(2))
+        self.assertTrue(bucket.drain(1))
+        self.assertFalse(bucket.drain(1))
+
+    def test_blocking_drain_waits_for_tokens(self):
+        bucket = TokenBucket(1, 100)
+        bucket.drain(1)
+        self.assertTrue(bucket.drain(1, blocking=True))
+        self.assertTrue(bucket.tokens <= 0.5)
+
+    def test_infinite_fill_rate_never_limits(self):
+        bucket = TokenBucket(float('inf'), float('inf'))
+        for i in range(100):
+            self.assertTrue(bucket.drain(1000))
+
+    def test_zero_fill_rate_never_blocks(self):
+        bucket = TokenBucket(0, 0)
+        self.assertFalse(bucket.drain(1))
+        self.assertFalse(bucket.drain(1, blocking=True))
+
+    def test_set_capacity_caps_tokens(self):
+        bucket = TokenBucket(10, 1)
+        bucket.setCapacityAndFillRate(2, 1)
+        self.assertTrue(bucket.drain(2))
+        self.assertFalse(bucket.drain(1))
+
+
+class DatapointUnpicklerTest(TestCase):
+
+    def test_loads_datapoints(self):
+        datapoints = [("foo.bar", (1400000000, 1.5)), (u"foo.baz", (1.0, 2))]
+        for protocol in (0, 2):
+            self.assertEqual(datapoints, DatapointUnpickler.loads(
+                pickle.dumps(datapoints, protocol)))
+
+    def test_refuses_globals(self):
+        for protocol in (0, 2):
+            self.assertRaises(pickle.UnpicklingError, DatapointUnpickler.loads,
+                              pickle.dumps([("foo", (1, TokenBucket))], protocol))
+            self.assertRaises(pickle.UnpicklingError, DatapointUnpickler.loads,
+                              pickle.dumps(object(), protocol))
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from carbon.wal import WriteAheadLog, readSegment
+from carbon import conf
+
+
+class WriteAheadLogTest(TestCase):
+
+    def setUp(self):
+        self.walDir = tempfile.mkdtemp()
+        self.original = conf.settings.get("WAL_DIR")
+        conf.settings["WAL_DIR"] = self.walDir
+        self.wal = WriteAheadLog()
+        self.wal.openSegment()
+        self.wal.enabled = True
+
+    def tearDown(self):
+        conf.settings["WAL_DIR"] = self.original
+        shutil.rmtree(self.walDir)
+
+    def test_commit_writes_records_in_order(self):
+        self.wal.append("foo.bar", (1, 1.5))
+        self.wal.append("foo.baz", (2, -2.0))
+        self.wal.commit()
+        self.assertEqual([("foo.bar", (1.0, 1.5)), ("foo.baz", (2.0, -2.0))],
+                         list(readSegment(self.wal.segment.path)))
+
+    def test_partly_written_record_is_ignored(self):
+        self.wal.append("foo.bar", (1, 1.5))
+        self.wal.append("foo.baz", (2, 2.0))
+        self.wal.commit()
+        path = self.wal.segment.path
+        fh = open(path, 'r+b')
+        fh.truncate(os.path.getsize(path) - 3)
+        fh.close()
+        self.assertEqual([("foo.bar", (1.0, 1.5))], list(readSegment(path)))
+
+    def test_written_segments_are_deleted(self):
+        """With nothing left in the cache every closed segment goes."""
+        self.wal.append("foo.bar", (1, 1.5))
+        self.wal.commit()
+        self.wal.closeSegment()
+        self.wal.openSegment()
+        self.assertEqual(1, len(self.wal.closedSegments))
+        self.wal.truncate()
+        self.assertEqual([], self.wal.closedSegments)
+        self.assertEqual([os.path.basename(self.wal.segment.path)],
+                         os.listdir(self.walDir))
@@ -0,0 +1,105 @@
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+import whisper
+from carbon import whisperfiles
+
+
+class PrivateFunctionsTest(TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpDir, "foo.wsp")
+        whisper.create(self.path, [(60, 60)])
+        self.supported = whisperfiles.SUPPORTED
+
+    def tearDown(self):
+        whisperfiles.SUPPORTED = self.supported
+        whisperfiles.local.__dict__.clear()
+        shutil.rmtree(self.tmpDir)
+
+    def test_installed_whisper_is_supported(self):
+        self.assertTrue(whisperfiles.SUPPORTED)
+
+    def test_missing_function_is_unsupported(self):
+        readHeader = getattr(whisper, "__readHeader")
+        delattr(whisper, "__readHeader")
+        try:
+            self.assertEqual(None, whisperfiles.findPrivateFunctions())
+        finally:
+            setattr(whisper, "__readHeader", readHeader)
+
+    def test_changed_signature_is_unsupported(self):
+        readHeader = getattr(whisper, "__readHeader")
+        setattr(whisper, "__readHeader", lambda fh, cache=True: readHeader(fh))
+        try:
+            self.assertEqual(None, whisperfiles.findPrivateFunctions())
+        finally:
+            setattr(whisper, "__readHeader", readHeader)
+
+    def test_unsupported_whisper_updates_through_public_api(self):
+        whisperfiles.SUPPORTED = False
+        now = int(time.time()) // 60 * 60
+        whisperfiles.update_many(self.path, [(now, 1.5)])
+        self.assertFalse(hasattr(whisperfiles.local, "openFiles"))
+        self.assertEqual(1.5, whisper.fetch(self.path, now - 60)[1][-1])
+
+
+class OpenFileCacheTest(TestCase):
+    """Files updated through a kept open, or mapped, file read back through
+    plain whisper exactly like files updated by whisper.update_many()."""
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.now = int(time.time())
+        self.points = [(self.now - i * 7, float(i % 13)) for i in range(200)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def create(self, name):
+        path = os.path.join(self.tmpDir, name)
+        whisper.create(path, [(10, 60), (60, 60), (300, 24)], 0.1, "max")
+        return path
+
+    def assertSameAsWhisper(self, mapped):
+        expected = self.create("expected.wsp")
+        actual = self.create("actual.wsp")
+        openFiles = whisperfiles.OpenFileCache(2, mapped)
+        try:
+            for start in range(0, len(self.points), 50):
+                whisper.update_many(expected, self.points[start:start + 50])
+                openFiles.updateMany(actual, self.points[start:start + 50])
+        finally:
+            openFiles.clear()
+
+        for fromTime in (self.now - 500, self.now - 3000, self.now - 5000):
+            self.assertEqual(whisper.fetch(expected, fromTime, self.now),
+                             whisper.fetch(actual, fromTime, self.now))
+        self.assertEqual(open(expected, "rb").read(), open(actual, "rb").read())
+
+    def test_least_recently_used_file_is_closed(self):
+        paths = [self.create("%s.wsp" % name) for name in "abc"]
+        openFiles = whisperfiles.OpenFileCache(2)
+        try:
+            first = openFiles.get(paths[0])
+            openFiles.get(paths[1])
+            self.assertTrue(openFiles.get(paths[0]) is first)
+            openFiles.get(paths[2])
+            self.assertEqual(sorted([paths[0], paths[2]]), sorted(openFiles.files))
+            self.assertFalse(first.fh.closed)
+            openFiles.discard(paths[0])
+            self.assertTrue(first.fh.closed)
+            self.assertEqual([paths[2]], openFiles.files.keys())
+        finally:
+            openFiles.clear()
+        self.assertEqual(0, len(openFiles))
+
+    def test_open_file_matches_whisper(self):
+        self.assertSameAsWhisper(mapped=False)
+
+    def test_mapped_file_matches_whisper(self):
+        self.assertSameAsWhisper(mapped=True)
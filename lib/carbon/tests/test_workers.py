@@ -0,0 +1,41 @@
+from unittest import TestCase
+from carbon.hashing import ConsistentHashRing
+from carbon.workers import MetricSlicer
+from carbon import conf, events
+
+
+class MetricSlicerTest(TestCase):
+
+    def setUp(self):
+        self.instance = conf.settings.get("instance")
+        conf.settings["instance"] = "a"
+        self.owned = []
+        events.metricsOwned.addHandler(self.owned.extend)
+        self.slicer = MetricSlicer(0, 3)
+
+    def tearDown(self):
+        events.metricsOwned.removeHandler(self.owned.extend)
+        conf.settings["instance"] = self.instance
+
+    def test_slices_match_the_webapp_ring(self):
+        """
+        Every worker owns the metrics CARBONLINK_HOSTS would ask it about,
+        which lists each worker as INGEST_PEER_INTERFACE:port:<instance>-k.
+        """
+        ring = ConsistentHashRing([("127.0.0.1", "a-%d" % k) for k in range(3)])
+        datapoints = [("metric.%d" % i, (i, 1.0)) for i in range(300)]
+        self.slicer.route(datapoints)
+
+        expected = [(metric, datapoint) for (metric, datapoint) in datapoints
+                    if ring.get_node(metric) == ("127.0.0.1", "a-0")]
+        self.assertEqual(expected, self.owned)
+        self.assertEqual([metric for (metric, datapoint) in expected],
+                         [metric for (metric, datapoint) in datapoints
+                          if self.slicer.owns(metric)])
+
+        forwarded = 0
+        for (host, port, instance), factory in self.slicer.clients.client_factories.items():
+            for (metric, datapoint) in factory.queue:
+                self.assertEqual(("127.0.0.1", instance), ring.get_node(metric))
+            forwarded += len(factory.queue)
+        self.assertEqual(len(datapoints) - len(expected), forwarded)
@@ -0,0 +1,269 @@
+import os
+import time
+import shutil
+import tempfile
+from os.path import dirname, join
+from unittest import TestCase
+from twisted.trial import unittest
+import whisper
+from carbon import conf
+from carbon.util import pickle
+
+# Where carbon.storage looks for its configuration, storage-schemas.conf is
+# read when carbon.writer is imported
+conf.settings.setdefault("CONF_DIR", dirname(__file__))
+from carbon import storage, writer, instrumentation
+from carbon.cache import MetricCacheShard
+
+
+class SchemaReloadTest(TestCase):
+    """Schemas are only loaded again when storage-schemas.conf,
+    storage-aggregation.conf or one of their lists has changed."""
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(writer, name)) for name in
+                          ("STORAGE_SCHEMAS_CONFIG", "STORAGE_AGGREGATION_CONFIG",
+                           "schemas", "schemas_mtime",
+                           "agg_schemas", "agg_schemas_mtime"))
+        self.storageConfigs = (storage.STORAGE_SCHEMAS_CONFIG,
+                               storage.STORAGE_AGGREGATION_CONFIG)
+        self.whitelistsDir = conf.settings.get("WHITELISTS_DIR")
+        conf.settings["WHITELISTS_DIR"] = self.tmpDir
+
+        self.schemasPath = join(self.tmpDir, "storage-schemas.conf")
+        self.aggregationPath = join(self.tmpDir, "storage-aggregation.conf")
+        writer.STORAGE_SCHEMAS_CONFIG = storage.STORAGE_SCHEMAS_CONFIG = self.schemasPath
+        writer.STORAGE_AGGREGATION_CONFIG = self.aggregationPath
+        storage.STORAGE_AGGREGATION_CONFIG = self.aggregationPath
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(writer, name, value)
+        (storage.STORAGE_SCHEMAS_CONFIG,
+         storage.STORAGE_AGGREGATION_CONFIG) = self.storageConfigs
+        conf.settings["WHITELISTS_DIR"] = self.whitelistsDir
+        shutil.rmtree(self.tmpDir)
+
+    def write(self, path, content, mtime):
+        fh = open(path, "w")
+        fh.write(content)
+        fh.close()
+        os.utime(path, (mtime, mtime))
+
+    def writeSchemas(self, retentions, mtime):
+        self.write(self.schemasPath,
+                   "[hosts]\nlist = hosts\nretentions = 10s:1h\n\n"
+                   "[default]\npattern = .*\nretentions = %s\n" % retentions,
+                   mtime)
+
+    def writeList(self, members, mtime):
+        fh = open(join(self.tmpDir, "hosts"), "wb")
+        pickle.dump(frozenset(members), fh)
+        fh.close()
+        os.utime(join(self.tmpDir, "hosts"), (mtime, mtime))
+
+    def archiveConfig(self, metric):
+        return writer.getCreateArgs(metric)[0]
+
+    def test_unchanged_file_is_not_parsed_again(self):
+        self.writeSchemas("60s:1d", 1000)
+        writer.reloadStorageSchemas()
+        schemas = writer.schemas
+        writer.reloadStorageSchemas()
+        self.assertTrue(writer.schemas is schemas)
+
+    def test_changed_file_is_picked_up(self):
+        self.writeSchemas("60s:1d", 1000)
+        writer.reloadStorageSchemas()
+        self.assertEqual([(60, 1440)], self.archiveConfig("foo.bar"))
+
+        self.writeSchemas("300s:1d", 2000)
+        writer.reloadStorageSchemas()
+        self.assertEqual([(300, 288)], self.archiveConfig("foo.bar"))
+
+    def test_changed_list_is_picked_up(self):
+        self.writeList([], 1000)
+        self.writeSchemas("60s:1d", 1000)
+        writer.reloadStorageSchemas()
+        schemas = writer.schemas
+        self.assertEqual([(60, 1440)], self.archiveConfig("foo.bar"))
+
+        self.writeList(["foo.bar"], 2000)
+        writer.reloadStorageSchemas()
+        self.assertTrue(writer.schemas is schemas)
+        self.assertEqual([(10, 360)], self.archiveConfig("foo.bar"))
+
+    def test_changed_aggregation_file_is_picked_up(self):
+        self.writeSchemas("60s:1d", 1000)
+        writer.reloadStorageSchemas()
+        self.write(self.aggregationPath,
+                   "[default]\npattern = .*\nxFilesFactor = 0.1\n", 1000)
+        writer.reloadAggregationSchemas()
+        self.assertEqual(0.1, writer.getCreateArgs("foo.bar")[1])
+
+        aggSchemas = writer.agg_schemas
+        writer.reloadAggregationSchemas()
+        self.assertTrue(writer.agg_schemas is aggSchemas)
+
+        self.write(self.aggregationPath,
+                   "[default]\npattern = .*\naggregationMethod = max\n", 2000)
+        writer.reloadAggregationSchemas()
+        self.assertEqual((None, "max"), writer.getCreateArgs("foo.bar")[1:])
+
+
+class FakeDatabase(object):
+
+    def __init__(self):
+        self.metrics = set()
+        self.failing = False
+
+    def exists(self, metric):
+        return metric in self.metrics
+
+    def create(self, metric, archiveConfig, xFilesFactor, aggregationMethod):
+        if self.failing:
+            raise IOError("No space left on device")
+        self.metrics.add(metric)
+
+
+class CreatesTestCase(object):
+    """Runs the writer against a FakeDatabase and PendingCreates of its own"""
+
+    def setUp(self):
+        self.settings = dict(conf.settings)
+        self.database = writer.database
+        self.pendingCreates = writer.PendingCreates
+        writer.database = FakeDatabase()
+        writer.database.metrics.add("existing")
+        writer.PendingCreates = writer.PendingCreates.__class__()
+        self.shard = MetricCacheShard()
+        self.shard.store("existing", (1, 1.0))
+        for metric, count in (("new.a", 3), ("new.b", 2)):
+            for i in range(count):
+                self.shard.store(metric, (i, float(i)))
+        self.droppedCreates = instrumentation.stats.get("droppedCreates", 0)
+
+    def tearDown(self):
+        conf.settings.clear()
+        conf.settings.update(self.settings)
+        writer.database = self.database
+        writer.PendingCreates = self.pendingCreates
+
+    def droppedSince(self):
+        return instrumentation.stats.get("droppedCreates", 0) - self.droppedCreates
+
+
+class PendingCreatesTest(CreatesTestCase, TestCase):
+
+    def test_new_metrics_wait_in_the_cache(self):
+        written = list(writer.optimalWriteOrder([self.shard]))
+        self.assertEqual([("existing", [(1, 1.0)])], written)
+        self.assertEqual(2, len(writer.PendingCreates))
+        self.assertEqual(set(["new.a", "new.b"]), self.shard.parked)
+        self.shard.store("new.a", (3, 3.0))
+        self.assertEqual(4, len(self.shard.getDatapoints("new.a")))
+        self.assertEqual(0, self.droppedSince())
+
+    def test_requests_are_handed_out_oldest_first(self):
+        list(writer.optimalWriteOrder([self.shard]))
+        metric, shard, requestTime = writer.PendingCreates.next(0)
+        self.assertEqual(("new.a", self.shard), (metric, shard))
+        self.assertEqual("new.b", writer.PendingCreates.next(0)[0])
+        self.assertEqual(None, writer.PendingCreates.next(0))
+
+    def test_new_metrics_past_max_pending_creates_are_dropped(self):
+        conf.settings["MAX_PENDING_CREATES"] = 1
+        list(writer.optimalWriteOrder([self.shard]))
+        self.assertEqual(set(["new.a"]), self.shard.parked)
+        self.assertFalse("new.b" in self.shard)
+        self.assertEqual(1, self.droppedSince())
+
+    def test_no_creates_per_minute_drops_new_metrics(self):
+        conf.settings["MAX_CREATES_PER_MINUTE"] = 0
+        written = list(writer.optimalWriteOrder([self.shard]))
+        self.assertEqual(["existing"], [metric for (metric, datapoints) in written])
+        self.assertEqual(0, len(writer.PendingCreates))
+        self.assertEqual(0, self.shard.size)
+        self.assertEqual(2, self.droppedSince())
+
+
+class CreatePendingMetricTest(CreatesTestCase, unittest.TestCase):
+
+    def test_created_metric_is_written_with_what_it_gathered(self):
+        list(writer.optimalWriteOrder([self.shard]))
+        writer.createPendingMetric(*writer.PendingCreates.next(0))
+        self.assertTrue("new.a" in writer.database.metrics)
+        self.assertEqual(1, len(writer.PendingCreates))
+        written = dict(writer.optimalWriteOrder([self.shard]))
+        self.assertEqual(3, len(written["new.a"]))
+
+    def test_failed_create_drops_the_datapoints(self):
+        writer.database.failing = True
+        list(writer.optimalWriteOrder([self.shard]))
+        writer.createPendingMetric(*writer.PendingCreates.next(0))
+        self.assertEqual(1, len(self.flushLoggedErrors(IOError)))
+        self.assertFalse("new.a" in self.shard)
+        self.assertEqual(1, len(writer.PendingCreates))
+
+
+class UpdateRateLimiterTest(TestCase):
+
+    def setUp(self):
+        self.settings = dict(conf.settings)
+        conf.settings.update(UPDATE_BURST_SECONDS=2, UPDATE_RATE_UNIT="updates",
+                             UPDATE_LATENCY_TARGET=0.01)
+        self.limiter = writer.UpdateRateLimiter(100)
+
+    def tearDown(self):
+        conf.settings.clear()
+        conf.settings.update(self.settings)
+
+    def test_unused_budget_is_capped_at_the_burst(self):
+        self.limiter.bucket.timestamp -= 3600
+        drained = 0
+        while self.limiter.bucket.drain(1) and drained <= 1000:
+            drained += 1
+        self.assertTrue(200 <= drained < 205)
+
+    def test_cost_by_rate_unit(self):
+        self.assertEqual(1, self.limiter.getCost(5))
+        conf.settings["UPDATE_RATE_UNIT"] = "points"
+        self.assertEqual(5, self.limiter.getCost(5))
+        conf.settings["UPDATE_RATE_UNIT"] = "bytes"
+        self.assertEqual(5 * whisper.pointSize, self.limiter.getCost(5))
+
+    def adjust(self, updateTime):
+        self.limiter.lastAdjustment -= self.limiter.ADJUST_INTERVAL
+        self.limiter.adjust(updateTime)
+        return self.limiter.rate
+
+    def test_slow_updates_lower_the_rate(self):
+        self.assertEqual(80, self.adjust(0.1))
+        self.assertEqual(80, self.limiter.bucket.fillRate)
+        self.assertEqual(160, self.limiter.bucket.capacity)
+        for i in range(50):
+            self.adjust(0.1)
+        self.assertEqual(10, self.limiter.rate)
+
+    def test_fast_updates_restore_the_rate(self):
+        for i in range(3):
+            self.adjust(0.1)
+        self.assertEqual(56.2, round(self.adjust(0.001), 1))
+        for i in range(50):
+            self.adjust(0.001)
+        self.assertEqual(100, self.limiter.rate)
+        self.assertEqual(100, self.limiter.bucket.fillRate)
+
+    def test_rate_is_adjusted_on_the_average_of_an_interval(self):
+        self.limiter.lastAdjustment = time.time()
+        self.limiter.adjust(0.1)
+        self.limiter.adjust(0.1)
+        self.assertEqual(100, self.limiter.rate)
+        self.assertEqual(80, self.adjust(0.001))
+
+    def test_no_latency_target_keeps_the_rate(self):
+        conf.settings["UPDATE_LATENCY_TARGET"] = 0
+        self.limiter.lastAdjustment -= self.limiter.ADJUST_INTERVAL
+        self.limiter.throttle(1, 1.0)
+        self.assertEqual(100, self.limiter.rate)
@@ -1,6 +1,8 @@
 import sys
 import os
 import pwd
+import time
+import socket
 
 from os.path import abspath, basename, dirname, join
 try:
@@ -14,6 +16,7 @@ except:
   import pickle
   USING_CPICKLE = False
 
+from threading import Lock
 from twisted.python.util import initgroups
 from twisted.scripts.twistd import runApp
 from twisted.scripts._twistd_unix import daemonize
@@ -21,6 +24,10 @@ from twisted.scripts._twistd_unix import daemonize
 
 daemonize = daemonize # Backwards compatibility
 
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+if SO_REUSEPORT is None and sys.platform.startswith('linux'):
+  SO_REUSEPORT = 15  # Linux 3.9 and later, Python 2 has no name for it
+
 
 def dropprivs(user):
   uid, gid = pwd.getpwnam(user)[2:4]
@@ -94,6 +101,101 @@ def run_twistd_plugin(filename):
     runApp(config)
 
 
+class LRUCache(object):
+  """A mapping of at most maxSize entries that approximates least recently
+  used eviction with two generations of plain dicts. When the current
+  generation fills up it becomes the previous one. Entries read from the
+  previous generation are promoted back, and the rest are dropped with it
+  at the next turnover. Lookups stay at dict speed, where an exact LRU
+  would need an ordered structure updated on every hit."""
+  def __init__(self, maxSize):
+    self.maxSize = max(2, int(maxSize))
+    self.current = {}
+    self.previous = {}
+
+  def __len__(self):
+    return len(self.current) + len(self.previous)
+
+  def __contains__(self, key):
+    return key in self.current or key in self.previous
+
+  def __getitem__(self, key):
+    try:
+      return self.current[key]
+    except KeyError:
+      value = self.previous[key]
+      self[key] = value
+      return value
+
+  def __setitem__(self, key, value):
+    if len(self.current) >= self.maxSize // 2:
+      self.previous = self.current
+      self.current = {}
+    self.current[key] = value
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def clear(self):
+    self.current = {}
+    self.previous = {}
+
+
+class TokenBucket(object):
+  """A token bucket rate limiter. Tokens are added at fillRate per second,
+  up to capacity, and every operation drains its cost from the bucket. It
+  can be shared between threads."""
+  def __init__(self, capacity, fillRate):
+    self.capacity = float(capacity)
+    self.fillRate = float(fillRate)
+    self.tokens = self.capacity
+    self.timestamp = time.time()
+    self.lock = Lock()
+
+  def setCapacityAndFillRate(self, capacity, fillRate):
+    try:
+      self.lock.acquire()
+      self._refill()
+      self.capacity = float(capacity)
+      self.fillRate = float(fillRate)
+      self.tokens = min(self.tokens, self.capacity)
+    finally:
+      self.lock.release()
+
+  def _refill(self):
+    now = time.time()
+    self.tokens = min(self.capacity, self.tokens + self.fillRate * (now - self.timestamp))
+    self.timestamp = now
+
+  def drain(self, cost=1, blocking=False):
+    """Takes cost tokens from the bucket. If there are not enough tokens,
+    returns False or, when blocking, sleeps until they have been added and
+    returns True. A bucket with no fill rate never gets them, so draining
+    it past its tokens returns False even when blocking."""
+    if self.fillRate == float('inf'):
+      return True
+
+    try:
+      self.lock.acquire()
+      self._refill()
+      if self.tokens >= cost:
+        self.tokens -= cost
+        return True
+      if not blocking or self.fillRate <= 0:
+        return False
+      # Go into debt so that concurrent callers queue up behind this one
+      wait = (cost - self.tokens) / self.fillRate
+      self.tokens -= cost
+    finally:
+      self.lock.release()
+
+    time.sleep(wait)
+    return True
+
+
 def parseDestinations(destination_strings):
   destinations = []
 
@@ -161,6 +263,24 @@ else:
       return cls(StringIO(pickle_string)).load()
  
 
+if USING_CPICKLE:
+  class DatapointUnpickler(object):
+    """Unpickles the [(metric, (timestamp, value)), ...] lists sent to the
+    pickle receiver. With find_global set to None cPickle refuses every
+    opcode that looks up a global or an extension code, so there is never
+    anything for REDUCE, BUILD, INST or OBJ to call and nothing but strings,
+    numbers and containers can be built. There is no Python code involved
+    per message, this runs at the speed of pickle.loads()."""
+    @staticmethod
+    def loads(pickle_string):
+      unpickler = pickle.Unpickler(StringIO(pickle_string))
+      unpickler.find_global = None
+      return unpickler.load()
+
+else:
+  DatapointUnpickler = SafeUnpickler
+
+
 def get_unpickler(insecure=False):
   if insecure:
     return pickle
@@ -0,0 +1,262 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import os
+import time
+import errno
+import struct
+import thread
+from os.path import join
+from threading import Lock
+
+from carbon.conf import settings
+from carbon.cache import MetricCache
+from carbon import log, instrumentation
+
+from twisted.internet.task import LoopingCall
+
+
+# Each record is the metric name's length, the timestamp and the value,
+# followed by the metric name itself.
+RECORD_HEADER = struct.Struct('!Hdd')
+FSYNC_POLICIES = ('commit', 'segment', 'never')
+
+
+def segmentName(sequence):
+  return '%020d.wal' % sequence
+
+
+def readSegment(path):
+  "Generates the (metric, (timestamp, value)) records of a segment file"
+  fh = open(path, 'rb')
+  try:
+    data = fh.read()
+  finally:
+    fh.close()
+
+  offset = 0
+  headerSize = RECORD_HEADER.size
+  while offset + headerSize <= len(data):
+    nameLength, timestamp, value = RECORD_HEADER.unpack_from(data, offset)
+    offset += headerSize
+    if offset + nameLength > len(data):
+      break
+    yield (data[offset:offset + nameLength], (timestamp, value))
+    offset += nameLength
+
+  if offset != len(data):
+    log.msg("Ignoring %d bytes of a partly written record at the end of %s" %
+            (len(data) - offset, path))
+
+
+class Segment:
+  def __init__(self, sequence, path):
+    self.sequence = sequence
+    self.path = path
+    self.fh = None
+    self.size = 0
+    self.opened = time.time()
+    self.lastAppend = 0.0
+
+
+class WriteAheadLog:
+  """Datapoints received by carbon-cache, appended to segment files in
+  WAL_DIR so they survive a crash and are replayed into the MetricCache at
+  the next start.
+
+  Datapoints are stored into the MetricCache first and only then appended,
+  so a queue never started later than any of its datapoints was logged.
+  Appends are buffered and group committed with a single write every
+  WAL_COMMIT_INTERVAL seconds; WAL_FSYNC decides whether that write is
+  fsynced, or only a segment as it is closed, or never.
+
+  A segment is closed once it reaches WAL_SEGMENT_SIZE bytes or has been
+  open for WAL_SEGMENT_SECONDS. It is deleted once every queue in the cache,
+  parked or not, and every batch a writer has taken out of the cache but
+  not yet written, was started after its last append."""
+  def __init__(self):
+    self.enabled = False
+    self.buffer = []
+    self.segment = None
+    self.closedSegments = []  # oldest first
+    self.nextSequence = 0
+    self.writers = {}  # { writer thread : oldest arrival of the batch it is writing }
+    self.writersLock = Lock()
+    self.lastTruncate = 0.0
+    self.commitTask = LoopingCall(self.commit)
+
+  def start(self):
+    "Replays existing segments into the MetricCache, then starts logging"
+    try:
+      os.makedirs(settings.WAL_DIR, 0755)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    self.replay()
+    self.openSegment()
+    self.enabled = True
+    self.commitTask.start(settings.WAL_COMMIT_INTERVAL, now=False)
+
+  def stop(self):
+    if not self.enabled:
+      return
+    self.enabled = False
+    if self.commitTask.running:
+      self.commitTask.stop()
+    self.commit()
+    self.closeSegment()
+
+  def replay(self):
+    sequences = sorted( int(name[:-4]) for name in os.listdir(settings.WAL_DIR)
+                        if name.endswith('.wal') and name[:-4].isdigit() )
+    replayed = 0
+    t = time.time()
+
+    for sequence in sequences:
+      segment = Segment(sequence, join(settings.WAL_DIR, segmentName(sequence)))
+      for (metric, datapoint) in readSegment(segment.path):
+        MetricCache.store(metric, datapoint)
+        replayed += 1
+      segment.size = os.path.getsize(segment.path)
+      self.closedSegments.append(segment)
+      self.nextSequence = sequence + 1
+
+    # The replayed queues were all started just now, truncation takes over
+    # from here as if these segments had been appended to until this moment.
+    now = time.time()
+    for segment in self.closedSegments:
+      segment.lastAppend = now
+
+    if sequences:
+      log.msg("Replayed %d datapoints from %d write-ahead log segments in %.2f seconds" %
+              (replayed, len(sequences), now - t))
+
+  def openSegment(self):
+    segment = Segment(self.nextSequence, join(settings.WAL_DIR, segmentName(self.nextSequence)))
+    segment.fh = open(segment.path, 'ab')
+    self.nextSequence += 1
+    self.segment = segment
+
+  def closeSegment(self):
+    segment = self.segment
+    if settings.WAL_FSYNC != 'never':
+      os.fsync(segment.fh.fileno())
+    segment.fh.close()
+    segment.fh = None
+    if segment.size:
+      self.closedSegments.append(segment)
+    else:
+      os.unlink(segment.path)
+    self.segment = None
+
+  def append(self, metric, datapoint):
+    "metricReceived handler, called after MetricCache.store"
+    if not self.enabled:
+      return
+    timestamp, value = datapoint
+    self.buffer.append(RECORD_HEADER.pack(len(metric), timestamp, value) + metric)
+
+  def appendMany(self, datapoints):
+    "metricsReceived handler, called after MetricCache.storeMany"
+    if not self.enabled:
+      return
+    pack = RECORD_HEADER.pack
+    self.buffer.extend([ pack(len(metric), timestamp, value) + metric
+                         for (metric, (timestamp, value)) in datapoints ])
+
+  def commit(self):
+    "Writes out everything appended since the last commit, with a single write"
+    try:
+      if self.buffer:
+        data = ''.join(self.buffer)
+        self.buffer = []
+        segment = self.segment
+        segment.fh.write(data)
+        segment.fh.flush()
+        if settings.WAL_FSYNC == 'commit':
+          os.fsync(segment.fh.fileno())
+        segment.size += len(data)
+        segment.lastAppend = time.time()
+        instrumentation.increment('walBytes', len(data))
+
+      segment = self.segment
+      if segment.size >= settings.WAL_SEGMENT_SIZE or \
+         (segment.size and time.time() - segment.opened >= settings.WAL_SEGMENT_SECONDS):
+        self.closeSegment()
+        self.openSegment()
+
+      if time.time() - self.lastTruncate >= 1.0:
+        self.truncate()
+    except:
+      log.err()
+
+  def writerBusy(self, shards):
+    """Called by a writer thread before it takes datapoints out of its shards.
+    Until writerIdle(), nothing logged after the oldest queue in those
+    shards was started may be deleted."""
+    if not self.enabled:
+      return
+    arrivals = [ shard.oldestArrival() for shard in shards ]
+    # Queues started from now on will be later than anything logged so far
+    arrivals = [ arrival for arrival in arrivals if arrival is not None ]
+    arrivals.append( time.time() )
+    try:
+      self.writersLock.acquire()
+      self.writers[thread.get_ident()] = min(arrivals)
+    finally:
+      self.writersLock.release()
+
+  def writerIdle(self):
+    if not self.enabled:
+      return
+    try:
+      self.writersLock.acquire()
+      self.writers.pop(thread.get_ident(), None)
+    finally:
+      self.writersLock.release()
+
+  def oldestUnwritten(self):
+    "Time the oldest queue not yet written was started, or None"
+    # Shards first: a queue gone from its shard by now was taken by a writer
+    # that is either still registered below or done writing it.
+    arrivals = [ shard.oldestArrival() for shard in MetricCache.shards ]
+    try:
+      self.writersLock.acquire()
+      arrivals.extend( self.writers.values() )
+    finally:
+      self.writersLock.release()
+    arrivals = [ arrival for arrival in arrivals if arrival is not None ]
+    if arrivals:
+      return min(arrivals)
+    return None
+
+  def truncate(self):
+    "Deletes the closed segments whose datapoints have all been written"
+    self.lastTruncate = time.time()
+    if not self.closedSegments:
+      return
+    oldest = self.oldestUnwritten()
+    while self.closedSegments:
+      segment = self.closedSegments[0]
+      if oldest is not None and oldest <= segment.lastAppend:
+        break
+      os.unlink(segment.path)
+      self.closedSegments.pop(0)
+
+    instrumentation.max('walSegments', len(self.closedSegments) + 1)
+
+
+# Ghetto singleton
+WAL = WriteAheadLog()
@@ -0,0 +1,261 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import os
+import mmap
+import time
+import threading
+
+import whisper
+from carbon.conf import settings
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# whisper only exposes whole-file updates publicly, these let a file stay
+# open and keep its parsed header between updates. whisper.fetch() also
+# picks the archive itself, archiveFetch reads a given one. They are
+# private to whisper, and have kept these signatures from 0.9.10 through
+# 1.1 (see requirements.txt). With any other whisper that does not have
+# them, SUPPORTED is False and carbon sticks to whisper's public functions.
+PRIVATE_FUNCTIONS = (
+  ('__readHeader', ('fh',)),
+  ('__archive_update_many', ('fh', 'header', 'archive', 'points')),
+  ('__archive_fetch', ('fh', 'archive', 'fromTime', 'untilTime')),
+)
+
+def findPrivateFunctions():
+  "whisper's private functions listed above, or None if any is missing or differs"
+  functions = []
+  for name, args in PRIVATE_FUNCTIONS:
+    function = getattr(whisper, name, None)
+    code = getattr(function, 'func_code', None)
+    if code is None or code.co_varnames[:code.co_argcount] != args:
+      return None
+    functions.append(function)
+  return functions
+
+privateFunctions = findPrivateFunctions()
+SUPPORTED = privateFunctions is not None
+if SUPPORTED:
+  readHeader, archiveUpdateMany, archiveFetch = privateFunctions
+
+
+MMAP_FLUSH_POLICIES = ('kernel', 'close', 'update')
+
+
+class MappedFile(mmap.mmap):
+  """A shared mapping of a whole file. whisper's archive routines only seek,
+  read, write and tell, so they run against the mapping unchanged and every
+  datapoint and propagated value is a memory copy rather than a syscall."""
+  def __new__(cls, fh):
+    mapping = mmap.mmap.__new__(cls, fh.fileno(), 0)
+    mapping.name = fh.name  # whisper names the file in CorruptWhisperFile
+    return mapping
+
+
+class OpenWhisperFile(object):
+  """A whisper file held open along with its parsed header. The file is
+  unbuffered so every update reaches the kernel as soon as it is made.
+
+  With mapped set, updates go to a MappedFile instead. Dirty pages are
+  written back by the kernel, or by msync at close or after every update,
+  according to WHISPER_MMAP_FLUSH."""
+  __slots__ = ('path', 'fh', 'data', 'header', 'identity', 'checked')
+
+  def __init__(self, path, mapped=False):
+    self.path = path
+    self.fh = open(path, 'r+b', 0)
+    try:
+      if mapped:
+        self.data = MappedFile(self.fh)
+      else:
+        self.data = self.fh
+      self.header = readHeader(self.data)
+      stat = os.fstat(self.fh.fileno())
+    except:
+      self.fh.close()
+      raise
+    self.identity = (stat.st_dev, stat.st_ino, stat.st_size)
+    self.checked = time.time()
+
+  @property
+  def mapped(self):
+    return self.data is not self.fh
+
+  def isCurrent(self):
+    """False once the path has been deleted, replaced (as whisper-resize does)
+    or resized, since a mapping can't follow a change in size"""
+    try:
+      stat = os.stat(self.path)
+    except OSError:
+      return False
+    return (stat.st_dev, stat.st_ino, stat.st_size) == self.identity
+
+  def refreshHeader(self):
+    self.header = readHeader(self.data)
+    self.checked = time.time()
+
+  def flush(self):
+    if self.mapped:
+      self.data.flush()
+    else:
+      self.fh.flush()
+    os.fsync(self.fh.fileno())
+
+  def close(self):
+    try:
+      if self.mapped:
+        if settings.WHISPER_MMAP_FLUSH == 'close':
+          self.data.flush()
+        self.data.close()
+    finally:
+      self.fh.close()
+
+  def updateMany(self, points):
+    "Does what whisper.file_update_many() does, with the header already parsed"
+    points = [ (int(t), float(v)) for (t, v) in points ]
+    points.sort(key=lambda p: p[0], reverse=True)  # newest first
+
+    # whisper relies on close() to drop its lock, an open file has to
+    # unlock explicitly or it would keep other writers out for good.
+    locked = whisper.LOCK and fcntl is not None
+    if locked:
+      fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+
+    try:
+      fh = self.data
+      header = self.header
+      now = int(time.time())
+      archives = iter(header['archives'])
+      currentArchive = next(archives)
+      currentPoints = []
+
+      for point in points:
+        age = now - point[0]
+
+        while currentArchive['retention'] < age:  # this archive can't fit any more points
+          if currentPoints:
+            currentPoints.reverse()  # chronological order
+            archiveUpdateMany(fh, header, currentArchive, currentPoints)
+            currentPoints = []
+          try:
+            currentArchive = next(archives)
+          except StopIteration:
+            currentArchive = None
+            break
+
+        if not currentArchive:
+          break  # drop points that are too old for any archive
+
+        currentPoints.append(point)
+
+      if currentArchive and currentPoints:
+        currentPoints.reverse()
+        archiveUpdateMany(fh, header, currentArchive, currentPoints)
+
+      if whisper.AUTOFLUSH:
+        self.flush()
+      elif self.mapped and settings.WHISPER_MMAP_FLUSH == 'update':
+        fh.flush()
+    finally:
+      if locked:
+        fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+
+
+class OpenFileCache:
+  """The maxOpen most recently updated whisper files, kept open (and
+  memory-mapped if mapped is set). A file
+  that has been open for WHISPER_FILE_RECHECK_INTERVAL seconds is checked
+  before its next update. If the path was deleted or replaced the file is
+  reopened, otherwise its header is re-read to catch in-place changes such
+  as a new aggregation method."""
+  def __init__(self, maxOpen, mapped=False):
+    self.maxOpen = max(1, int(maxOpen))
+    self.mapped = mapped
+    # Links of a circular list in the order the files were last used, least
+    # recently first, since collections.OrderedDict needs Python 2.7
+    self.files = {}  # { path : [previous link, next link, path, OpenWhisperFile] }
+    self.root = root = []
+    root[:] = [root, root, None, None]
+
+  def __len__(self):
+    return len(self.files)
+
+  def unlink(self, path):
+    "Removes path, raising KeyError if it is not open, and returns its file"
+    previous, next, path, whisperFile = self.files.pop(path)
+    previous[1] = next
+    next[0] = previous
+    return whisperFile
+
+  def append(self, path, whisperFile):
+    "Adds path as the most recently used file"
+    root = self.root
+    last = root[0]
+    last[1] = root[0] = self.files[path] = [last, root, path, whisperFile]
+
+  def get(self, path):
+    try:
+      whisperFile = self.unlink(path)
+    except KeyError:
+      while len(self.files) >= self.maxOpen:
+        self.unlink(self.root[1][2]).close()
+      whisperFile = OpenWhisperFile(path, self.mapped)
+    else:
+      if time.time() - whisperFile.checked >= settings.WHISPER_FILE_RECHECK_INTERVAL:
+        if whisperFile.isCurrent():
+          whisperFile.refreshHeader()
+        else:
+          whisperFile.close()
+          whisperFile = OpenWhisperFile(path, self.mapped)
+
+    self.append(path, whisperFile)
+    return whisperFile
+
+  def discard(self, path):
+    if path in self.files:
+      self.unlink(path).close()
+
+  def clear(self):
+    while self.files:
+      self.unlink(self.root[1][2]).close()
+
+  def updateMany(self, path, points):
+    if not points:
+      return
+    try:
+      self.get(path).updateMany(points)
+    except:
+      self.discard(path)  # deleted or corrupt, start over next time
+      raise
+
+
+# Every writer thread, and every writer process, has open files of its own
+local = threading.local()
+
+
+def update_many(path, points):
+  """whisper.update_many() through the calling thread's OpenFileCache, or
+  whisper.update_many() itself with a whisper this module doesn't support"""
+  if not SUPPORTED:
+    return whisper.update_many(path, points)
+  try:
+    openFiles = local.openFiles
+  except AttributeError:
+    openFiles = local.openFiles = OpenFileCache(settings.WRITER_OPEN_FILES,
+                                                settings.WHISPER_MMAP)
+  openFiles.updateMany(path, points)
@@ -0,0 +1,212 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Ingest workers. With INGEST_PROCESSES set, the daemon started from the
+command line only supervises that many copies of itself, each run with
+--worker and otherwise the same options and configuration. The workers
+all listen on the same receiver ports with SO_REUSEPORT and the kernel
+spreads the connections, and the datagrams (see carbon.datagram), between
+them.
+
+A carbon-cache or carbon-reader worker owns a slice of the metrics, so
+that no two of them ever write the same whisper file or hold the same
+series. Whatever a worker receives for a metric of another worker's slice
+is forwarded there over the binary protocol."""
+
+import os
+import sys
+import socket
+from os.path import abspath
+
+from twisted.application.service import Service
+from twisted.application.internet import TCPServer
+from twisted.internet import reactor, tcp
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from carbon.conf import settings, get_parser
+from carbon.routers import ConsistentHashingRouter
+from carbon.client import CarbonClientManager
+from carbon.util import LRUCache, SO_REUSEPORT
+from carbon import log, events
+
+
+# Seconds before a worker that exited is started again
+RESTART_DELAY = 5
+
+# The options a worker is passed on from the supervisor's command line
+WORKER_OPTIONS = ('config', 'instance', 'logdir', 'whitelist', 'blacklist',
+                  'rules', 'rewrite-rules')
+
+
+class ReusePortTCPPort(tcp.Port):
+  def createInternetSocket(self):
+    s = tcp.Port.createInternetSocket(self)
+    s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return s
+
+
+class ReusePortTCPServer(TCPServer):
+  "A TCPServer whose port other processes can listen on too"
+  def _getPort(self):
+    port = ReusePortTCPPort(*self.args, **self.kwargs)
+    port.startListening()
+    return port
+
+
+def workerName(worker):
+  "The instance name of an ingest worker, as CARBONLINK_HOSTS lists it"
+  if settings.instance is None:
+    return str(worker)
+  return '%s-%d' % (settings.instance, worker)
+
+
+def peerDestination(worker):
+  "Where an ingest worker receives the datapoints its peers forward to it"
+  return (settings.INGEST_PEER_INTERFACE, int(settings.INGEST_PEER_PORT) + worker,
+          workerName(worker))
+
+
+def workerCommand(options):
+  "The command line that runs a worker, but for its --worker option and action"
+  parser = get_parser(settings.program)
+  command = [sys.executable, abspath(sys.argv[0]), '--nodaemon']
+  for name in WORKER_OPTIONS:
+    if options.get(name) is not None and parser.has_option('--' + name):
+      command.extend(['--' + name, options[name]])
+  return command
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+  "Logs what a worker writes to stdout and stderr before its own logging starts"
+  def __init__(self, supervisor, worker):
+    self.supervisor = supervisor
+    self.worker = worker
+
+  def outReceived(self, data):
+    for line in data.splitlines():
+      if line.strip():
+        log.msg("worker %d: %s" % (self.worker, line))
+
+  errReceived = outReceived
+
+  def processEnded(self, reason):
+    self.supervisor.workerEnded(self.worker, reason)
+
+
+class SupervisorService(Service):
+  """Keeps count worker processes running, starting one again RESTART_DELAY
+  seconds after it exits. Stopping the service stops the workers and fires
+  once all of them have exited, which for carbon-cache is after they have
+  written out their caches."""
+  def __init__(self, command, count):
+    self.command = command
+    self.count = count
+    self.processes = {}  # { worker : IProcessTransport }
+    self.allEnded = None
+
+  def startService(self):
+    Service.startService(self)
+    for worker in range(self.count):
+      self.spawn(worker)
+
+  def spawn(self, worker):
+    if not self.running or worker in self.processes:
+      return
+    args = self.command + ['--worker', str(worker), 'start']
+    log.msg("Starting ingest worker %d: %s" % (worker, ' '.join(args)))
+    protocol = WorkerProcessProtocol(self, worker)
+    self.processes[worker] = reactor.spawnProcess(protocol, args[0], args, env=os.environ)
+
+  def workerEnded(self, worker, reason):
+    del self.processes[worker]
+    if self.running:
+      log.msg("Ingest worker %d exited (%s), starting it again in %d seconds" %
+              (worker, reason.getErrorMessage(), RESTART_DELAY))
+      reactor.callLater(RESTART_DELAY, self.spawn, worker)
+    else:
+      log.msg("Ingest worker %d has stopped" % worker)
+      if not self.processes and self.allEnded is not None:
+        self.allEnded.callback(None)
+
+  def stopService(self):
+    Service.stopService(self)
+    if not self.processes:
+      return
+    self.allEnded = Deferred()
+    for worker, process in self.processes.items():
+      log.msg("Stopping ingest worker %d" % worker)
+      try:
+        process.signalProcess('TERM')
+      except ProcessExitedAlready:
+        pass
+    return self.allEnded
+
+
+def stopIfOrphaned(supervisorPid):
+  "TimerService function of a worker, so that it does not outlive a killed supervisor"
+  if os.getppid() != supervisorPid:
+    log.msg("The supervisor (pid %d) has gone, stopping" % supervisorPid)
+    reactor.stop()
+
+
+class MetricSlicer(object):
+  """Splits the datapoints an ingest worker receives into those of the
+  metrics it owns, which go to metricsOwned, and the rest, which are
+  forwarded to the workers owning them. Every worker of an instance is a
+  node of the same consistent hash ring, the one the webapp makes of
+  CARBONLINK_HOSTS when it lists the workers, and the owner of each metric
+  is remembered once it has been looked up on the ring."""
+  def __init__(self, worker, count):
+    self.own = peerDestination(worker)
+    self.router = ConsistentHashingRouter()
+    self.router.addDestination(self.own)
+    self.clients = CarbonClientManager(self.router, destinationProtocol='binary',
+                                       maxQueueSize=settings.INGEST_PEER_QUEUE_SIZE)
+    for peer in range(count):
+      if peer != worker:
+        self.clients.startClient(peerDestination(peer))
+    self.owners = LRUCache(settings.METRIC_RESOLUTION_CACHE_SIZE)
+
+  def owns(self, metric):
+    "Whether this worker owns metric, which unlike owner() is safe from any thread"
+    return self.router.getDestinations(metric).next() == self.own
+
+  def owner(self, metric):
+    try:
+      return self.owners[metric]
+    except KeyError:
+      owner = self.owners[metric] = self.router.getDestinations(metric).next()
+      return owner
+
+  def route(self, datapoints):
+    "metricsReceived handler"
+    own = self.own
+    owner = self.owner
+    owned = []
+    forwarded = {}  # { destination : [ (metric, datapoint), ... ] }
+    for (metric, datapoint) in datapoints:
+      destination = owner(metric)
+      if destination == own:
+        owned.append( (metric, datapoint) )
+      else:
+        try:
+          forwarded[destination].append( (metric, datapoint) )
+        except KeyError:
+          forwarded[destination] = [ (metric, datapoint) ]
+
+    if owned:
+      events.metricsOwned(owned)
+    for destination, destinationDatapoints in forwarded.iteritems():
+      self.clients.client_factories[destination].sendDatapoints(destinationDatapoints)
@@ -13,15 +13,21 @@ See the License for the specific language governing permissions and
 limitations under the License."""
 
 
-import os
 import time
-from os.path import exists, dirname
+import signal
+from collections import deque
+from threading import Lock, Condition
+from multiprocessing import Pipe, Process
 
 import whisper
 from carbon import state
 from carbon.cache import MetricCache
-from carbon.storage import getFilesystemPath, loadStorageSchemas,\
-    loadAggregationSchemas
+from carbon.database import database
+from carbon.wal import WAL
+from carbon.snapshot import dumpCache
+from carbon.storage import loadStorageSchemas, loadAggregationSchemas,\
+    getConfigMtime, STORAGE_SCHEMAS_CONFIG, STORAGE_AGGREGATION_CONFIG
+from carbon.util import TokenBucket
 from carbon.conf import settings
 from carbon import log, events, instrumentation
 
@@ -30,155 +36,445 @@ from twisted.internet.task import LoopingCall
 from twisted.application.service import Service
 
 
-lastCreateInterval = 0
-createCount = 0
+schemas_mtime = getConfigMtime(STORAGE_SCHEMAS_CONFIG)
 schemas = loadStorageSchemas()
+agg_schemas_mtime = getConfigMtime(STORAGE_AGGREGATION_CONFIG)
 agg_schemas = loadAggregationSchemas()
 CACHE_SIZE_LOW_WATERMARK = settings.MAX_CACHE_SIZE * 0.95
 
 
-def optimalWriteOrder():
-  """Generates metrics with the most cached values first and applies a soft
-  rate limit on new metrics"""
-  global lastCreateInterval
-  global createCount
-  metrics = MetricCache.counts()
+class UpdateRateLimiter:
+  """Holds every writer thread together to MAX_UPDATES_PER_SECOND with a
+  token bucket. Budget left unused builds up as burst credit, worth up to
+  UPDATE_BURST_SECONDS of the rate. Depending on UPDATE_RATE_UNIT the rate
+  counts update_many() calls, datapoints, or datapoint bytes.
 
-  t = time.time()
-  metrics.sort(key=lambda item: item[1], reverse=True)  # by queue size, descending
-  log.debug("Sorted %d cache queues in %.6f seconds" % (len(metrics),
-                                                        time.time() - t))
+  With UPDATE_LATENCY_TARGET set, the rate also adapts to how long updates
+  take. It backs off multiplicatively while updates are slower than the
+  target and climbs back towards MAX_UPDATES_PER_SECOND once they are not."""
+  ADJUST_INTERVAL = 1.0
+  MIN_RATE_FRACTION = 0.1
 
-  for metric, queueSize in metrics:
-    if state.cacheTooFull and MetricCache.size < CACHE_SIZE_LOW_WATERMARK:
-      events.cacheSpaceAvailable()
+  def __init__(self, maxRate):
+    self.lock = Lock()
+    self.bucket = TokenBucket(1, 1)
+    self.setMaxRate(maxRate)
 
-    dbFilePath = getFilesystemPath(metric)
-    dbFileExists = exists(dbFilePath)
-
-    if not dbFileExists:
-      createCount += 1
+  def setMaxRate(self, maxRate):
+    try:
+      self.lock.acquire()
+      self.maxRate = float(maxRate)
+      self.rate = self.maxRate
+      self.latencyTotal = 0.0
+      self.latencyCount = 0
+      self.lastAdjustment = time.time()
+      self.bucket.setCapacityAndFillRate(self.rate * settings.UPDATE_BURST_SECONDS, self.rate)
+    finally:
+      self.lock.release()
+
+  def getCost(self, pointCount):
+    unit = settings.UPDATE_RATE_UNIT
+    if unit == 'updates':
+      return 1
+    elif unit == 'points':
+      return pointCount
+    elif unit == 'bytes':
+      return pointCount * whisper.pointSize
+    raise Exception("Invalid UPDATE_RATE_UNIT \"%s\", must be one of: updates, points, bytes" % unit)
+
+  def adjust(self, updateTime):
+    try:
+      self.lock.acquire()
+      self.latencyTotal += updateTime
+      self.latencyCount += 1
       now = time.time()
+      if now - self.lastAdjustment < self.ADJUST_INTERVAL:
+        return
 
-      if now - lastCreateInterval >= 60:
-        lastCreateInterval = now
-        createCount = 1
-
-      elif createCount >= settings.MAX_CREATES_PER_MINUTE:
-        # dropping queued up datapoints for new metrics prevents filling up the entire cache
-        # when a bunch of new metrics are received.
-        try:
-          MetricCache.pop(metric)
-        except KeyError:
-          pass
+      averageLatency = self.latencyTotal / self.latencyCount
+      if averageLatency > settings.UPDATE_LATENCY_TARGET:
+        self.rate = max(self.maxRate * self.MIN_RATE_FRACTION, self.rate * 0.8)
+      else:
+        self.rate = min(self.maxRate, self.rate + self.maxRate * 0.05)
+
+      self.bucket.setCapacityAndFillRate(self.rate * settings.UPDATE_BURST_SECONDS, self.rate)
+      self.latencyTotal = 0.0
+      self.latencyCount = 0
+      self.lastAdjustment = now
+    finally:
+      self.lock.release()
+
+    instrumentation.append('updateRateLimits', self.rate)
+
+  def throttle(self, pointCount, updateTime):
+    "Called after every update, sleeps for as long as the budget requires"
+    if settings.UPDATE_LATENCY_TARGET and self.maxRate != float('inf'):
+      self.adjust(updateTime)
+    self.bucket.drain(self.getCost(pointCount), blocking=True)
+
+
+UpdateLimiter = UpdateRateLimiter(settings.MAX_UPDATES_PER_SECOND)
+
+
+def optimalWriteOrder(shards=None):
+  """Generates (metric, datapoints) in the order chosen by
+  CACHE_WRITE_STRATEGY. Metrics the storage backend doesn't have yet are
+  handed to the creator thread instead. The given cache shards (all of them
+  by default) are walked one at a time."""
+  if shards is None:
+    shards = MetricCache.shards
+
+  for shard in shards:
+    for metric in shard.writeOrder():
+      if state.cacheTooFull and MetricCache.size < CACHE_SIZE_LOW_WATERMARK:
+        events.cacheSpaceAvailable()
+
+      if not database.exists(metric):
+        if not PendingCreates.request(metric, shard):
+          # dropping queued up datapoints for new metrics prevents filling up the entire cache
+          # when a bunch of new metrics are received.
+          try:
+            shard.pop(metric)
+            instrumentation.increment('droppedCreates')
+          except KeyError:
+            pass
 
         continue
 
-    try:  # metrics can momentarily disappear from the MetricCache due to the implementation of MetricCache.store()
-      datapoints = MetricCache.pop(metric)
+      try:  # metrics can momentarily disappear from the MetricCache due to the implementation of MetricCache.store()
+        datapoints = shard.pop(metric)
+      except KeyError:
+        log.msg("MetricCache contention, skipping %s update for now" % metric)
+        continue  # we simply move on to the next metric when this race condition occurs
+
+      yield (metric, datapoints)
+
+
+def getCreateArgs(metric):
+  """Finds the archive config, xFilesFactor and aggregation method for a new
+  metric. This runs once per metric created, so it is not worth caching."""
+  archiveConfig = None
+  xFilesFactor, aggregationMethod = None, None
+
+  for schema in schemas:
+    if schema.matches(metric):
+      log.creates('new metric %s matched schema %s' % (metric, schema.name))
+      archiveConfig = [archive.getTuple() for archive in schema.archives]
+      break
+
+  for schema in agg_schemas:
+    if schema.matches(metric):
+      log.creates('new metric %s matched aggregation schema %s' % (metric, schema.name))
+      xFilesFactor, aggregationMethod = schema.archives
+      break
+
+  if not archiveConfig:
+    raise Exception("No storage schema matched the metric '%s', check your storage-schemas.conf file." % metric)
+
+  return (archiveConfig, xFilesFactor, aggregationMethod)
+
+
+class PendingCreates:
+  """Metrics waiting for the creator thread to create them in the backend.
+  Their datapoints stay parked in the MetricCache meanwhile, where they keep
+  accumulating and count towards MAX_CACHE_SIZE."""
+  def __init__(self):
+    self.condition = Condition()
+    self.queue = deque()  # (metric, shard, requestTime)
+    self.pending = set()
+
+  def __len__(self):
+    return len(self.pending)
+
+  def request(self, metric, shard):
+    """Queues a metric for creation. Returns False if MAX_PENDING_CREATES
+    metrics are already waiting, or if MAX_CREATES_PER_MINUTE is 0 and no
+    metric is ever created, in which case the caller drops it."""
+    if settings.MAX_CREATES_PER_MINUTE <= 0:
+      return False
+    try:
+      self.condition.acquire()
+      if metric in self.pending:
+        return True
+      if len(self.pending) >= settings.MAX_PENDING_CREATES:
+        return False
+      if shard.park(metric):
+        self.pending.add(metric)
+        self.queue.append( (metric, shard, time.time()) )
+        self.condition.notify()
+      return True
+    finally:
+      self.condition.release()
+
+  def next(self, timeout):
+    "Returns the oldest request, or None if there was none within timeout seconds"
+    try:
+      self.condition.acquire()
+      if not self.queue:
+        self.condition.wait(timeout)
+      if not self.queue:
+        return None
+      return self.queue.popleft()
+    finally:
+      self.condition.release()
+
+  def done(self, metric):
+    try:
+      self.condition.acquire()
+      self.pending.discard(metric)
+    finally:
+      self.condition.release()
+
+
+# Ghetto singleton
+PendingCreates = PendingCreates()
+
+
+def createPendingMetric(metric, shard, requestTime):
+  try:
+    createArgs = getCreateArgs(metric)
+    log.creates("creating %s (archive=%s xff=%s agg=%s)" %
+                ((metric,) + createArgs))
+    t = time.time()
+    database.create(metric, *createArgs)
+  except:
+    log.msg("Error creating %s, dropping its datapoints" % metric)
+    log.err()
+    instrumentation.increment('errors')
+    try:
+      shard.pop(metric)
     except KeyError:
-      log.msg("MetricCache contention, skipping %s update for now" % metric)
-      continue  # we simply move on to the next metric when this race condition occurs
+      pass
+  else:
+    now = time.time()
+    shard.unpark(metric)
+    instrumentation.increment('creates')
+    instrumentation.append('createTimes', now - t)
+    instrumentation.append('createWaitTimes', now - requestTime)
+  finally:
+    PendingCreates.done(metric)
+
+
+def createForever():
+  """Creates new metrics in the backend, at most MAX_CREATES_PER_MINUTE a
+  minute, so that slow creates never hold up updates to existing metrics"""
+  createRate = settings.MAX_CREATES_PER_MINUTE
+  if createRate <= 0:
+    log.msg("MAX_CREATES_PER_MINUTE is %s, no new metrics will be created" % createRate)
+    return
+  bucket = TokenBucket(createRate, createRate / 60.0)
 
-    yield (metric, datapoints, dbFilePath, dbFileExists)
+  while reactor.running:
+    try:
+      instrumentation.max('pendingCreates', len(PendingCreates))
+      request = PendingCreates.next(1.0)
+      if request is None:
+        continue
+      bucket.drain(1, blocking=True)
+      createPendingMetric(*request)
+    except:
+      log.err()
 
 
-def writeCachedDataPoints():
-  "Write datapoints until the MetricCache is completely empty"
-  updates = 0
-  lastSecond = 0
+def recordWrite(metric, pointCount, result):
+  updateTime, error = result
 
-  while MetricCache:
-    dataWritten = False
+  if error is not None:
+    log.msg("Error writing %s\n%s" % (metric, error))
+    instrumentation.increment('errors')
+    database.invalidate(metric)
+    return
 
-    for (metric, datapoints, dbFilePath, dbFileExists) in optimalWriteOrder():
-      dataWritten = True
+  instrumentation.increment('committedPoints', pointCount)
+  instrumentation.append('updateTimes', updateTime)
 
-      if not dbFileExists:
-        archiveConfig = None
-        xFilesFactor, aggregationMethod = None, None
-
-        for schema in schemas:
-          if schema.matches(metric):
-            log.creates('new metric %s matched schema %s' % (metric, schema.name))
-            archiveConfig = [archive.getTuple() for archive in schema.archives]
-            break
-
-        for schema in agg_schemas:
-          if schema.matches(metric):
-            log.creates('new metric %s matched aggregation schema %s' % (metric, schema.name))
-            xFilesFactor, aggregationMethod = schema.archives
-            break
-
-        if not archiveConfig:
-          raise Exception("No storage schema matched the metric '%s', check your storage-schemas.conf file." % metric)
-
-        dbDir = dirname(dbFilePath)
-        try:
-            os.makedirs(dbDir, 0755)
-        except OSError as e:
-            log.err("%s" % e)
-        log.creates("creating database file %s (archive=%s xff=%s agg=%s)" %
-                    (dbFilePath, archiveConfig, xFilesFactor, aggregationMethod))
-        whisper.create(dbFilePath, archiveConfig, xFilesFactor, aggregationMethod, settings.WHISPER_SPARSE_CREATE, settings.WHISPER_FALLOCATE_CREATE)
-        instrumentation.increment('creates')
-
-      try:
-        t1 = time.time()
-        whisper.update_many(dbFilePath, datapoints)
-        t2 = time.time()
-        updateTime = t2 - t1
-      except:
-        log.msg("Error writing to %s" % (dbFilePath))
-        log.err()
-        instrumentation.increment('errors')
-      else:
-        pointCount = len(datapoints)
-        instrumentation.increment('committedPoints', pointCount)
-        instrumentation.append('updateTimes', updateTime)
+  if settings.LOG_UPDATES:
+    log.updates("wrote %d datapoints for %s in %.5f seconds" % (pointCount, metric, updateTime))
 
-        if settings.LOG_UPDATES:
-          log.updates("wrote %d datapoints for %s in %.5f seconds" % (pointCount, metric, updateTime))
+  # Rate limit update operations
+  UpdateLimiter.throttle(pointCount, updateTime)
 
-        # Rate limit update operations
-        thisSecond = int(t2)
 
-        if thisSecond != lastSecond:
-          lastSecond = thisSecond
-          updates = 0
-        else:
-          updates += 1
-          if updates >= settings.MAX_UPDATES_PER_SECOND:
-            time.sleep(int(t2 + 1) - t2)
+def writeBatch(batch, writerProcess=None):
+  "Writes { metric : datapoints } with one backend call, or through a WriterProcess"
+  if writerProcess is None:
+    results = database.writeMany(batch)
+  else:
+    results = writerProcess.writeBatch(batch)
+
+  for metric, datapoints in batch.iteritems():
+    recordWrite(metric, len(datapoints), results[metric])
+
+
+def writeCachedDataPoints(shards=None, writerProcess=None):
+  """Write datapoints until the given cache shards (or the whole MetricCache)
+  are empty, or until the writers are stopped. Metrics are handed to the
+  storage backend, or to the given WriterProcess, in batches of up to
+  WRITER_BATCH_SIZE."""
+  if shards is None:
+    shards = MetricCache.shards
+
+  while any(shards) and not state.writersStopped:
+    dataWritten = False
+    instrumentation.max('oldestPointAge', MetricCache.oldestAge())
+    batch = {}
+    WAL.writerBusy(shards)
+
+    for (metric, datapoints) in optimalWriteOrder(shards):
+      dataWritten = True
+      batch[metric] = datapoints
+      if len(batch) >= settings.WRITER_BATCH_SIZE:
+        writeBatch(batch, writerProcess)
+        batch = {}
+        if state.writersStopped:
+          break
+        WAL.writerBusy(shards)
+
+    if batch:
+      writeBatch(batch, writerProcess)
+    WAL.writerIdle()
 
     # Avoid churning CPU when only new metrics are in the cache
     if not dataWritten:
       time.sleep(0.1)
 
 
-def writeForever():
+def writeForever(shards=None, writerProcess=None):
   while reactor.running:
     try:
-      writeCachedDataPoints()
+      writeCachedDataPoints(shards, writerProcess)
+    except WriterProcessDied:
+      return
     except:
       log.err()
 
     time.sleep(1)  # The writer thread only sleeps when the cache is empty or an error occurs
 
 
+def writerProcessMain(conn):
+  """Entry point of a writer process. Receives batches of
+  { metric : datapoints } and answers each with the database.writeMany()
+  results, until the pipe is closed or None is received."""
+  # Shutdown is driven by carbon-cache closing the pipe, never by signals
+  # that would interrupt a write half way.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+  while True:
+    try:
+      batch = conn.recv()
+    except (EOFError, IOError):
+      break
+
+    if batch is None:
+      break
+
+    conn.send(database.writeMany(batch))
+
+  conn.close()
+
+
+class WriterProcessDied(Exception):
+  pass
+
+
+def stopReactor():
+  if reactor.running:
+    reactor.stop()
+
+
+class WriterProcess:
+  """A child process that makes backend writes on behalf of one writer
+  thread, so whisper's packing and unpacking runs outside this process's
+  GIL. The thread blocks while a batch is being written, which keeps
+  MetricCache flow control working as before.
+
+  The process is only ever forked at startup, before the writer threads
+  run. A fork from a running writer thread could leave the child holding
+  locks other threads had at that moment, so a writer process that dies
+  shuts carbon-cache down instead of being started again."""
+  def __init__(self, name):
+    self.name = name
+    self.process = None
+    self.conn = None
+
+  def start(self):
+    self.conn, childConn = Pipe()
+    self.process = Process(target=writerProcessMain, args=(childConn,), name=self.name)
+    self.process.daemon = True
+    self.process.start()
+    childConn.close()
+    log.msg("Started %s with pid %d" % (self.name, self.process.pid))
+
+  def stop(self):
+    if self.process is None:
+      return
+    try:
+      self.conn.send(None)
+    except (EOFError, IOError):
+      pass
+    self.process.join(60)
+    self.conn.close()
+    self.process = None
+
+  def writeBatch(self, batch):
+    """Returns the database.writeMany() results. Raises WriterProcessDied,
+    after having the reactor stop, if the process has died"""
+    try:
+      self.conn.send(batch)
+      return self.conn.recv()
+    except (EOFError, IOError):
+      log.msg("%s died, shutting down. %d metrics were lost" % (self.name, len(batch)))
+      instrumentation.increment('errors', len(batch))
+      self.conn.close()
+      self.process = None
+      reactor.callFromThread(stopReactor)
+      raise WriterProcessDied()
+
+
+def refreshSchemaLists(schemaList):
+  changed = False
+  for schema in schemaList:
+    if schema.refresh():
+      changed = True
+  return changed
+
+
 def reloadStorageSchemas():
+  "Reloads storage-schemas.conf, only if it or one of its lists has changed"
   global schemas
+  global schemas_mtime
   try:
-    schemas = loadStorageSchemas()
+    mtime = getConfigMtime(STORAGE_SCHEMAS_CONFIG)
+    if mtime != schemas_mtime:
+      schemas = loadStorageSchemas()
+      schemas_mtime = mtime
+      changed = True
+    else:
+      changed = refreshSchemaLists(schemas)
+
+    if changed:
+      log.msg("Storage schemas changed, resolving new metrics against them")
   except:
     log.msg("Failed to reload storage schemas")
     log.err()
 
 
 def reloadAggregationSchemas():
+  "Reloads storage-aggregation.conf, only if it or one of its lists has changed"
   global agg_schemas
+  global agg_schemas_mtime
   try:
-    agg_schemas = loadAggregationSchemas()
+    mtime = getConfigMtime(STORAGE_AGGREGATION_CONFIG)
+    if mtime != agg_schemas_mtime:
+      agg_schemas = loadAggregationSchemas()
+      agg_schemas_mtime = mtime
+      changed = True
+    else:
+      changed = refreshSchemaLists(agg_schemas)
+
+    if changed:
+      log.msg("Aggregation schemas changed, resolving new metrics against them")
   except:
     log.msg("Failed to reload aggregation schemas")
     log.err()
@@ -187,24 +483,82 @@ def reloadAggregationSchemas():
 def shutdownModifyUpdateSpeed():
     try:
         settings.MAX_UPDATES_PER_SECOND = settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN
+        UpdateLimiter.setMaxRate(settings.MAX_UPDATES_PER_SECOND)
         log.msg("Carbon shutting down.  Changed the update rate to: " + str(settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN))
     except KeyError:
         log.msg("Carbon shutting down.  Update rate not changed")
 
 
+def stopWriters():
+  "Has the writers stop after their current batch instead of draining the cache"
+  state.writersStopped = True
+  log.msg("Carbon shutting down.  Stopping writers with %d datapoints cached" % MetricCache.size)
+
+
+def snapshotCache():
+  """Saves what is left in the cache to CACHE_SNAPSHOT_FILE once the writers
+  have stopped, unless the write-ahead log already carries it over"""
+  if settings.ENABLE_WAL:
+    log.msg("Leaving %d cached datapoints to the write-ahead log" % MetricCache.size)
+    return
+  try:
+    t = time.time()
+    metrics, datapoints = dumpCache(MetricCache, settings.CACHE_SNAPSHOT_FILE)
+    log.msg("Saved %d datapoints for %d metrics to %s in %.2f seconds" %
+            (datapoints, metrics, settings.CACHE_SNAPSHOT_FILE, time.time() - t))
+  except:
+    log.msg("Failed to save the cache snapshot, %d datapoints are lost" % MetricCache.size)
+    log.err()
+
+
 class WriterService(Service):
 
     def __init__(self):
         self.storage_reload_task = LoopingCall(reloadStorageSchemas)
         self.aggregation_reload_task = LoopingCall(reloadAggregationSchemas)
+        self.writer_processes = []
 
     def startService(self):
         self.storage_reload_task.start(60, False)
         self.aggregation_reload_task.start(60, False)
-        reactor.addSystemEventTrigger('before', 'shutdown', shutdownModifyUpdateSpeed)
-        reactor.callInThread(writeForever)
+        if settings.CACHE_SNAPSHOT_ON_SHUTDOWN:
+            reactor.addSystemEventTrigger('before', 'shutdown', stopWriters)
+            reactor.addSystemEventTrigger('after', 'shutdown', snapshotCache)
+        else:
+            reactor.addSystemEventTrigger('before', 'shutdown', shutdownModifyUpdateSpeed)
+
+        # Each writer thread owns every Nth cache shard, so no two threads
+        # ever hold datapoints for, or write to, the same metric. With
+        # WRITER_PROCESSES every thread feeds a writer process of its own.
+        if settings.WRITER_PROCESSES:
+            threadCount = int(settings.WRITER_PROCESSES)
+        else:
+            threadCount = int(settings.WRITER_THREADS)
+        threadCount = max(1, min(threadCount, MetricCache.shardCount))
+
+        if settings.WRITER_PROCESSES:
+            for i in range(threadCount):
+                writerProcess = WriterProcess('%s-writer-%d' % (settings.program, i))
+                writerProcess.start()
+                self.writer_processes.append(writerProcess)
+            reactor.addSystemEventTrigger('after', 'shutdown', self.stopWriterProcesses)
+
+        reactor.suggestThreadPoolSize(10 + threadCount + 1)
+        reactor.callInThread(database.start)
+        reactor.callInThread(createForever)
+        for i in range(threadCount):
+            if self.writer_processes:
+                writerProcess = self.writer_processes[i]
+            else:
+                writerProcess = None
+            reactor.callInThread(writeForever, MetricCache.shards[i::threadCount], writerProcess)
         Service.startService(self)
 
+    def stopWriterProcesses(self):
+        for writerProcess in self.writer_processes:
+            writerProcess.stop()
+        self.writer_processes = []
+
     def stopService(self):
         self.storage_reload_task.stop()
         self.aggregation_reload_task.stop()
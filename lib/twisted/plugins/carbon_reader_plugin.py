@@ -0,0 +1,25 @@
+from zope.interface import implements
+
+from twisted.plugin import IPlugin
+from twisted.application.service import IServiceMaker
+
+from carbon import service
+from carbon import conf
+
+
+class CarbonReaderServiceMaker(object):
+
+    implements(IServiceMaker, IPlugin)
+    tapname = "carbon-reader"
+    description = "Serve time-range queries for graphite from memory."
+    options = conf.CarbonCacheOptions
+
+    def makeService(self, options):
+        """
+        Construct a C{carbon-reader} service.
+        """
+        return service.createReaderService(options)
+
+
+# Now construct an object which *provides* the relevant interfaces
+serviceMaker = CarbonReaderServiceMaker()